@@ -0,0 +1,230 @@
+# -*- coding:utf-8 -*-
+
+import time
+import asyncio
+
+import aiohttp
+
+from mdapi import MDApiConnector
+from fundamental import FundamentalApi, PARAMS, LIMIT_REACHED
+from scheduler import QuotaExceeded, background
+from transport import RETRY_STATUSES
+import metrics
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTransport:
+    """aiohttp counterpart of HttpTransport, one connection pool per event loop."""
+
+    def __init__(self, pool_size=100, per_host=32, timeout=(3.05, 10), retries=3, backoff=0.5):
+        self.pool_size = pool_size
+        self.per_host = per_host
+        self.timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        self.retries = retries
+        self.backoff = backoff
+        # called with the URL of every retried request, as on HttpTransport
+        self.on_retry = None
+        self.new_connections = 0
+        self.reused_connections = 0
+        self._session = None
+
+    @classmethod
+    def from_config(cls, section):
+        return cls(pool_size=section.getint("pool_size", 10),
+                   per_host=section.getint("per_host", 32),
+                   timeout=(section.getfloat("connect_timeout", 3.05), section.getfloat("read_timeout", 10)),
+                   retries=section.getint("retries", 3),
+                   backoff=section.getfloat("backoff", 0.5))
+
+    @property
+    def session(self):
+        # aiohttp sessions have to be created inside the running loop
+        if self._session is None or self._session.closed:
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self._on_create)
+            trace.on_connection_reuseconn.append(self._on_reuse)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.per_host),
+                timeout=self.timeout, trace_configs=[trace])
+        return self._session
+
+    async def _on_create(self, session, context, params):
+        self.new_connections += 1
+
+    async def _on_reuse(self, session, context, params):
+        self.reused_connections += 1
+
+    async def get_json(self, url, headers=None, params=None):
+        for attempt in range(self.retries + 1):
+            async with self.session.get(url, headers=headers, params=params) as response:
+                if response.status in RETRY_STATUSES and attempt < self.retries:
+                    delay = float(response.headers.get("Retry-After", self.backoff * 2 ** attempt))
+                    if self.on_retry is not None:
+                        self.on_retry(url)
+                    await asyncio.sleep(delay)
+                    continue
+                response.raise_for_status()
+                return await response.json(content_type=None)
+
+    def stats(self):
+        return {"new_connections": self.new_connections,
+                "reused_connections": self.reused_connections}
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+class AsyncMDApiConnector:
+    def __init__(self, connector, transport):
+        # the blocking connector still owns the token and the scheduler
+        self.connector = connector
+        self.transport = transport
+
+    async def _request(self, endpoint, params=None):
+        name = endpoint.split("/")[1]
+        await self.connector.scheduler.acquire_async("exante", name)
+        with metrics.timer("upstream_request_seconds", "upstream_errors_total", upstream="exante", endpoint=name):
+            return await self.transport.get_json(self.connector.url + endpoint, headers=self.connector.auth_headers(),
+                                                 params=params)
+
+    async def get_stocks(self):
+        return MDApiConnector.parse_stocks(await self._request("/types/STOCK"))
+
+    async def get_crossrates(self):
+        return MDApiConnector.parse_crossrates(await self._request("/types/CURRENCY"))
+
+    async def get_crypto(self):
+        return MDApiConnector.parse_crypto(await self._request("/types/FUND"))
+
+    async def get_crossrate_price(self, id1, id2):
+        crossrate = await self._request(f"/crossrates/{id1}/{id2}")
+        return crossrate["rate"]
+
+    async def get_last_ohlc_bar(self, symbol_id):
+        ohlc = await self._request(f"/ohlc/{symbol_id}/86400", {"size": 1})
+        return ohlc[0]
+
+    async def get_bars(self, symbol_id, granularity, size):
+        return await self._request(*MDApiConnector.ohlc_request(symbol_id, granularity, size))
+
+    async def get_ohlc(self, symbol_id, duration):
+        granularity, size = MDApiConnector.ohlc_window(duration)
+        candles = self.connector.candles
+        if candles is None:
+            return await self.get_bars(symbol_id, granularity, size)
+        loop = asyncio.get_running_loop()
+        if candles.shared is not None:
+            await loop.run_in_executor(None, candles.pull, symbol_id, granularity)
+        source, missing = candles.plan(symbol_id, granularity, size)
+        if missing:
+            candles.merge(symbol_id, source, await self.get_bars(symbol_id, source, missing))
+            if candles.shared is not None:
+                await loop.run_in_executor(None, candles.push, symbol_id, source)
+        return candles.bars(symbol_id, granularity, size, source)
+
+    async def get_feed(self, symbol_id):
+        return await self._request(f"/feed/{symbol_id}/last")
+
+
+class AsyncFundamentalApi:
+    def __init__(self, fapi, transport):
+        # cache, coalescing and quota state are shared with the blocking client
+        self.fapi = fapi
+        self.transport = transport
+
+    @metrics.timed("fundamentals_request_seconds")
+    async def request(self, symbol, sheet):
+        key = (symbol, sheet)
+        hit, value, leader = self.fapi.claim(key)
+        if hit:
+            return value
+        if not leader:
+            return await asyncio.wrap_future(value)
+        try:
+            data = await self.shared_sheet(symbol, sheet)
+            if data is None:
+                data = await self.fetch(symbol, sheet)
+                if self.fapi.shared is not None:
+                    await asyncio.get_running_loop().run_in_executor(None, self.fapi.share, symbol, sheet, data)
+        except Exception as e:
+            self.fapi.settle(key, value, error=e)
+            raise
+        self.fapi.settle(key, value, data)
+        return data
+
+    async def shared_sheet(self, symbol, sheet):
+        # the backend client blocks, so it runs on the default executor
+        if self.fapi.shared is None:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(None, self.fapi.shared_sheet, symbol, sheet)
+
+    async def fetch(self, symbol, sheet):
+        scheduler = self.fapi.scheduler
+        if scheduler.quota_low("fmp"):
+            return LIMIT_REACHED
+        try:
+            await scheduler.acquire_async("fmp", sheet)
+        except QuotaExceeded:
+            return LIMIT_REACHED
+        with metrics.timer("upstream_request_seconds", "upstream_errors_total", upstream="fmp", endpoint=sheet):
+            data = await self.transport.get_json(self.fapi.url(symbol, sheet), params=PARAMS)
+        return FundamentalApi.parse(data)
+
+
+class AsyncRefresher:
+    """Runs DataStorage refresh cycles as coroutines instead of the storage thread."""
+
+    def __init__(self, storage, connector, workers=8):
+        self.storage = storage
+        self.connector = connector
+        self.workers = workers
+
+    async def refresh(self, universe=True, feed_ids=None):
+        started = time.perf_counter()
+        limit = asyncio.Semaphore(self.workers)
+
+        async def timed(stage, func, args):
+            async with limit:
+                began = time.perf_counter()
+                try:
+                    result = await func(*args)
+                except Exception as e:
+                    return stage, None, None, e
+                return stage, time.perf_counter() - began, result, None
+
+        jobs = self.storage.refresh_jobs(universe, feed_ids, connector=self.connector)
+        outcomes = await asyncio.gather(*(timed(*job) for job in jobs))
+        # publishing rebuilds the search index, which is CPU work
+        await asyncio.get_running_loop().run_in_executor(None, self.storage.finish_refresh, outcomes, started)
+
+    async def run(self):
+        self.storage.start_stream()
+        with background():
+            loop = asyncio.get_running_loop()
+            while True:
+                self.storage.wakeup.clear()
+                try:
+                    if self.storage.following():
+                        # followers only read the leader's snapshot from the backend
+                        timeout = await loop.run_in_executor(None, self.storage.step)
+                    else:
+                        await loop.run_in_executor(None, self.storage.exchange_ids)
+                        polled = self.storage.due_poll()
+                        if polled is None:
+                            await self.refresh(feed_ids=self.storage.next_feed_ids())
+                            # writing the snapshot is disk work, keep it off the loop
+                            await loop.run_in_executor(None, self.storage.refreshed)
+                        elif polled:
+                            await self.refresh(universe=False, feed_ids=polled)
+                            await loop.run_in_executor(None, self.storage.polled_refreshed)
+                        timeout = self.storage.interval()
+                except Exception:
+                    logger.exception("Refresh failed, retrying in 15s")
+                    metrics.counter("refresh_failures_total").inc()
+                    timeout = 15
+                # a change of leader cuts the wait short
+                await loop.run_in_executor(None, self.storage.wakeup.wait, timeout)
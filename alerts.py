@@ -0,0 +1,233 @@
+# -*- coding:utf-8 -*-
+
+import os
+import time
+import pickle
+from bisect import bisect_left, bisect_right, insort
+from collections import namedtuple
+from threading import Thread, Event, Lock
+
+from scheduler import default_scheduler
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# one Telegram message holds at most 4096 characters
+MAX_MESSAGE = 4000
+
+Alert = namedtuple("Alert", "id chat_id symbol_id ticker op threshold created")
+
+
+def quote_price(quote):
+    # mid price when both sides are quoted, otherwise whichever side there is
+    sides = [float(quote[side][0]["value"]) for side in ("bid", "ask") if quote.get(side)]
+    return sum(sides) / len(sides) if sides else None
+
+
+class AlertBook:
+    """One-shot price alerts kept in per-symbol sorted threshold lists.
+
+    An alert fires when the price crosses its threshold: ``>`` when the
+    previous price was at or below it and the new one is above. Alerts are
+    stored as ascending ``(threshold, id)`` pairs, so the alerts crossed
+    between the previous and the new price are one slice of the list and a
+    quote only touches the alerts it triggers.
+    """
+
+    def __init__(self, path=None, max_per_chat=50):
+        self.alerts = {}
+        # symbol id -> {">": [(threshold, id), ...], "<": [...]}
+        self.index = {}
+        self.by_chat = {}
+        # symbol id -> last price seen, the start of the next crossing
+        self.last = {}
+        self.next_id = 1
+        self.path = path
+        self.max_per_chat = max_per_chat
+        self.triggered = 0
+        self.dirty = False
+        self._lock = Lock()
+        self._save_lock = Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    data = pickle.load(f)
+                self.next_id = data["next_id"]
+                self.last.update(data.get("last", {}))
+                for alert in data["alerts"]:
+                    self._insert(alert)
+            except Exception as e:
+                logger.error(f"Could not load alerts {path}: {e}")
+
+    def __len__(self):
+        return len(self.alerts)
+
+    def _insert(self, alert):
+        self.alerts[alert.id] = alert
+        self.by_chat.setdefault(alert.chat_id, set()).add(alert.id)
+        sides = self.index.setdefault(alert.symbol_id, {">": [], "<": []})
+        insort(sides[alert.op], (alert.threshold, alert.id))
+
+    def add(self, chat_id, symbol_id, ticker, op, threshold, price=None):
+        # price is the current one if known, a later quote past the threshold then fires the alert
+        if op not in (">", "<"):
+            raise ValueError(f"unknown condition {op}")
+        with self._lock:
+            if len(self.by_chat.get(chat_id, ())) >= self.max_per_chat:
+                raise ValueError(f"at most {self.max_per_chat} alerts per chat")
+            alert = Alert(self.next_id, chat_id, symbol_id, ticker, op, float(threshold), time.time())
+            self.next_id += 1
+            self._insert(alert)
+            if price is not None:
+                self.last.setdefault(symbol_id, price)
+            self.dirty = True
+        return alert
+
+    def remove(self, chat_id, alert_id):
+        with self._lock:
+            alert = self.alerts.get(alert_id)
+            if alert is None or alert.chat_id != chat_id:
+                return None
+            self._discard(alert_id)
+            side = self.index[alert.symbol_id][alert.op]
+            del side[bisect_left(side, (alert.threshold, alert.id))]
+            self.dirty = True
+        return alert
+
+    def _discard(self, alert_id):
+        alert = self.alerts.pop(alert_id)
+        self.by_chat[alert.chat_id].discard(alert_id)
+        return alert
+
+    def for_chat(self, chat_id):
+        with self._lock:
+            return [self.alerts[alert_id] for alert_id in sorted(self.by_chat.get(chat_id, ()))]
+
+    def symbols(self):
+        with self._lock:
+            return [symbol_id for symbol_id, sides in self.index.items() if sides[">"] or sides["<"]]
+
+    def match(self, symbol_id, price):
+        # removes and returns the alerts crossed on the way from the last price to this one
+        previous = self.last.get(symbol_id)
+        self.last[symbol_id] = price
+        sides = self.index.get(symbol_id)
+        if sides is None or previous is None or previous == price:
+            return []
+        if price > previous:
+            # previous <= threshold < price
+            side = sides[">"]
+            i, j = bisect_left(side, (previous,)), bisect_left(side, (price,))
+        else:
+            # price < threshold <= previous
+            side = sides["<"]
+            i, j = bisect_right(side, (price, float("inf"))), bisect_right(side, (previous, float("inf")))
+        fired = side[i:j]
+        del side[i:j]
+        return [self._discard(alert_id) for _, alert_id in fired]
+
+    def check(self, quotes):
+        # returns (alert, price) for every alert the quotes triggered
+        fired = []
+        with self._lock:
+            for quote in quotes:
+                if quote["symbolId"] not in self.index:
+                    continue
+                price = quote_price(quote)
+                if price is not None:
+                    fired.extend((alert, price) for alert in self.match(quote["symbolId"], price))
+            self.triggered += len(fired)
+            self.dirty = self.dirty or bool(fired)
+        return fired
+
+    def save(self, path=None):
+        path = path or self.path
+        if not path:
+            return
+        with self._lock:
+            data = {"next_id": self.next_id, "alerts": list(self.alerts.values()),
+                    "last": {symbol_id: self.last[symbol_id] for symbol_id in self.index if symbol_id in self.last}}
+            self.dirty = False
+        tmp = path + ".tmp"
+        with self._save_lock:
+            try:
+                with open(tmp, "wb") as f:
+                    pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, path)
+            except OSError as e:
+                logger.error(f"Could not save alerts {path}: {e}")
+
+    def autosave(self, interval=5):
+        # changes reach the disk within ``interval`` seconds instead of one write per change
+        def run():
+            while True:
+                time.sleep(interval)
+                if self.dirty:
+                    self.save()
+        Thread(target=run, name="alerts-save", daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            return {"alerts": len(self.alerts), "symbols": len(self.index), "triggered": self.triggered}
+
+
+class AlertNotifier(Thread):
+    """Collects triggered alerts for ``window`` seconds and sends one message per chat.
+
+    Sends go through the scheduler's ``telegram`` limit, so a burst of
+    triggers stays inside the Bot API's message rate.
+    """
+
+    def __init__(self, send, scheduler=None, window=1.0):
+        super().__init__(daemon=True)
+        self.send = send
+        self.scheduler = scheduler or default_scheduler
+        self.window = window
+        self.sent = 0
+        self.failed = 0
+        self._pending = {}
+        self._lock = Lock()
+        self._wakeup = Event()
+
+    def notify(self, chat_id, line):
+        with self._lock:
+            self._pending.setdefault(chat_id, []).append(line)
+        self._wakeup.set()
+
+    @staticmethod
+    def messages(lines):
+        message = ""
+        for line in lines:
+            if message and len(message) + len(line) + 1 > MAX_MESSAGE:
+                yield message
+                message = ""
+            message = f"{message}\n{line}" if message else line
+        if message:
+            yield message
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for chat_id, lines in pending.items():
+            for message in self.messages(lines):
+                try:
+                    self.scheduler.acquire("telegram")
+                    self.send(chat_id, message)
+                    self.sent += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"Could not send alerts to {chat_id}: {e}")
+
+    def stats(self):
+        with self._lock:
+            pending = sum(len(lines) for lines in self._pending.values())
+        return {"sent": self.sent, "failed": self.failed, "pending": pending}
+
+    def run(self):
+        while True:
+            self._wakeup.wait()
+            # a burst of triggers for one chat ends up in a single message
+            time.sleep(self.window)
+            self._wakeup.clear()
+            self.flush()
@@ -0,0 +1,316 @@
+# -*- coding:utf-8 -*-
+
+import os
+import time
+import pickle
+import socket
+from collections import OrderedDict
+from queue import LifoQueue, Empty, Full
+from threading import Thread, Lock, Event
+from uuid import uuid4
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# lease scripts run atomically on the server: only the owner may extend or drop its lease
+RENEW = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+
+class BackendError(Exception):
+    pass
+
+
+class MemoryBackend:
+    """Key-value store with expiry inside this process, the default for a single replica.
+
+    Values are kept as they are, so callers must not change them after set().
+    """
+
+    # caches in front of it hold the same values already, there is nothing to share
+    remote = False
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        # key -> (value, expires at or None), least recently written first
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.monotonic() + ttl if ttl else None)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def add_members(self, key, members, ttl=None):
+        # adds to the set under key, the expiry covers the whole set
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            current = entry[0] if entry is not None and (entry[1] is None or entry[1] > time.monotonic()) else set()
+            self._entries[key] = (current | set(members), time.monotonic() + ttl if ttl else None)
+
+    def members(self, key):
+        return set(self.get(key) or ())
+
+    def lease(self, name, owner, ttl):
+        # takes a free or expired lease, or extends our own; True while we hold it
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry[0] != owner and entry[1] > time.monotonic():
+                return False
+            self._entries.pop(name, None)
+            self._entries[name] = (owner, time.monotonic() + ttl)
+            return True
+
+    def release(self, name, owner):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry[0] == owner:
+                del self._entries[name]
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries)}
+
+
+class RedisBackend:
+    """Pickled values in Redis, or anything speaking its protocol, under one key prefix.
+
+    A shared cache that is down behaves like an empty one: get() misses and
+    set() is dropped. Lease calls raise BackendError instead, so the caller can
+    tell an outage from a lost election.
+    """
+
+    remote = True
+
+    def __init__(self, host="127.0.0.1", port=6379, db=0, password=None, prefix="mardat:", timeout=1.0,
+                 pool_size=8):
+        self.address = (host, port)
+        self.db = db
+        self.password = password
+        self.prefix = prefix
+        self.timeout = timeout
+        self.commands = 0
+        self.errors = 0
+        self._idle = LifoQueue(maxsize=pool_size)
+        self._lock = Lock()
+
+    @classmethod
+    def from_config(cls, section):
+        return cls(host=section.get('host', '127.0.0.1'),
+                   port=section.getint('port', 6379),
+                   db=section.getint('db', 0),
+                   password=section.get('password') or None,
+                   prefix=section.get('prefix', 'mardat:'),
+                   timeout=section.getfloat('timeout', 1.0),
+                   pool_size=section.getint('pool_size', 8))
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = (sock, sock.makefile("rb"))
+        if self.password:
+            self._call(conn, ("AUTH", self.password))
+        if self.db:
+            self._call(conn, ("SELECT", self.db))
+        return conn
+
+    @staticmethod
+    def _encode(args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    def _read(self, reader):
+        line = reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise BackendError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            size = int(rest)
+            if size < 0:
+                return None
+            data = reader.read(size + 2)
+            if len(data) != size + 2:
+                raise ConnectionError("connection closed")
+            return data[:-2]
+        if kind == b"*":
+            size = int(rest)
+            return None if size < 0 else [self._read(reader) for _ in range(size)]
+        raise ConnectionError(f"unexpected reply {line[:20]!r}")
+
+    def _call(self, conn, args):
+        conn[0].sendall(self._encode(args))
+        return self._read(conn[1])
+
+    def command(self, *args):
+        try:
+            conn = self._idle.get_nowait()
+        except Empty:
+            conn = None
+        with self._lock:
+            self.commands += 1
+        try:
+            conn = conn or self._connect()
+            reply = self._call(conn, args)
+        except BackendError:
+            # an error reply, the connection itself is fine
+            with self._lock:
+                self.errors += 1
+            if conn is not None:
+                self._release(conn)
+            raise
+        except (OSError, ValueError) as e:
+            # a half-read reply leaves the connection unusable
+            with self._lock:
+                self.errors += 1
+            if conn is not None:
+                conn[0].close()
+            raise BackendError(f"{args[0]} failed: {e}") from e
+        self._release(conn)
+        return reply
+
+    def _release(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except Full:
+            conn[0].close()
+
+    def get(self, key):
+        try:
+            data = self.command("GET", self.prefix + key)
+        except BackendError as e:
+            logger.warning(f"Shared cache get {key} failed: {e}")
+            return None
+        return pickle.loads(data) if data is not None else None
+
+    def set(self, key, value, ttl=None):
+        args = ["SET", self.prefix + key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)]
+        if ttl:
+            args += ["PX", int(ttl * 1000)]
+        try:
+            self.command(*args)
+        except BackendError as e:
+            logger.warning(f"Shared cache set {key} failed: {e}")
+
+    def delete(self, key):
+        try:
+            self.command("DEL", self.prefix + key)
+        except BackendError as e:
+            logger.warning(f"Shared cache delete {key} failed: {e}")
+
+    def add_members(self, key, members, ttl=None):
+        # members are strings, kept in a native Redis set
+        if not members:
+            return
+        try:
+            self.command("SADD", self.prefix + key, *members)
+            if ttl:
+                self.command("PEXPIRE", self.prefix + key, int(ttl * 1000))
+        except BackendError as e:
+            logger.warning(f"Shared cache add to {key} failed: {e}")
+
+    def members(self, key):
+        try:
+            return {member.decode() for member in self.command("SMEMBERS", self.prefix + key)}
+        except BackendError as e:
+            logger.warning(f"Shared cache members of {key} failed: {e}")
+            return set()
+
+    def lease(self, name, owner, ttl):
+        key, ms = self.prefix + name, int(ttl * 1000)
+        if self.command("SET", key, owner, "NX", "PX", ms) is not None:
+            return True
+        return self.command("EVAL", RENEW, 1, key, owner, ms) == 1
+
+    def release(self, name, owner):
+        self.command("EVAL", RELEASE, 1, self.prefix + name, owner)
+
+    def stats(self):
+        with self._lock:
+            return {"commands": self.commands, "errors": self.errors, "idle_connections": self._idle.qsize()}
+
+
+def open_backend(section=None):
+    # [Backend] kind=memory (default) or redis
+    kind = section.get('kind', 'memory') if section is not None else 'memory'
+    if kind == 'redis':
+        return RedisBackend.from_config(section)
+    if kind != 'memory':
+        raise ValueError(f"Unknown backend {kind}")
+    return MemoryBackend(max_entries=section.getint('max_entries', 100000) if section is not None else 100000)
+
+
+class LeaderElection(Thread):
+    """Holds a lease in the backend; the replica holding it refreshes, the others follow.
+
+    If the backend cannot be reached every replica considers itself the
+    leader, so an outage degrades to independent replicas instead of none
+    refreshing at all.
+    """
+
+    def __init__(self, backend, name="leader", ttl=30, owner=None):
+        super().__init__(name="election", daemon=True)
+        self.backend = backend
+        self.lease_name = name
+        self.ttl = ttl
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.leader = False
+        self.transitions = 0
+        # called with the new state whenever it changes
+        self.listeners = []
+        self._stopped = Event()
+
+    def renew(self):
+        try:
+            leader = self.backend.lease(self.lease_name, self.owner, self.ttl)
+        except BackendError as e:
+            logger.warning(f"Leader election unavailable, refreshing locally: {e}")
+            leader = True
+        if leader != self.leader:
+            self.leader = leader
+            self.transitions += 1
+            logger.info(f"{self.owner} is {'now the leader' if leader else 'following'}")
+            for listener in self.listeners:
+                listener(leader)
+        return leader
+
+    def run(self):
+        # renewing three times per lease keeps it through one missed round
+        while not self._stopped.wait(self.ttl / 3):
+            self.renew()
+
+    def stop(self):
+        self._stopped.set()
+        try:
+            self.backend.release(self.lease_name, self.owner)
+        except BackendError:
+            pass
+
+    def stats(self):
+        return {"leader": int(self.leader), "transitions": self.transitions}
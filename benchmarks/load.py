@@ -0,0 +1,419 @@
+# -*- coding:utf-8 -*-
+"""
+Load and cold-start benchmarks against local stand-ins for Exante, FMP and Telegram.
+
+    python benchmarks/load.py --mode threaded,asyncio --concurrency 32 --requests 2000 \\
+        --latency exante=0.05,fmp=0.15,telegram=0.03 --errors exante=0.01 --output load.json
+    python benchmarks/load.py --scenario coldstart --stocks 40000 --output coldstart.json
+    python benchmarks/load.py --scenario replicas --replicas 3 --requests 900 --output replicas.json
+
+The load scenario drives ``process``, ``tchart_menu`` and ``cryptolist`` through
+the running dispatcher (or the event loop in asyncio mode) at a fixed
+concurrency. It reports latency percentiles per handler, throughput, memory and
+upstream calls per interaction. Each mode runs in a fresh interpreter, and the
+results are printed as one JSON document. The replicas scenario runs several
+bots at once against the same stand-ins and a stand-in Redis; it reports which
+replica was elected and how many upstream calls all of them made together.
+
+Traffic is synthetic unless ``--traffic`` names a recording: one JSON object per
+line, such as ``{"action": "process", "text": "aapl goog"}``,
+``{"action": "chart", "kind": "stock", "ticker": "AAPL", "range": "1 week"}``
+or ``{"action": "cryptolist"}``. ``--save-traffic`` writes the synthetic traffic
+in that format.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from standins import ROOT, POPULAR, StandInServer, KeyValueServer, Universe, Upstream, bench_config
+
+RANGES = ["30 mins.", "1 hour", "6 hours", "1 day", "1 week", "30 days", "3 months", "6 months"]
+
+
+def pairs(text, cast=float):
+    # "exante=0.05,fmp=0.1" -> {"exante": 0.05, "fmp": 0.1}
+    return {k.strip(): cast(v) for k, v in (item.split("=") for item in text.split(",") if item)} if text else {}
+
+
+def memory():
+    # current and peak resident set size in MiB
+    values = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    values[line.split(":")[0]] = int(line.split()[1]) / 1024
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        values = {"VmRSS": peak, "VmHWM": peak}
+    return {"rss_mb": round(values["VmRSS"], 1), "peak_rss_mb": round(values["VmHWM"], 1)}
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summary(latencies, errors):
+    return {"count": len(latencies),
+            "errors": errors,
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None,
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+            "p90_ms": round(percentile(latencies, 0.9) * 1000, 2) if latencies else None,
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+            "max_ms": round(max(latencies) * 1000, 2) if latencies else None}
+
+
+def synthetic_traffic(universe, count, mix, seed):
+    rnd = random.Random(seed)
+    tickers = POPULAR + [s["ticker"] for s in rnd.sample(universe.stocks[len(POPULAR):],
+                                                         min(200, len(universe.stocks) - len(POPULAR)))]
+    # a few instruments get most of the traffic, as in real chats
+    weights = [1 / (i + 1) for i in range(len(tickers))]
+    crossrates = [c["ticker"] for c in universe.crossrates]
+    actions, kinds = [], list(mix)
+    for _ in range(count):
+        kind = rnd.choices(kinds, [mix[k] for k in kinds])[0]
+        if kind == "process":
+            roll = rnd.random()
+            if roll < 0.7:
+                text = rnd.choices(tickers, weights)[0].lower()
+            elif roll < 0.85:
+                text = rnd.choice(crossrates).lower()
+            else:
+                text = " ".join(t.lower() for t in rnd.choices(tickers, weights, k=rnd.randint(2, 6)))
+            actions.append({"action": "process", "text": text})
+        elif kind == "chart":
+            actions.append({"action": "chart", "kind": "stock", "ticker": rnd.choices(tickers, weights)[0],
+                            "range": rnd.choice(["stock"] + RANGES)})
+        else:
+            actions.append({"action": "cryptolist"})
+    return actions
+
+
+class Driver:
+    """Builds Telegram updates for traffic entries and runs them through the bot's handlers."""
+
+    def __init__(self, bot, mode, users=500):
+        from telegram import Update
+        from telegram.ext import CallbackContext
+        self.bot = bot
+        self.mode = mode
+        self.users = users
+        self.Update = Update
+        self.CallbackContext = CallbackContext
+        self.update_id = 0
+        if mode == "asyncio":
+            self.handlers = {"process": bot.process_async, "chart": bot.tchart_menu_async,
+                             "cryptolist": bot.cryptolist_async}
+        else:
+            self.handlers = {"process": bot.process, "chart": bot.tchart_menu, "cryptolist": bot.cryptolist}
+
+    def message(self, user_id, text):
+        return {"message_id": random.randint(1, 10 ** 6), "date": int(time.time()), "text": text,
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "Bench"}}
+
+    def update(self, action, user_id):
+        self.update_id += 1
+        data = {"update_id": self.update_id}
+        if action["action"] == "chart":
+            data["callback_query"] = {"id": str(self.update_id), "chat_instance": "bench", "data": action["range"],
+                                      "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+                                      "message": self.message(user_id, "")}
+        else:
+            text = "/cryptolist" if action["action"] == "cryptolist" else action["text"]
+            data["message"] = self.message(user_id, text)
+        return self.Update.de_json(data, self.bot.up.bot)
+
+    def context(self, update, action):
+        context = self.CallbackContext.from_update(update, self.bot.dispatcher)
+        if action["action"] == "chart":
+            table = {"stock": self.bot.storage.stocks, "cross": self.bot.storage.crossrates,
+                     "crypto": self.bot.storage.crypto}[action.get("kind", "stock")]
+            instrum = table[action["ticker"]]
+            # the chart buttons belong to an earlier quote reply, remembered per message
+            counter = instrum.get("currency") or instrum["ticker"].split("/")[-1]
+            message = update.callback_query.message
+            self.bot.remember_chart(message.chat_id, message.message_id, instrum, counter)
+        return context
+
+    def run(self, action):
+        # returns the handler's wall time; raises when the handler failed
+        user_id = random.randint(1, self.users)
+        update = self.update(action, user_id)
+        context = self.context(update, action)
+        handler = self.handlers[action["action"]]
+        started = time.perf_counter()
+        if self.mode == "asyncio":
+            import asyncio
+            asyncio.run_coroutine_threadsafe(handler(update, context), self.bot.loop).result()
+        else:
+            promise = handler(update, context)
+            promise.result()
+            if promise.exception is not None:
+                raise promise.exception
+        return time.perf_counter() - started
+
+
+def wait_for(condition, timeout, interval=0.05):
+    started = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - started > timeout:
+            raise TimeoutError("the bot did not get ready in time")
+        time.sleep(interval)
+    return time.perf_counter() - started
+
+
+def start_server(args):
+    latency, jitter, errors = pairs(args.latency), pairs(args.jitter), pairs(args.errors)
+    upstreams = {name: Upstream(latency.get(name, 0), jitter.get(name, 0), errors.get(name, 0))
+                 for name in ("exante", "fmp", "telegram")}
+    return StandInServer(Universe(args.stocks, args.seed), replay=args.replay, record=args.record,
+                         **upstreams).start()
+
+
+def run_load(args):
+    # replicas get their config from the parent, which runs the stand-ins for all of them
+    server = None if args.config else start_server(args)
+    config_path = args.config or bench_config(tempfile.mkdtemp(prefix="mardat-bench-"), server, limits=args.limits,
+                                              Bot={"mode": args.mode}, Feed={"stream": "false"})
+    rss_start = memory()
+    import bot
+    import metrics
+    bot.bootstrap(config_path)
+    bot.launch()
+    wait_for(lambda: len(bot.storage.stocks) > 0, 120)
+
+    if args.traffic:
+        with open(args.traffic) as f:
+            traffic = [json.loads(line) for line in f if line.strip()]
+    else:
+        mix = pairs(args.mix)
+        universe = server.universe if server is not None else Universe(args.stocks, args.seed)
+        traffic = synthetic_traffic(universe, args.requests + args.warmup, mix, args.seed)
+        if args.save_traffic:
+            with open(args.save_traffic, "w") as f:
+                f.writelines(json.dumps(action) + "\n" for action in traffic)
+    total = args.requests + args.warmup
+    traffic = [traffic[i % len(traffic)] for i in range(total)]
+
+    driver = Driver(bot, args.mode, args.users)
+    latencies, errors = {}, {}
+
+    def one(action, record):
+        try:
+            elapsed = driver.run(action)
+        except Exception:
+            if record:
+                errors[action["action"]] = errors.get(action["action"], 0) + 1
+            return
+        if record:
+            latencies.setdefault(action["action"], []).append(elapsed)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(lambda a: one(a, False), traffic[:args.warmup]))
+        rss_warm = memory()
+        before = server.stats() if server is not None else None
+        started = time.perf_counter()
+        list(pool.map(lambda a: one(a, True), traffic[args.warmup:]))
+        wall = time.perf_counter() - started
+    after = server.stats() if server is not None else None
+    rss_end = memory()
+
+    completed = sum(len(v) for v in latencies.values())
+    everything = [x for v in latencies.values() for x in v]
+    return {"scenario": "load",
+            "mode": args.mode,
+            "leader": int(bot.election.leader) if bot.election is not None else None,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "duration_s": round(wall, 3),
+            "throughput_rps": round(completed / wall, 2) if wall else None,
+            "handlers": {name: summary(latencies.get(name, []), errors.get(name, 0))
+                         for name in sorted(set(latencies) | set(errors))},
+            "all": summary(everything, sum(errors.values())),
+            "memory": {"start": rss_start, "warm": rss_warm, "end": rss_end},
+            "upstream": upstream_summary(before, after, completed) if server is not None else None,
+            "bot": metrics.collect()}
+
+
+def upstream_summary(before, after, completed):
+    calls = {k: after["requests"].get(k, 0) - before["requests"].get(k, 0) for k in after["requests"]}
+    upstream_calls = sum(v for k, v in calls.items() if k.startswith(("exante", "fmp")))
+    telegram_calls = sum(v for k, v in calls.items() if k.startswith("telegram") and not k.endswith("getUpdates"))
+    return {"calls": calls,
+            "errors": after["errors"],
+            "upstream_calls_per_request": round(upstream_calls / max(completed, 1), 3),
+            "telegram_calls_per_request": round(telegram_calls / max(completed, 1), 3)}
+
+
+def run_coldstart(args):
+    server = start_server(args)
+    config_path = bench_config(args.workdir, server, limits=args.limits, Feed={"stream": "false"})
+    with_snapshot = os.path.exists(os.path.join(args.workdir, "snapshot.pickle"))
+    started = time.perf_counter()
+    import bot
+    imported = time.perf_counter()
+    bot.bootstrap(config_path)
+    booted = time.perf_counter()
+    universe_at_boot = len(bot.storage.stocks)
+    bot.launch()
+    launched = time.perf_counter()
+    # with a snapshot the universe is there as soon as bootstrap() returns
+    universe = booted if universe_at_boot else launched + wait_for(lambda: len(bot.storage.stocks) > 0, 600)
+    wait_for(lambda: not bot.storage.skip, 600)
+    refreshed = time.perf_counter()
+    return {"scenario": "coldstart",
+            "snapshot": with_snapshot,
+            "stocks": len(bot.storage.stocks),
+            "universe_at_bootstrap": universe_at_boot,
+            "import_s": round(imported - started, 4),
+            "bootstrap_s": round(booted - imported, 4),
+            "launch_s": round(launched - booted, 4),
+            "time_to_universe_s": round(universe - started, 4),
+            "time_to_first_refresh_s": round(refreshed - started, 4),
+            "memory": memory()}
+
+
+def child(args):
+    result = run_coldstart(args) if args.scenario == "coldstart" else run_load(args)
+    print(json.dumps(result))
+    sys.stdout.flush()
+    # Updater, renderer pool and stand-in threads are not worth an orderly shutdown here
+    os._exit(0)
+
+
+def spawn(argv, **extra):
+    return finish(start_child(argv, **extra))
+
+
+def start_child(argv, **extra):
+    command = [sys.executable, os.path.abspath(__file__), "--child"] + argv
+    for key, value in extra.items():
+        command += [f"--{key.replace('_', '-')}", str(value)]
+    return subprocess.Popen(command, cwd=ROOT, stdout=subprocess.PIPE)
+
+
+def finish(child):
+    output, _ = child.communicate()
+    if child.returncode:
+        raise subprocess.CalledProcessError(child.returncode, child.args)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def run_replicas(args, argv):
+    # every replica is a separate bot process; upstreams and the backend are shared by all of them
+    server = start_server(args)
+    keyvalue = KeyValueServer().start()
+    host, port = keyvalue.address
+    before = server.stats()
+    with tempfile.TemporaryDirectory() as workdir:
+        children = []
+        for i in range(args.replicas):
+            directory = os.path.join(workdir, f"replica{i}")
+            os.mkdir(directory)
+            config_path = bench_config(directory, server, limits=args.limits,
+                                       Bot={"mode": args.mode}, Feed={"stream": "false"},
+                                       Backend={"kind": "redis", "host": host, "port": port})
+            children.append(start_child(argv, config=config_path, requests=args.requests // args.replicas,
+                                        seed=args.seed + i))
+        runs = [finish(child) for child in children]
+    completed = sum(run["all"]["count"] for run in runs)
+    return runs, {"leaders": sum(run["leader"] or 0 for run in runs),
+                  "upstream": upstream_summary(before, server.stats(), completed),
+                  "backend": keyvalue.stats()}
+
+
+def strip(argv, *options):
+    # drops options the parent sets per child, in both "--opt value" and "--opt=value" form
+    kept, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in options:
+            skip = True
+        elif not arg.startswith(tuple(f"{option}=" for option in options)):
+            kept.append(arg)
+    return kept
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--scenario", choices=["load", "coldstart", "replicas"], default="load")
+    parser.add_argument("--mode", default="threaded", help="threaded, asyncio or both comma-separated")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--replicas", type=int, default=3, help="bots sharing one backend in the replicas scenario")
+    parser.add_argument("--mix", default="process=0.7,chart=0.2,cryptolist=0.1")
+    parser.add_argument("--stocks", type=int, default=2000, help="size of the stand-in stock universe")
+    parser.add_argument("--latency", default="exante=0.03,fmp=0.1,telegram=0.02", help="seconds per upstream")
+    parser.add_argument("--jitter", default="", help="seconds of uniform jitter per upstream")
+    parser.add_argument("--errors", default="", help="share of failed requests per upstream")
+    parser.add_argument("--limits", action="store_true", help="keep the [Limits] rate limits of config.ini")
+    parser.add_argument("--traffic", help="recorded traffic to replay instead of synthetic traffic")
+    parser.add_argument("--save-traffic", help="write the synthetic traffic to this file")
+    parser.add_argument("--replay", help="recorded upstream responses to serve")
+    parser.add_argument("--record", help="append every upstream response served to this file")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--config", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+
+    argv = strip(sys.argv[1:], "--output")
+    runs, totals = [], None
+    if args.scenario == "replicas":
+        runs, totals = run_replicas(args, strip(argv, "--requests", "--seed", "--scenario"))
+    elif args.scenario == "coldstart":
+        with tempfile.TemporaryDirectory() as workdir:
+            # the first start has no snapshot and writes one, the second starts from it
+            runs.append(spawn(argv, workdir=workdir))
+            runs.append(spawn(argv, workdir=workdir))
+    else:
+        for mode in args.mode.split(","):
+            runs.append(spawn(strip(argv, "--mode"), mode=mode))
+
+    report = {"meta": {"revision": git_revision(),
+                       "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                       "python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "args": {k: v for k, v in vars(args).items() if k not in ("child", "workdir", "config")}},
+              "runs": runs}
+    if totals is not None:
+        report["totals"] = totals
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,447 @@
+# -*- coding:utf-8 -*-
+"""
+Local stand-ins for the Exante MD API, the FMP statements and the Telegram Bot
+API, served from one HTTP server so the bot can be measured without credentials,
+and for the Redis commands the shared backend uses. Streamed feeds (``accept:
+application/x-json-stream``) stay open and can be cut off with ``drop_streams()``.
+
+Every upstream gets its own latency, jitter and error rate. Responses can be
+replayed from a recording (one JSON object per line with ``path``, ``status``
+and ``body``) and everything served can be recorded in the same format.
+"""
+
+import os
+import json
+import time
+import random
+import sys
+import threading
+from configparser import ConfigParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from urllib.parse import urlsplit, unquote, parse_qs
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from backend import RENEW, RELEASE  # noqa: E402
+
+EXANTE_PREFIX = "/md/2.0"
+FMP_PREFIX = "/api/v3"
+TELEGRAM_PREFIX = "/bot"
+
+POPULAR = ["AAPL", "GOOG", "TSLA", "AMZN", "NFLX", "MSFT", "NVDA", "META", "INTC", "AMD"]
+CURRENCIES = ["EUR", "USD", "GBP", "JPY", "CHF", "RUB", "CAD", "AUD"]
+CRYPTO = ["BTC", "ETH", "LTC", "XRP", "BCH", "EOS", "XLM", "TRX"]
+
+
+class Upstream:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    def delay(self):
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def fails(self):
+        return random.random() < self.error_rate
+
+
+class Universe:
+    """Synthetic instruments with prices that drift on every request."""
+
+    def __init__(self, stocks=2000, seed=7):
+        rnd = random.Random(seed)
+        tickers = POPULAR + [f"S{i:05d}" for i in range(max(stocks - len(POPULAR), 0))]
+        self.stocks = [{"id": f"{t}.NASDAQ", "ticker": t, "exchange": "NASDAQ", "currency": "USD",
+                        "description": f"{t} Holdings Inc", "country": "US"} for t in tickers]
+        self.crossrates = [{"id": f"{a}/{b}.EXANTE", "ticker": f"{a}/{b}", "exchange": "EXANTE",
+                            "description": f"{a} to {b}"}
+                           for a in CURRENCIES for b in CURRENCIES if a != b]
+        self.crypto = [{"id": f"{c}.EXANTE", "ticker": c, "exchange": "EXANTE", "name": c,
+                        "description": f"{c} coin", "currency": "USD"} for c in CRYPTO]
+        self.prices = {x["id"]: rnd.uniform(1, 500) for x in self.stocks + self.crossrates + self.crypto}
+
+    def price(self, symbol_id):
+        base = self.prices.setdefault(symbol_id, 100.0)
+        return base * (1 + random.uniform(-0.002, 0.002))
+
+    def quote(self, symbol_id):
+        mid = self.price(symbol_id)
+        return {"symbolId": symbol_id, "timestamp": int(time.time() * 1000),
+                "bid": [{"value": f"{mid * 0.9995:.4f}", "size": "100"}],
+                "ask": [{"value": f"{mid * 1.0005:.4f}", "size": "100"}]}
+
+    def ohlc(self, symbol_id, granularity, size):
+        step = granularity * 1000
+        end = int(time.time() * 1000) // step * step
+        bars = []
+        for i in range(size):
+            close = self.price(symbol_id)
+            bars.append({"timestamp": end - i * step, "open": f"{close * 0.999:.4f}",
+                         "high": f"{close * 1.003:.4f}", "low": f"{close * 0.997:.4f}",
+                         "close": f"{close:.4f}", "volume": "1000"})
+        return bars
+
+    @staticmethod
+    def statement(sheet, symbol):
+        rows = []
+        for quarter in range(4):
+            rows.append({"symbol": symbol, "date": f"2026-0{3 * quarter + 1}-01", "debtToEquity": 1.2,
+                         "peRatio": 25.4, "returnOnEquity": 0.31, "epsdiluted": 1.45})
+        return rows
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, universe=None, exante=None, fmp=None, telegram=None,
+                 replay=None, record=None, host="127.0.0.1", port=0, feed_interval=1.0):
+        super().__init__((host, port), StandInHandler)
+        self.universe = universe or Universe()
+        self.upstreams = {"exante": exante or Upstream(), "fmp": fmp or Upstream(), "telegram": telegram or Upstream()}
+        self.replay = {}
+        if replay:
+            with open(replay) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.replay.setdefault(entry["path"], []).append(entry)
+        self.record = open(record, "a") if record else None
+        self.requests = Counter()
+        self.errors = Counter()
+        self.message_id = 1000
+        # streamed feeds send a quote per symbol every feed_interval seconds, or nothing when it is 0
+        self.feed_interval = feed_interval
+        self.streams = []
+        self._streams_generation = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="standins", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._closed = True
+        self.shutdown()
+        if self.record:
+            self.record.close()
+
+    def count(self, key, failed=False):
+        with self._lock:
+            self.requests[key] += 1
+            if failed:
+                self.errors[key] += 1
+
+    def next_message_id(self):
+        with self._lock:
+            self.message_id += 1
+            return self.message_id
+
+    def open_stream(self, symbol_ids):
+        with self._lock:
+            self.streams.append(symbol_ids)
+            return self._streams_generation
+
+    def streaming(self, generation):
+        return not self._closed and generation == self._streams_generation
+
+    def drop_streams(self):
+        # every open feed stream is cut off mid-transfer, as a network failure would
+        with self._lock:
+            self._streams_generation += 1
+
+    def recorded(self, path):
+        # recordings are played back in order, the last one keeps being served
+        with self._lock:
+            entries = self.replay.get(path)
+            if not entries:
+                return None
+            return entries.pop(0) if len(entries) > 1 else entries[0]
+
+    def save(self, path, status, body):
+        if self.record:
+            with self._lock:
+                self.record.write(json.dumps({"path": path, "status": status, "body": body}) + "\n")
+
+    def stats(self):
+        with self._lock:
+            return {"requests": dict(self.requests), "errors": dict(self.errors)}
+
+    def handle_error(self, request, client_address):
+        # bots under test exit without closing their long polls
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def dispatch(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        path = urlsplit(self.path).path
+        if path.startswith(EXANTE_PREFIX):
+            upstream, key, handler = "exante", path[len(EXANTE_PREFIX):].split("/")[1], self.exante
+        elif path.startswith(FMP_PREFIX):
+            upstream, key, handler = "fmp", path[len(FMP_PREFIX):].split("/")[1], self.fmp
+        elif path.startswith(TELEGRAM_PREFIX):
+            upstream, key, handler = "telegram", path.rsplit("/", 1)[-1], self.telegram
+        else:
+            self.reply(404, {"error": "unknown path"})
+            return
+
+        settings = self.server.upstreams[upstream]
+        time.sleep(settings.delay())
+        if settings.fails():
+            self.server.count(f"{upstream}:{key}", failed=True)
+            self.reply(503, {"error": "injected failure"})
+            return
+        self.server.count(f"{upstream}:{key}")
+        if (upstream, key) == ("exante", "feed") and "x-json-stream" in self.headers.get("Accept", "") \
+                and not path.endswith("/last"):
+            self.stream(path)
+            return
+        recorded = self.server.recorded(self.path)
+        if recorded is not None:
+            self.reply(recorded["status"], recorded["body"])
+            return
+        status, payload = handler(path, body)
+        self.server.save(self.path, status, payload)
+        self.reply(status, payload)
+
+    def reply(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def stream(self, path):
+        symbol_ids = [unquote(symbol_id) for symbol_id in path[len(EXANTE_PREFIX):].split("/")[2].split(",")]
+        server = self.server
+        generation = server.open_stream(symbol_ids)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-json-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        # the stream ends without its final chunk, so the client sees a broken transfer
+        self.close_connection = True
+        next_tick = time.monotonic()
+        try:
+            while server.streaming(generation):
+                if server.feed_interval and time.monotonic() >= next_tick:
+                    data = "".join(json.dumps(server.universe.quote(symbol_id)) + "\n"
+                                   for symbol_id in symbol_ids).encode()
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    next_tick += server.feed_interval
+                time.sleep(0.01)
+        except ConnectionError:
+            pass
+
+    def exante(self, path, body):
+        universe = self.server.universe
+        # path segments keep %2F encoded, so ids are split on "/" before decoding
+        parts = path[len(EXANTE_PREFIX):].split("/")[1:]
+        query = parse_qs(urlsplit(self.path).query)
+        if parts[0] == "types":
+            table = {"STOCK": universe.stocks, "CURRENCY": universe.crossrates, "FUND": universe.crypto}
+            return 200, table.get(parts[1], [])
+        if parts[0] == "feed":
+            return 200, [universe.quote(unquote(symbol_id)) for symbol_id in parts[1].split(",")]
+        if parts[0] == "ohlc":
+            size = int(query.get("size", ["60"])[0])
+            return 200, universe.ohlc(unquote(parts[1]), int(parts[2]), size)
+        if parts[0] == "crossrates":
+            return 200, {"pair": f"{parts[1]}/{parts[2]}", "rate": f"{universe.price(parts[1] + parts[2]):.4f}"}
+        return 404, {"error": "unknown endpoint"}
+
+    def fmp(self, path, body):
+        _, sheet, symbol = path[len(FMP_PREFIX):].split("/")[:3]
+        return 200, Universe.statement(sheet, symbol)
+
+    def telegram(self, path, body):
+        method = path.rsplit("/", 1)[-1]
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Bench",
+                                                "username": "benchmark_bot"}}
+        if method == "getMyCommands":
+            return 200, {"ok": True, "result": []}
+        if method == "getUpdates":
+            time.sleep(0.5)
+            return 200, {"ok": True, "result": []}
+        if method in ("sendChatAction", "answerCallbackQuery", "deleteMessage", "setWebhook", "deleteWebhook",
+                      "setMyCommands"):
+            return 200, {"ok": True, "result": True}
+        message = {"message_id": self.server.next_message_id(), "date": int(time.time()),
+                   "chat": {"id": 1, "type": "private"}, "text": ""}
+        if method in ("sendPhoto", "editMessageMedia"):
+            message["photo"] = [{"file_id": f"photo-{message['message_id']}",
+                                 "file_unique_id": f"u{message['message_id']}", "width": 1200, "height": 900}]
+        return 200, {"ok": True, "result": message}
+
+
+class KeyValueServer(ThreadingTCPServer):
+    """Just enough of Redis for backend.RedisBackend: GET, SET, DEL, PEXPIRE, SADD, SMEMBERS and its lease
+    scripts."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, host="127.0.0.1", port=0):
+        super().__init__((host, port), KeyValueHandler)
+        self.latency = latency
+        self.data = {}
+        self.commands = Counter()
+        self.closed = False
+        self._lock = threading.Lock()
+
+    @property
+    def address(self):
+        return self.server_address[:2]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="keyvalue", daemon=True).start()
+        return self
+
+    def stop(self):
+        # open connections are dropped at their next command, as when Redis goes away
+        self.closed = True
+        self.shutdown()
+        self.server_close()
+
+    def lookup(self, key):
+        entry = self.data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return entry
+
+    def execute(self, args):
+        name = args[0].decode().upper()
+        with self._lock:
+            self.commands[name] += 1
+            if name in ("PING", "AUTH", "SELECT"):
+                return "+PONG" if name == "PING" else "+OK"
+            if name == "GET":
+                entry = self.lookup(args[1])
+                return entry[0] if entry is not None else None
+            if name == "SET":
+                key, value, expires, options = args[1], args[2], None, [a.decode().upper() for a in args[3:]]
+                for i, option in enumerate(options):
+                    if option in ("PX", "EX"):
+                        expires = time.monotonic() + int(options[i + 1]) / (1000 if option == "PX" else 1)
+                exists = self.lookup(key) is not None
+                if ("NX" in options and exists) or ("XX" in options and not exists):
+                    return None
+                self.data[key] = (value, expires)
+                return "+OK"
+            if name == "DEL":
+                return sum(self.data.pop(key, None) is not None for key in args[1:])
+            if name == "SADD":
+                entry = self.lookup(args[1])
+                members = entry[0] if entry is not None else set()
+                added = len(set(args[2:]) - members)
+                self.data[args[1]] = (members | set(args[2:]), entry[1] if entry is not None else None)
+                return added
+            if name == "SMEMBERS":
+                entry = self.lookup(args[1])
+                return sorted(entry[0]) if entry is not None else []
+            if name == "PEXPIRE":
+                entry = self.lookup(args[1])
+                if entry is None:
+                    return 0
+                self.data[args[1]] = (entry[0], time.monotonic() + int(args[2]) / 1000)
+                return 1
+            if name == "EVAL":
+                script, key, owner = args[1].decode(), args[3], args[4]
+                entry = self.lookup(key)
+                if entry is None or entry[0] != owner:
+                    return 0
+                if script == RENEW:
+                    self.data[key] = (owner, time.monotonic() + int(args[5]) / 1000)
+                    return 1
+                if script == RELEASE:
+                    del self.data[key]
+                    return 1
+            return Exception(f"ERR unknown command {name}")
+
+    def stats(self):
+        with self._lock:
+            return {"commands": dict(self.commands), "keys": len(self.data)}
+
+
+class KeyValueHandler(StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line or self.server.closed:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                size = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(size + 2)[:-2])
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            self.wfile.write(self.encode(self.server.execute(args)))
+
+    @staticmethod
+    def encode(reply):
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, Exception):
+            return f"-{reply}\r\n".encode()
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, str):
+            return reply.encode() + b"\r\n"
+        if isinstance(reply, list):
+            return b"*%d\r\n" % len(reply) + b"".join(KeyValueHandler.encode(item) for item in reply)
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+
+
+def bench_config(directory, server=None, limits=True, **sections):
+    """Writes the repo's config.ini with a placeholder token, caches under ``directory``
+    and, given a server, every upstream pointed at it."""
+    config = ConfigParser()
+    with open(os.path.join(ROOT, "config.ini")) as f:
+        config.read_file(f)
+    config["Telegram"]["token"] = "123456:benchmark"
+    for key in ("snapshot", "fundamentals", "candles", "alerts", "watchlists", "quota"):
+        if config.has_option("Storage", key):
+            config["Storage"][key] = os.path.join(directory, config["Storage"][key])
+    if config.has_section("Metrics"):
+        config["Metrics"]["port"] = "0"
+    if server is not None:
+        config["Telegram"]["base_url"] = server.url + TELEGRAM_PREFIX
+        config["API"]["url"] = server.url + EXANTE_PREFIX
+        config["API"]["fmp_url"] = server.url + FMP_PREFIX
+    if not limits:
+        config.remove_section("Limits")
+        config.add_section("Limits")
+    for section, values in sections.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        for key, value in values.items():
+            config[section][key] = str(value)
+    path = os.path.join(directory, "config.ini")
+    with open(path, "w") as f:
+        config.write(f)
+    return path
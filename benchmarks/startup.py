@@ -0,0 +1,106 @@
+# -*- coding:utf-8 -*-
+"""
+Startup benchmark: how long ``import bot`` takes and how long a fresh process
+needs from start to its first reply.
+
+    python benchmarks/startup.py --runs 5 --max-import 0.5 --max-first-reply 3
+
+Every run is a new interpreter with its own empty cache directory, so nothing
+is shared between runs. The first reply is the answer to a ticker (AAPL): the
+process launches, downloads the universe and fetches the quote and statements
+it needs from the stand-ins in standins.py, and sends the reply to the stand-in
+Telegram API; no request leaves the machine. Exits with status 1 when a median
+exceeds its limit.
+"""
+
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+from standins import ROOT, StandInServer, bench_config
+
+IMPORT_ONLY = """
+import time, json
+started = time.perf_counter()
+import bot
+print(json.dumps({"import": time.perf_counter() - started}))
+"""
+
+FIRST_REPLY = """
+import sys, time, json
+started = time.perf_counter()
+import bot
+imported = time.perf_counter()
+from telegram import Update
+from telegram.ext import CallbackContext
+
+bot.bootstrap(sys.argv[1])
+booted = time.perf_counter()
+bot.launch()
+while "AAPL" not in bot.storage.stocks:
+    if time.perf_counter() - started > 120:
+        raise TimeoutError("no universe after 120s")
+    time.sleep(0.005)
+ready = time.perf_counter()
+update = Update.de_json({"update_id": 1,
+                         "message": {"message_id": 1, "date": int(time.time()), "text": "AAPL",
+                                     "chat": {"id": 1, "type": "private"},
+                                     "from": {"id": 1, "is_bot": False, "first_name": "Bench"}}}, bot.up.bot)
+promise = bot.process(update, CallbackContext.from_update(update, bot.dispatcher))
+promise.result()
+if promise.exception is not None:
+    raise promise.exception
+replied = time.perf_counter()
+print(json.dumps({"import": imported - started, "bootstrap": booted - imported, "universe": ready - started,
+                  "first_reply": replied - started}), flush=True)
+bot.up.stop()
+bot.renderer.close()
+"""
+
+
+def run(script, *args):
+    output = subprocess.run([sys.executable, "-c", script, *args], cwd=ROOT, check=True,
+                            stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import", type=float, help="limit for the median import time, seconds")
+    parser.add_argument("--max-first-reply", type=float, help="limit for the median time to first reply, seconds")
+    args = parser.parse_args()
+
+    imports = [run(IMPORT_ONLY)["import"] for _ in range(args.runs)]
+    server = StandInServer().start()
+    replies = []
+    try:
+        for _ in range(args.runs):
+            sent = server.stats()["requests"].get("telegram:sendMessage", 0)
+            with tempfile.TemporaryDirectory() as directory:
+                replies.append(run(FIRST_REPLY, bench_config(directory, server)))
+            if server.stats()["requests"].get("telegram:sendMessage", 0) <= sent:
+                raise RuntimeError("the ticker reply never reached the Telegram stand-in")
+    finally:
+        server.stop()
+
+    results = {"import": statistics.median(imports),
+               "bootstrap": statistics.median(r["bootstrap"] for r in replies),
+               "universe": statistics.median(r["universe"] for r in replies),
+               "first_reply": statistics.median(r["first_reply"] for r in replies)}
+    for name, value in results.items():
+        print(f"{name:<12} {value * 1000:8.1f} ms (median of {args.runs})")
+
+    failed = False
+    for name, limit in (("import", args.max_import), ("first_reply", args.max_first_reply)):
+        if limit is not None and results[name] > limit:
+            print(f"{name} regressed: {results[name]:.3f}s > {limit:.3f}s")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,21 +7,35 @@ import re
 import os
 from sys import path
 from decimal import Decimal
-import jwt
-import pandas as pd
-import plotly.graph_objects as go
 import datetime
-from functools import wraps
+import asyncio
+from io import BytesIO
+from html import escape
+from functools import wraps, partial
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
 
 from configparser import ConfigParser
 
 from telegram import ParseMode, ChatAction, Update, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity
-from telegram import InputMediaPhoto
+from telegram import InputMediaPhoto, Message
+from telegram.error import BadRequest
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler
 from telegram.ext.dispatcher import run_async
 
-from mdapi import DataStorage, MDApiConnector
-from fundamental import FundamentalApi
+from mdapi import DataStorage, MDApiConnector, OHLC_DURATIONS, API_URL
+from chartcache import ChartCache
+from candles import CandleStore
+from renderer import ChartRenderer, RenderTimeout
+from fundamental import FundamentalApi, FMP_URL
+from transport import HttpTransport
+from scheduler import RequestScheduler
+from compose import Composer
+from alerts import AlertBook, AlertNotifier, quote_price
+from watchlist import Watchlists
+from cryptolist import CryptoPages, query_id
+from backend import open_backend, LeaderElection
+import metrics
 
 import logging
 
@@ -29,23 +43,118 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
                     level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-config = ConfigParser()
-config.read_file(open('config.ini'))
-
 PORT = int(os.environ.get('PORT', 5000))
-TOKEN = config['Telegram']['token']
+# seconds the chart buttons of a quote reply and the /cryptolist page buttons keep working
+CHART_STATE_TTL = 2 * 24 * 60 * 60
+# instruments quoted in one multi-ticker reply, all fetched with a single feed request
+MAX_DIGEST = 20
+
+# created by bootstrap(), importing this module does no I/O at all
+config = None
+up = None
+dispatcher = None
+transport = None
+scheduler = None
+api = None
+fapi = None
+composer = None
+chart_cache = None
+renderer = None
+storage = None
+alerts = None
+notifier = None
+watchlists = None
+backend = None
+election = None
+# Telegram user ids allowed to use /stats
+admins = set()
+
+
+def bootstrap(config_path="config.ini"):
+    """Builds the bot from its config; disk caches are loaded but nothing touches the network."""
+    global config, up, dispatcher, transport, scheduler, api, fapi, composer, chart_cache, renderer, storage
+    global alerts, notifier, watchlists, admins, backend, election
+    config = ConfigParser()
+    with open(config_path) as f:
+        config.read_file(f)
+
+    renderer = ChartRenderer.from_config(config['Charts'])
+    backend = open_backend(config['Backend'] if config.has_section('Backend') else None)
+    # caches only go through a networked backend, the in-process one would just hold second copies
+    shared = backend if backend.remote else None
+    # with replicas sharing a backend only the elected one refreshes the universe and feed
+    election = LeaderElection(backend, ttl=config.getfloat('Backend', 'lease', fallback=30)) if shared else None
+    up = Updater(token=config['Telegram']['token'], workers=32, use_context=True,
+                 base_url=config.get('Telegram', 'base_url', fallback=None))
+    dispatcher = up.dispatcher
+
+    transport = HttpTransport.from_config(config['HTTP'])
+    scheduler = RequestScheduler(path=config.get('Storage', 'quota', fallback=None)).configure(config['Limits'])
+    scheduler.route("exante", config.get('API', 'url', fallback=API_URL))
+    scheduler.route("fmp", config.get('API', 'fmp_url', fallback=FMP_URL))
+    transport.on_retry = scheduler.retried
+    api = MDApiConnector(
+        client_id=config['API']['client_id'],
+        app_id=config['API']['app_id'],
+        key=config['API']['shared_key'],
+        url=config.get('API', 'url', fallback=API_URL),
+        transport=transport,
+        scheduler=scheduler,
+        candles=CandleStore(max_series=config.getint('Storage', 'candle_series', fallback=512),
+                            max_bars=config.getint('Storage', 'candle_bars', fallback=2000),
+                            path=config.get('Storage', 'candles', fallback=None),
+                            shared=shared)
+    )
+    fapi = FundamentalApi(transport=transport,
+                          scheduler=scheduler,
+                          url=config.get('API', 'fmp_url', fallback=FMP_URL),
+                          max_entries=config.getint('Storage', 'fundamentals_entries', fallback=2048),
+                          path=config.get('Storage', 'fundamentals', fallback=None),
+                          shared=shared)
+    composer = Composer(workers=config.getint('Lookup', 'workers', fallback=64),
+                        deadline=config.getfloat('Lookup', 'deadline', fallback=5))
+    chart_cache = ChartCache(max_bytes=config.getint('Charts', 'cache_bytes', fallback=32 * 1024 * 1024),
+                             shared=shared)
+    storage = DataStorage(api,
+                          stream=config.getboolean('Feed', 'stream', fallback=False),
+                          batch_size=config.getint('Feed', 'batch_size', fallback=5),
+                          workers=config.getint('Feed', 'refresh_workers', fallback=8),
+                          snapshot_path=config.get('Storage', 'snapshot', fallback=None),
+                          shared=shared,
+                          election=election,
+                          sync_interval=config.getfloat('Backend', 'sync_interval', fallback=15),
+                          poll_interval=config.getfloat('Alerts', 'poll', fallback=60))
+    alerts = AlertBook(path=config.get('Storage', 'alerts', fallback=None),
+                       max_per_chat=config.getint('Alerts', 'max_per_chat', fallback=50))
+    notifier = AlertNotifier(lambda chat_id, text: up.bot.send_message(chat_id=chat_id, text=text, parse_mode="html"),
+                             scheduler=scheduler,
+                             window=config.getfloat('Alerts', 'window', fallback=1))
+    storage.listeners.append(check_alerts)
+    storage.polled = alerts.symbols
+    watchlists = Watchlists(path=config.get('Storage', 'watchlists', fallback=None), max_symbols=MAX_DIGEST)
+    admins = {int(x) for x in config.get('Metrics', 'admins', fallback='').split(',') if x.strip()}
 
-up = Updater(token=TOKEN, workers=32, use_context=True)
-dispatcher = up.dispatcher
+    metrics.collector("storage", storage.stats)
+    metrics.collector("chart_cache", chart_cache.stats)
+    metrics.collector("candles", api.candles.stats)
+    metrics.collector("fundamentals", fapi.stats)
+    metrics.collector("renderer", renderer.stats)
+    metrics.collector("scheduler", scheduler.stats)
+    metrics.collector("http", transport.stats)
+    metrics.collector("lookup", composer.stats)
+    metrics.collector("alerts", alerts.stats)
+    metrics.collector("notifier", notifier.stats)
+    metrics.collector("backend", backend.stats)
+    if election is not None:
+        metrics.collector("election", election.stats)
+    metrics.collector("cryptolist", lambda: crypto_pages().stats())
+    metrics.collector("updates", lambda: {"queued": up.update_queue.qsize()})
 
-api = MDApiConnector(
-    client_id=config['API']['client_id'],
-    app_id=config['API']['app_id'],
-    key=config['API']['shared_key']
-)
-fapi = FundamentalApi()
-storage = DataStorage(api)
-storage.start()
+
+def preload():
+    # pandas and plotly are only needed for charts, load them off the startup path
+    import pandas
+    import plotly.graph_objects
 
 
 def send_typing_action(func):
@@ -101,7 +210,13 @@ def start(update, context):
           "<b>— FOR CRYPTOCURRENCIES —</b>\n\t\t\t\t\tEnter a ticker code to retrieve an instrument's " \
           "price and historical data." \
           "\n\n<b><u>/help</u></b> — See this message again.\n" \
-          "<b><u>/cryptolist</u></b> — List of available cryptocurrencies (ticker codes in brackets).\n"
+          "<b><u>/cryptolist</u></b> — List of available cryptocurrencies (ticker codes in brackets), " \
+          "<b><u>/cryptolist bit</u></b> to filter it.\n" \
+          "<b><u>/alert aapl > 190</u></b> — Get a message once the price crosses a level.\n" \
+          "<b><u>/alerts</u></b> — Your alerts. <b><u>/unalert 12</u></b> — Delete alert #12.\n" \
+          "<b><u>/watchlist</u></b> — Quotes for your watchlist, " \
+          "<b><u>/watchlist add aapl eur/usd</u></b> or <b><u>remove</u></b> to change it.\n\n" \
+          "Several tickers in one message (e.g. <b><u>aapl goog eur/usd</u></b>) are answered with one table.\n"
 
     context.bot.send_message(chat_id=update.message.chat_id,
                              text=msg.format(
@@ -111,173 +226,290 @@ def start(update, context):
                              parse_mode="html")
 
 
-@send_typing_action
-@run_async
-def process(update, context):
-    stock, crossrate, crypto, base, counter = None, None, None, None, None
+def get_quote(symbol_id):
+    feed = storage.feed.get(symbol_id)
+    if feed is None:
+        feed = storage.put_quote(api.get_feed(symbol_id)[0])
+    return feed
+
+
+def quote_fields(feed, time_format="%b %d, %H:%M:%S"):
+    bid, ask, timestamp = "N/A", "N/A", "N/A"
+    if feed is None:
+        return bid, ask, timestamp
+    timestamp = datetime.datetime.utcfromtimestamp(feed["timestamp"] / 1000).strftime(time_format)
+    if len(feed.get("bid", [])) != 0:
+        bid = round(Decimal(feed["bid"][0]["value"]), 4)
+    if len(feed.get("ask", [])) != 0:
+        ask = round(Decimal(feed["ask"][0]["value"]), 4)
+    return bid, ask, timestamp
+
+
+def format_digest(instruments, feed, title=None):
+    rows = [("Ticker", "Bid", "Ask", "UTC")]
+    for kind, instrum in instruments:
+        bid, ask, timestamp = quote_fields(feed.get(instrum["path_id"]), time_format="%d.%m %H:%M")
+        rows.append((instrum["ticker"], str(bid), str(ask), timestamp))
+    widths = [max(len(row[i]) for row in rows) for i in range(4)]
+    lines = [" ".join([row[0].ljust(widths[0])] + [row[i].rjust(widths[i]) for i in range(1, 4)]) for row in rows]
+    msg = "<pre>" + escape("\n".join(lines)) + "</pre>"
+    return f"<b>{escape(title)}</b>\n{msg}" if title else msg
+
+
+def format_crossrate(crossrate, rate, feed):
+    counter = crossrate["ticker"].split("/")[1]
+    price = "N/A" if rate is None else round(Decimal(rate), 4)
+    bid, ask, timestamp = quote_fields(feed)
+
+    return f"<b>{crossrate['description']} ({crossrate['ticker']}, {crossrate['exchange']}):</b>\n\n" \
+           f"Current Price:  <b><u>{price} {counter}</u></b>\n" \
+           f"—> [Bid <b>{bid} {counter}</b>]\n" \
+           f"—> [Ask <b>{ask} {counter}</b>]\n" \
+           f"<em>Last updated at {timestamp} UTC</em>\n"
+
+
+def format_stock(stock, data):
+    # returns the reply and whether the FMP quota ran out
+    price, key_metrics, ratios, inc_stmnt = data["ohlc"], data["key-metrics"], data["ratios"], data["income-statement"]
+
+    d2e = "N/A"
+    roe = "N/A"
+    pe_ratio = "N/A"
+    eps = "N/A"
+    # near the quota cached sheets are still served, so some sheets may be lists and others error payloads
+    sheets = (key_metrics, ratios, inc_stmnt)
+    limit_reached = any(isinstance(sheet, dict) for sheet in sheets)
+    key_metrics, ratios, inc_stmnt = (sheet if isinstance(sheet, list) else None for sheet in sheets)
+    if key_metrics:
+        d2e = round(key_metrics[0]["debtToEquity"], 4)
+    if ratios:
+        roe = round(ratios[0]["returnOnEquity"], 4)
+    if inc_stmnt:
+        eps = 0
+        for q in inc_stmnt:
+            eps += q.get('epsdiluted')
+        if Decimal(eps) != 0:
+            if stock["currency"] != "USD":
+                if key_metrics:
+                    pe_ratio = round(Decimal(key_metrics[0]["peRatio"]), 2)
+            elif price is not None:
+                pe_ratio = round(Decimal(price['close']) / Decimal(eps), 2)
+            eps = round(Decimal(eps), 2)
+            eps = f"{eps} {stock['currency']}"
+        else:
+            eps = "N/A"
+
+    share_price = "N/A" if price is None else round(Decimal(price['close']), 4)
+    bid, ask, timestamp = quote_fields(data["feed"])
+
+    msg = f"<b>{stock['ticker']} ({stock['description']}, {stock['exchange']}):</b>\n\n" \
+          f"Earnings per Share (TTM):  <b><u>{eps}</u></b>\n" \
+          f"Price/Earnings (P/E) Ratio:  <b><u>{pe_ratio}</u></b>\n" \
+          f"Debt/Equity (D/E) Ratio:  <b><u>{d2e}</u></b>\n" \
+          f"Return on Equity:  <b><u>{roe}</u></b>\n\n" \
+          f"Share Price:  <b><u>{share_price} {stock['currency']}</u></b>\n" \
+          f"—> [Bid <b>{bid} {stock['currency']}</b>]\n" \
+          f"—> [Ask <b>{ask} {stock['currency']}</b>]\n" \
+          f"<em>Last updated at {timestamp} UTC</em>\n"
+    return msg, limit_reached
+
+
+def format_crypto(crypto, ohlc, feed):
+    price = "N/A" if ohlc is None else round(Decimal(ohlc['close']), 4)
+    bid, ask, timestamp = quote_fields(feed)
 
-    ticker_cr = re.search(r'([\w]{1,4})/([\w]{1,4})', update.message.text)
+    return f"<b>{crypto['description']} ({crypto['ticker']}, {crypto['exchange']}):</b>\n\n" \
+           f"Current Price:  <b><u>{price} {crypto['currency']}</u></b>\n" \
+           f"—> [Buy <b>{bid} {crypto['currency']}</b>]\n" \
+           f"—> [Sell <b>{ask} {crypto['currency']}</b>]\n" \
+           f"<em>Last updated at {timestamp} UTC</em>\n"
+
+
+LIMIT_MSG = "<b>[Financial Modelling Prep API]:</b> Limit reached. Accounting ratios will not be retrieved."
+
+
+def reply_crossrate(message, context, crossrate):
+    logger.debug(f"Lookup {crossrate['ticker']}")
+    base, counter = crossrate["ticker"].split("/")
+    data = composer.run({"crossrate": lambda: api.get_crossrate_price(base, counter),
+                         "feed": lambda: get_quote(crossrate["path_id"])})
+    msg = format_crossrate(crossrate, data["crossrate"], data["feed"])
+    reply = message.reply_text(text=msg, reply_markup=show_tchart_keyboard("cross"), parse_mode="html")
+    remember_chart(reply.chat_id, reply.message_id, crossrate, counter)
+
+
+def reply_stock(message, context, stock):
+    logger.debug(f"Lookup {stock['ticker']}")
+    # none of these depend on each other, so they share one deadline instead of queueing up
+    data = composer.run({"ohlc": lambda: api.get_last_ohlc_bar(stock['path_id']),
+                         "key-metrics": lambda: fapi.request(stock["ticker"], "key-metrics"),
+                         "ratios": lambda: fapi.request(stock["ticker"], "ratios"),
+                         "income-statement": lambda: fapi.request(stock["ticker"], "income-statement"),
+                         "feed": lambda: get_quote(stock["path_id"])})
+    msg, limit_reached = format_stock(stock, data)
+    if limit_reached:
+        message.reply_text(text=LIMIT_MSG, parse_mode="html")
+    reply = message.reply_text(text=msg, reply_markup=show_tchart_keyboard("stock"), parse_mode="html")
+    remember_chart(reply.chat_id, reply.message_id, stock, stock["currency"])
+
+
+def reply_crypto(message, context, crypto):
+    logger.debug(f"Lookup {crypto['ticker']}")
+    data = composer.run({"ohlc": lambda: api.get_last_ohlc_bar(crypto['path_id']),
+                         "feed": lambda: get_quote(crypto["path_id"])})
+    msg = format_crypto(crypto, data["ohlc"], data["feed"])
+    reply = message.reply_text(text=msg, reply_markup=show_tchart_keyboard("crypto"), parse_mode="html")
+    remember_chart(reply.chat_id, reply.message_id, crypto, crypto["currency"])
+
+
+REPLIES = {"cross": reply_crossrate, "stock": reply_stock, "crypto": reply_crypto}
+
+
+def suggestion_keyboard(suggestions):
+    button_list = []
+    for kind, key, instrum in suggestions:
+        label = f"{instrum['ticker']} — {instrum['description']}"
+        button_list.append(InlineKeyboardButton(label[:60], callback_data=f"lookup:{kind}:{key}"))
+    return InlineKeyboardMarkup(build_menu(button_list, n_cols=1))
+
+
+def resolve(text, snapshot):
+    stock, crossrate, crypto = None, None, None
+
+    ticker_cr = re.search(r'([\w]{1,4})/([\w]{1,4})', text)
     if ticker_cr:
         base = ticker_cr.group(1).upper()
         counter = ticker_cr.group(2).upper()
-        crossrate = storage.crossrates.get(base + "/" + counter)
+        crossrate = snapshot.crossrates.get(base + "/" + counter)
 
         if not crossrate:
-            base, counter = counter, base
-            crossrate = storage.crossrates.get(base + "/" + counter)
+            crossrate = snapshot.crossrates.get(counter + "/" + base)
     else:
-        ticker = re.search(r'[\w]{1,9}', update.message.text)
+        ticker = re.search(r'[\w]{1,9}', text)
         if ticker:
             ticker = ticker.group(0).upper()
-            stock = storage.stocks.get(ticker)
-            crypto = storage.crypto.get(ticker)
+            stock = snapshot.stocks.get(ticker)
+            crypto = snapshot.crypto.get(ticker)
+    return crossrate, stock, crypto
 
-    if crossrate:
-        print(crossrate)
-        crossrate["id"] = re.sub(r"/", r"%2F", crossrate["id"])
-        price = round(Decimal(api.get_crossrate_price(base, counter)), 4)
-        if crossrate["id"] in storage.feed:
-            feed = storage.feed[crossrate["id"]]
-        else:
-            feed = api.get_feed(crossrate["id"])[0]
-            feed["symbolId"] = re.sub(r"/", r"%2F", feed["symbolId"])
-            storage.feed[crossrate["id"]] = feed
-        timestamp = pd.to_datetime(feed["timestamp"], unit="ms").strftime("%b %d, %H:%M:%S")
-        bid, ask = "N/A", "N/A"
-        if len(feed["bid"]) != 0:
-            bid = round(Decimal(feed["bid"][0]["value"]), 4)
-        if len(feed["ask"]) != 0:
-            ask = round(Decimal(feed["ask"][0]["value"]), 4)
-
-        msg = f"<b>{crossrate['description']} ({crossrate['ticker']}, {crossrate['exchange']}):</b>\n\n" \
-              f"Current Price:  <b><u>{price} {counter}</u></b>\n" \
-              f"—> [Bid <b>{bid} {counter}</b>]\n" \
-              f"—> [Ask <b>{ask} {counter}</b>]\n" \
-              f"<em>Last updated at {timestamp} UTC</em>\n"
-
-        context.user_data['user_input_cross'] = [crossrate, None]
-        context.user_data['counter_currency'] = counter
-        if context.user_data["user_input_cross"][1] is not None:
-            context.bot.delete_message(chat_id=update.message.chat_id,
-                                       message_id=context.user_data["user_input_cross"][1])
-            context.user_data["user_input_cross"][1] = None
-        update.message.reply_text(text=msg, reply_markup=show_tchart_keyboard("cross"), parse_mode="html")
 
-    if stock:
-        print(stock)
-        stock["id"] = re.sub(r"/", r"%2F", stock["id"])
-        price = api.get_last_ohlc_bar(stock['id'])
-
-        key_metrics = fapi.request(stock["ticker"], "key-metrics")
-        ratios = fapi.request(stock["ticker"], "ratios")
-        inc_stmnt = fapi.request(stock["ticker"], "income-statement")
-
-        d2e = "N/A"
-        roe = "N/A"
-        pe_ratio = "N/A"
-        eps = "N/A"
-        if type(inc_stmnt) == dict:
-            msg = "<b>[Financial Modelling Prep API]:</b> Limit reached. Accounting ratios will not be retrieved."
-            update.message.reply_text(text=msg, parse_mode="html")
-        else:
-            d2e = round(key_metrics[0]["debtToEquity"], 4)
-            roe = round(ratios[0]["returnOnEquity"], 4)
-            eps = 0
-            for q in inc_stmnt:
-                eps += q.get('epsdiluted')
-            if Decimal(eps) != 0:
-                if stock["currency"] != "USD":
-                    pe_ratio = round(Decimal(key_metrics[0]["peRatio"]), 2)
-                else:
-                    pe_ratio = round(Decimal(price['close']) / Decimal(eps), 2)
-                eps = round(Decimal(eps), 2)
-                eps = f"{eps} {stock['currency']}"
-            else:
-                eps = "N/A"
+def split_tickers(text):
+    return [token for token in re.split(r"[\s,;]+", text) if token]
 
-        if stock["id"] in storage.feed:
-            feed = storage.feed[stock["id"]]
-        else:
-            feed = api.get_feed(stock["id"])[0]
-            storage.feed[stock["id"]] = feed
-        timestamp = pd.to_datetime(feed["timestamp"], unit="ms").strftime("%b %d, %H:%M:%S")
-        bid, ask = "N/A", "N/A"
-        if len(feed["bid"]) != 0:
-            bid = round(Decimal(feed["bid"][0]["value"]), 4)
-        if len(feed["ask"]) != 0:
-            ask = round(Decimal(feed["ask"][0]["value"]), 4)
-
-        msg = f"<b>{stock['ticker']} ({stock['description']}, {stock['exchange']}):</b>\n\n" \
-              f"Earnings per Share (TTM):  <b><u>{eps}</u></b>\n" \
-              f"Price/Earnings (P/E) Ratio:  <b><u>{pe_ratio}</u></b>\n" \
-              f"Debt/Equity (D/E) Ratio:  <b><u>{d2e}</u></b>\n" \
-              f"Return on Equity:  <b><u>{roe}</u></b>\n\n" \
-              f"Share Price:  <b><u>{round(Decimal(price['close']), 4)} {stock['currency']}</u></b>\n" \
-              f"—> [Bid <b>{bid} {stock['currency']}</b>]\n" \
-              f"—> [Ask <b>{ask} {stock['currency']}</b>]\n" \
-              f"<em>Last updated at {timestamp} UTC</em>\n"
-
-        context.user_data['user_input_stock'] = [stock, None]
-        context.user_data['counter_currency'] = stock["currency"]
-        if context.user_data["user_input_stock"][1] is not None:
-            context.bot.delete_message(chat_id=update.message.chat_id,
-                                       message_id=context.user_data["user_input_cross"][1])
-            context.user_data["user_input_stock"][1] = None
-        update.message.reply_text(text=msg, reply_markup=show_tchart_keyboard("stock"), parse_mode="html")
 
-    if crypto:
-        print(crypto)
-        price = api.get_last_ohlc_bar(crypto['id'])
-        if crypto["id"] in storage.feed:
-            feed = storage.feed[crypto["id"]]
-        else:
-            feed = api.get_feed(crypto["id"])[0]
-            storage.feed[crypto["id"]] = feed
-        timestamp = pd.to_datetime(feed["timestamp"], unit="ms").strftime("%b %d, %H:%M:%S")
-        bid, ask = "N/A", "N/A"
-        if len(feed["bid"]) != 0:
-            bid = round(Decimal(feed["bid"][0]["value"]), 4)
-        if len(feed["ask"]) != 0:
-            ask = round(Decimal(feed["ask"][0]["value"]), 4)
-
-        msg = f"<b>{crypto['description']} ({crypto['ticker']}, {crypto['exchange']}):</b>\n\n" \
-              f"Current Price:  <b><u>{round(Decimal(price['close']), 4)} {crypto['currency']}</u></b>\n" \
-              f"—> [Buy <b>{bid} {crypto['currency']}</b>]\n" \
-              f"—> [Sell <b>{ask} {crypto['currency']}</b>]\n" \
-              f"<em>Last updated at {timestamp} UTC</em>\n"
-
-        context.user_data['user_input_crypto'] = [crypto, None]
-        context.user_data['counter_currency'] = crypto["currency"]
-        if context.user_data["user_input_crypto"][1] is not None:
-            context.bot.delete_message(chat_id=update.message.chat_id,
-                                       message_id=context.user_data["user_input_cross"][1])
-            context.user_data["user_input_crypto"][1] = None
-        update.message.reply_text(text=msg, reply_markup=show_tchart_keyboard("crypto"), parse_mode="html")
+def resolve_many(text, snapshot):
+    # returns unique (kind, instrument) pairs for every whitespace or comma separated ticker
+    found = {}
+    for token in split_tickers(text):
+        for kind, instrum in zip(("cross", "stock", "crypto"), resolve(token, snapshot)):
+            if instrum is not None:
+                found.setdefault(instrum["path_id"], (kind, instrum))
+    return list(found.values())[:MAX_DIGEST]
 
-    if all(v is None for v in [crossrate, stock, crypto]):
+
+def watchlist_entries(chat_id, snapshot):
+    tables = {"cross": snapshot.crossrates, "stock": snapshot.stocks, "crypto": snapshot.crypto}
+    return [(kind, tables[kind][key]) for kind, key in watchlists.get(chat_id) if key in tables[kind]]
+
+
+def change_watchlist(chat_id, args, snapshot):
+    # returns the reply for /watchlist add|remove|clear, or None when the watchlist should be shown
+    action = args[0].lower() if args else "show"
+    if action == "clear":
+        watchlists.clear(chat_id)
+        return "Your watchlist is empty now."
+    if action not in ("add", "remove"):
+        return None
+    instruments = resolve_many(" ".join(args[1:]), snapshot)
+    if not instruments:
+        return "Usage: <b><u>/watchlist add aapl goog eur/usd</u></b> or <b><u>/watchlist remove goog</u></b>"
+    entries = [(kind, instrum["ticker"]) for kind, instrum in instruments]
+    if action == "add":
+        changed = watchlists.add(chat_id, entries)
+        if not changed:
+            return f"Nothing added, a watchlist holds up to {MAX_DIGEST} instruments."
+        return "Added: " + ", ".join(key for _, key in changed)
+    changed = watchlists.remove(chat_id, entries)
+    return "Removed: " + ", ".join(key for _, key in changed) if changed else "Not on your watchlist."
+
+
+def not_recognised(message, snapshot):
+    suggestions = snapshot.index.search(message.text)
+    if suggestions:
+        msg = "Ticker label not recognised! Did you mean one of these?"
+        message.reply_text(text=msg, reply_markup=suggestion_keyboard(suggestions), parse_mode="html")
+    else:
         msg = "Ticker label not recognised!\n" + \
               "Try asking about something else, like <b><u>GOOG</u></b>, <b><u>AMZN</u></b> or <b><u>AAPL</u></b>."
-        update.message.reply_text(text=msg, parse_mode="html")
+        message.reply_text(text=msg, parse_mode="html")
+
+
+def reply_digest(message, instruments, title=None):
+    symbol_ids = ",".join(instrum["path_id"] for _, instrum in instruments)
+    # one feed request for the whole set; on failure the table falls back to the stored quotes
+    composer.run({"feed": lambda: storage.put_quotes(api.get_feed(symbol_ids))})
+    message.reply_text(text=format_digest(instruments, storage.feed, title), parse_mode="html")
 
 
 @send_typing_action
-def tchart_menu(update, context):
-    load_msg = None
+@run_async
+@metrics.timed("handler_seconds", "handler_errors_total", profile=True, handler="process")
+def process(update, context):
+    snapshot = storage.snapshot
+    instruments = resolve_many(update.message.text, snapshot)
+    # a single ticker may still name both a stock and a crypto, those keep their detailed replies
+    if len(instruments) > 1 and len(split_tickers(update.message.text)) > 1:
+        reply_digest(update.message, instruments)
+        return
+    crossrate, stock, crypto = resolve(update.message.text, snapshot)
+
+    if crossrate:
+        reply_crossrate(update.message, context, crossrate)
+    if stock:
+        reply_stock(update.message, context, stock)
+    if crypto:
+        reply_crypto(update.message, context, crypto)
+
+    if all(v is None for v in [crossrate, stock, crypto]):
+        not_recognised(update.message, snapshot)
+
+
+@send_typing_action
+@run_async
+@metrics.timed("handler_seconds", "handler_errors_total", profile=True, handler="watchlist")
+def watchlist(update, context):
+    snapshot = storage.snapshot
+    msg = change_watchlist(update.message.chat_id, context.args, snapshot)
+    if msg is not None:
+        update.message.reply_text(text=msg, parse_mode="html")
+        return
+    instruments = watchlist_entries(update.message.chat_id, snapshot)
+    if not instruments:
+        update.message.reply_text(text="Your watchlist is empty. Add to it with "
+                                       "<b><u>/watchlist add aapl eur/usd</u></b>", parse_mode="html")
+        return
+    reply_digest(update.message, instruments, title="Watchlist")
+
+
+@run_async
+@metrics.timed("handler_seconds", "handler_errors_total", profile=True, handler="suggestion")
+def lookup_suggestion(update, context):
     query = update.callback_query
-    trange = query.data
-    if query.data in ["cross", "stock", "crypto"]:
-        context.user_data['look_at'] = query.data
-        trange = "1 day"
-    instrum_data = context.user_data[f"user_input_{context.user_data['look_at']}"]
-    instrum = instrum_data[0]
-    counter = context.user_data['counter_currency']
-    if instrum_data[1] is None:
-        load_msg = context.bot.send_message(text="...One moment, please!", chat_id=query.message.chat_id)
-    else:
-        context.bot.edit_message_caption(caption="...One moment, please!", chat_id=query.message.chat_id,
-                                         message_id=query.message.message_id)
+    _, kind, key = query.data.split(":", 2)
+    table = {"cross": storage.crossrates, "stock": storage.stocks, "crypto": storage.crypto}[kind]
+    instrum = table.get(key)
+    if instrum is None:
+        query.answer(text="This instrument is no longer available.")
+        return
+    query.answer()
+    REPLIES[kind](query.message, context, instrum)
+
 
-    df_ohlc = pd.DataFrame.from_records(api.get_ohlc(instrum['id'], trange))
+def build_chart(ohlc, instrum, trange, counter):
+    import pandas as pd
+    import plotly.graph_objects as go
+
+    df_ohlc = pd.DataFrame.from_records(ohlc)
     df_ohlc["timestamp"] = pd.to_datetime(df_ohlc["timestamp"], unit="ms")
     cutoff = df_ohlc["timestamp"][0] - datetime.timedelta(seconds=tchart_timestamp_dict(trange))
     df_ohlc["timestamp"] = df_ohlc["timestamp"].loc[df_ohlc["timestamp"] > cutoff]
@@ -299,46 +531,536 @@ def tchart_menu(update, context):
         height=900,
         font_size=20
     )
-    query.answer()
-    fig.write_image("candlestick.png")
-    if instrum_data[1] is None:
+    return fig
+
+
+def render_chart(instrum, trange, counter):
+    return renderer.render(build_chart(api.get_ohlc(instrum['path_id'], trange), instrum, trange, counter))
+
+
+def settle_chart(key, flight, render, instrum, trange, counter):
+    try:
+        png = render(instrum, trange, counter)
+    except Exception as e:
+        chart_cache.settle(key, flight, error=e)
+        raise
+    return chart_cache.settle(key, flight, png, OHLC_DURATIONS[trange]["secs"])
+
+
+def remember_chart(chat_id, message_id, instrum, counter):
+    # chart state is kept per message in the backend; a networked one serves it to every replica and across restarts
+    backend.set(f"chart-state:{chat_id}:{message_id}", (dict(instrum), counter), ttl=CHART_STATE_TTL)
+
+
+def not_modified(error):
+    # Telegram refuses edits that would leave a message as it is
+    return "not modified" in str(error).lower()
+
+
+def send_chart(query, context, new_chart, photo):
+    if new_chart:
+        return context.bot.send_photo(chat_id=query.message.chat_id, disable_notification=True,
+                                      caption='Choose the time range:', parse_mode="MarkdownV2",
+                                      photo=photo, reply_markup=tchart_keyboard())
+    try:
+        message = context.bot.edit_message_media(media=InputMediaPhoto(photo),
+                                                 parse_mode="MarkdownV2",
+                                                 chat_id=query.message.chat_id, message_id=query.message.message_id)
+    except BadRequest as e:
+        # the message already shows this chart, which is what was asked for
+        if not not_modified(e):
+            raise
+        message = query.message
+    try:
+        context.bot.edit_message_caption(caption="Choose the time range:", chat_id=query.message.chat_id,
+                                         message_id=query.message.message_id, reply_markup=tchart_keyboard())
+    except BadRequest as e:
+        if not not_modified(e):
+            raise
+    return message
+
+
+def chart_request(query, context):
+    # returns (instrument, counter currency, time range, whether a new photo is sent) or None
+    chart_state = backend.get(f"chart-state:{query.message.chat_id}:{query.message.message_id}")
+    if chart_state is None:
+        query.answer(text="This chart has expired, please ask for the instrument again.")
+        return None
+    instrum, counter = chart_state
+    new_chart = query.data in ["cross", "stock", "crypto"]
+    trange = "1 day" if new_chart else query.data
+    return instrum, counter, trange, new_chart
+
+
+def show_loading(query, context, new_chart):
+    if new_chart:
+        return context.bot.send_message(text="...One moment, please!", chat_id=query.message.chat_id)
+    context.bot.edit_message_caption(caption="...One moment, please!", chat_id=query.message.chat_id,
+                                     message_id=query.message.message_id)
+    return None
+
+
+def chart_failed(query, context, load_msg):
+    query.answer(text="The chart could not be drawn, please try again.")
+    if load_msg is not None:
         context.bot.delete_message(chat_id=query.message.chat_id, message_id=load_msg.message_id)
-        context.bot.send_photo(chat_id=query.message.chat_id, disable_notification=True,
-                               caption='Choose the time range:', parse_mode="MarkdownV2",
-                               photo=open("candlestick.png", "rb"), reply_markup=tchart_keyboard())
     else:
-        context.bot.edit_message_media(media=InputMediaPhoto(open("candlestick.png", "rb")),
-                                       parse_mode="MarkdownV2",
-                                       chat_id=query.message.chat_id, message_id=query.message.message_id)
         context.bot.edit_message_caption(caption="Choose the time range:", chat_id=query.message.chat_id,
-                                         message_id=query.message.message_id, reply_markup=tchart_keyboard())
+                                         message_id=query.message.message_id,
+                                         reply_markup=tchart_keyboard())
+
 
-    instrum_data[1] = query.message.message_id
+def deliver_chart(query, context, key, chart, instrum, counter, new_chart, load_msg):
+    query.answer()
+    if load_msg is not None:
+        context.bot.delete_message(chat_id=query.message.chat_id, message_id=load_msg.message_id)
+
+    message = None
+    if chart.file_id is not None:
+        try:
+            message = send_chart(query, context, new_chart, chart.file_id)
+        except BadRequest as e:
+            logger.warning(f"Cached chart file_id rejected, re-uploading: {e}")
+            chart_cache.forget_file_id(key)
+    if message is None:
+        # each callback uploads from its own buffer, nothing touches the disk
+        with BytesIO(chart.png) as photo:
+            photo.name = "candlestick.png"
+            message = send_chart(query, context, new_chart, photo)
+        if isinstance(message, Message) and message.photo:
+            chart_cache.set_file_id(key, message.photo[-1].file_id)
+
+    if new_chart and isinstance(message, Message):
+        remember_chart(query.message.chat_id, message.message_id, instrum, counter)
+
+
+@send_typing_action
+@run_async
+@metrics.timed("handler_seconds", "handler_errors_total", profile=True, handler="chart")
+def tchart_menu(update, context):
+    load_msg = None
+    query = update.callback_query
+    request = chart_request(query, context)
+    if request is None:
+        return
+    instrum, counter, trange, new_chart = request
+
+    key = (instrum['path_id'], trange, counter)
+    chart, flight, leader = chart_cache.claim(key)
+    if chart is None:
+        load_msg = show_loading(query, context, new_chart)
+        try:
+            # presses of the same chart while it renders wait for that one render
+            if leader:
+                chart = settle_chart(key, flight, render_chart, instrum, trange, counter)
+            else:
+                chart = flight.result()
+        except RenderTimeout as e:
+            logger.error(e)
+            chart_failed(query, context, load_msg)
+            return
+    deliver_chart(query, context, key, chart, instrum, counter, new_chart, load_msg)
+
+
+# (crypto table, CryptoPages) of the last universe generation the list was built for
+_crypto_pages = (None, None)
+_crypto_lock = Lock()
+
+
+def crypto_pages():
+    global _crypto_pages
+    crypto = storage.crypto
+    table, pages = _crypto_pages
+    if table is not crypto:
+        with _crypto_lock:
+            table, pages = _crypto_pages
+            if table is not crypto:
+                pages = CryptoPages(crypto)
+                _crypto_pages = (crypto, pages)
+    return pages
+
+
+def crypto_page(number, query=""):
+    # returns the text and pagination keyboard of one /cryptolist page
+    text, number, count = crypto_pages().page(number, query)
+    if text is None:
+        return f"No cryptocurrency matches <b>{escape(query)}</b>." if query else "No cryptocurrencies yet.", None
+    if count == 1:
+        return text, None
+    # callback data is limited to 64 bytes, so the buttons only carry the filter's id
+    key = remember_filter(query) if query.strip() else ""
+    buttons = [InlineKeyboardButton("«", callback_data=f"crypto:{number - 1}:{key}") if number else None,
+               InlineKeyboardButton(f"{number + 1}/{count}", callback_data=f"crypto:{number}:{key}"),
+               InlineKeyboardButton("»", callback_data=f"crypto:{number + 1}:{key}") if number + 1 < count else None]
+    return text, InlineKeyboardMarkup([[b for b in buttons if b is not None]])
+
+
+def remember_filter(query):
+    key = query_id(query)
+    backend.set(f"crypto-filter:{key}", query, ttl=CHART_STATE_TTL)
+    return key
+
+
+def turn_crypto_page(query):
+    _, number, key = query.data.split(":", 2)
+    text = backend.get(f"crypto-filter:{key}") if key else ""
+    if text is None:
+        query.answer(text="This list has expired, please send /cryptolist again.")
+        return
+    text, keyboard = crypto_page(int(number), text)
+    query.answer()
+    try:
+        query.edit_message_text(text=text, reply_markup=keyboard, parse_mode="html")
+    except BadRequest as e:
+        # pressing the current page again leaves the message as it is
+        if not not_modified(e):
+            raise
 
 
 @run_async
 def cryptolist(update, context):
-    msg = ""
-    for x in storage.crypto:
-        msg += f"{storage.crypto[x]['description']} | (<b><u>{x}</u></b>)\n"
+    text, keyboard = crypto_page(0, " ".join(context.args or ()))
+    context.bot.send_message(chat_id=update.message.chat_id, text=text, reply_markup=keyboard, parse_mode="html")
 
-    context.bot.send_message(chat_id=update.message.chat_id,
-                             text=msg.format(
-                                 user_name=update.message.from_user.first_name,
-                                 bot_name=context.bot.name),
-                             parse_mode="html")
 
+@run_async
+def crypto_list_page(update, context):
+    turn_crypto_page(update.callback_query)
+
+
+ALERT_USAGE = "Usage: <b><u>/alert aapl > 190</u></b> or <b><u>/alert eur/usd < 1.05</u></b>"
+
+
+def format_alert(alert, price=None):
+    msg = f"#{alert.id} <b>{escape(alert.ticker)}</b> {escape(alert.op)} {alert.threshold:g}"
+    if price is not None:
+        msg += f" (now {round(Decimal(price), 4)})"
+    return msg
+
+
+def check_alerts(quotes):
+    for fired, price in alerts.check(quotes):
+        notifier.notify(fired.chat_id, "Alert triggered: " + format_alert(fired, price))
+
+
+def alert(update, context):
+    match = re.match(r"^\s*(.+?)\s*([<>])\s*([0-9]+(?:[.,][0-9]+)?)\s*$", " ".join(context.args))
+    if match is None:
+        update.message.reply_text(text=ALERT_USAGE, parse_mode="html")
+        return
+    text, op, threshold = match.group(1), match.group(2), float(match.group(3).replace(",", "."))
+    instrum = next((i for i in resolve(text, storage.snapshot) if i is not None), None)
+    if instrum is None:
+        update.message.reply_text(text=f"Could not find <b>{escape(text)}</b>. " + ALERT_USAGE, parse_mode="html")
+        return
+    feed = storage.feed.get(instrum["path_id"])
+    price = feed and quote_price(feed)
+    try:
+        new = alerts.add(update.message.chat_id, instrum["path_id"], instrum["ticker"], op, threshold, price)
+    except ValueError as e:
+        update.message.reply_text(text=f"The alert was not set: {e}.")
+        return
+    storage.watch([new.symbol_id])
+    msg = "Alert set: " + format_alert(new, price)
+    if price is not None and (price > threshold if op == ">" else price < threshold):
+        msg += ". The price is past it already, the alert fires once it crosses the level again."
+    update.message.reply_text(text=msg, parse_mode="html")
+
+
+def list_alerts(update, context):
+    mine = alerts.for_chat(update.message.chat_id)
+    if not mine:
+        update.message.reply_text(text="You have no alerts. " + ALERT_USAGE, parse_mode="html")
+        return
+    update.message.reply_text(text="\n".join(format_alert(a) for a in mine), parse_mode="html")
+
+
+def unalert(update, context):
+    if len(context.args) != 1 or not context.args[0].lstrip("#").isdigit():
+        update.message.reply_text(text="Usage: <b><u>/unalert 12</u></b>", parse_mode="html")
+        return
+    removed = alerts.remove(update.message.chat_id, int(context.args[0].lstrip("#")))
+    if removed is None:
+        update.message.reply_text(text="There is no such alert.")
+        return
+    update.message.reply_text(text="Deleted: " + format_alert(removed), parse_mode="html")
+
+
+def format_stats():
+    lines = []
+    for (name, labels), h in sorted(metrics.histograms().items()):
+        stats = h.stats()
+        if stats["count"]:
+            label = ",".join(str(v) for _, v in labels)
+            lines.append(f"{name}[{label}] n={stats['count']} mean={stats['mean']} p50={stats['p50']} p99={stats['p99']}")
+    for (name, labels), c in sorted(metrics.counters().items()):
+        lines.append(f"{name}[{','.join(str(v) for _, v in labels)}] {c.value}")
+    lines.extend(f"{name} {value}" for name, value in sorted(metrics.collect().items()))
+    return "\n".join(lines)
+
+
+def show_stats(update, context):
+    if update.effective_user.id not in admins:
+        return
+    text = format_stats()
+    # one message holds 4096 characters, the Prometheus endpoint has the rest
+    update.message.reply_text(text="<pre>" + escape(text[:3900]) + "</pre>", parse_mode="html")
+
+
+# asyncio mode: handlers are coroutines on one event loop, upstream calls go through aiohttp
+# and only the blocking Telegram calls and chart rendering are handed to executors
+loop = None
+aapi = None
+afapi = None
+telegram_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="telegram")
+chart_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="chart")
+
+
+async def telegram(func, *args, **kwargs):
+    return await loop.run_in_executor(telegram_pool, partial(func, *args, **kwargs))
+
+
+async def backend_call(func, *args):
+    # a networked backend blocks, the in-process one is cheap enough to call on the loop
+    if backend.remote:
+        return await loop.run_in_executor(None, partial(func, *args))
+    return func(*args)
+
+
+async def typing(update, context):
+    await telegram(context.bot.send_chat_action, chat_id=update.effective_message.chat_id, action=ChatAction.TYPING)
+
+
+async def get_quote_async(symbol_id):
+    feed = storage.feed.get(symbol_id)
+    if feed is None:
+        feed = storage.put_quote((await aapi.get_feed(symbol_id))[0])
+    return feed
+
+
+async def reply_crossrate_async(message, context, crossrate):
+    base, counter = crossrate["ticker"].split("/")
+    data = await composer.run_async({"crossrate": aapi.get_crossrate_price(base, counter),
+                                     "feed": get_quote_async(crossrate["path_id"])})
+    msg = format_crossrate(crossrate, data["crossrate"], data["feed"])
+    reply = await telegram(message.reply_text, text=msg, reply_markup=show_tchart_keyboard("cross"),
+                           parse_mode="html")
+    await backend_call(remember_chart, reply.chat_id, reply.message_id, crossrate, counter)
+
+
+async def reply_stock_async(message, context, stock):
+    data = await composer.run_async({"ohlc": aapi.get_last_ohlc_bar(stock['path_id']),
+                                     "key-metrics": afapi.request(stock["ticker"], "key-metrics"),
+                                     "ratios": afapi.request(stock["ticker"], "ratios"),
+                                     "income-statement": afapi.request(stock["ticker"], "income-statement"),
+                                     "feed": get_quote_async(stock["path_id"])})
+    msg, limit_reached = format_stock(stock, data)
+    if limit_reached:
+        await telegram(message.reply_text, text=LIMIT_MSG, parse_mode="html")
+    reply = await telegram(message.reply_text, text=msg, reply_markup=show_tchart_keyboard("stock"),
+                           parse_mode="html")
+    await backend_call(remember_chart, reply.chat_id, reply.message_id, stock, stock["currency"])
+
+
+async def reply_crypto_async(message, context, crypto):
+    data = await composer.run_async({"ohlc": aapi.get_last_ohlc_bar(crypto['path_id']),
+                                     "feed": get_quote_async(crypto["path_id"])})
+    msg = format_crypto(crypto, data["ohlc"], data["feed"])
+    reply = await telegram(message.reply_text, text=msg, reply_markup=show_tchart_keyboard("crypto"),
+                           parse_mode="html")
+    await backend_call(remember_chart, reply.chat_id, reply.message_id, crypto, crypto["currency"])
+
+
+ASYNC_REPLIES = {"cross": reply_crossrate_async, "stock": reply_stock_async, "crypto": reply_crypto_async}
+
+
+async def put_quotes_async(symbol_ids):
+    return storage.put_quotes(await aapi.get_feed(symbol_ids))
+
+
+async def reply_digest_async(message, instruments, title=None):
+    symbol_ids = ",".join(instrum["path_id"] for _, instrum in instruments)
+    await composer.run_async({"feed": put_quotes_async(symbol_ids)})
+    await telegram(message.reply_text, text=format_digest(instruments, storage.feed, title), parse_mode="html")
+
+
+@metrics.timed("handler_seconds", "handler_errors_total", handler="process")
+async def process_async(update, context):
+    await typing(update, context)
+    snapshot = storage.snapshot
+    instruments = resolve_many(update.message.text, snapshot)
+    if len(instruments) > 1 and len(split_tickers(update.message.text)) > 1:
+        await reply_digest_async(update.message, instruments)
+        return
+    crossrate, stock, crypto = resolve(update.message.text, snapshot)
+
+    if crossrate:
+        await reply_crossrate_async(update.message, context, crossrate)
+    if stock:
+        await reply_stock_async(update.message, context, stock)
+    if crypto:
+        await reply_crypto_async(update.message, context, crypto)
+
+    if all(v is None for v in [crossrate, stock, crypto]):
+        await telegram(not_recognised, update.message, snapshot)
+
+
+@metrics.timed("handler_seconds", "handler_errors_total", handler="watchlist")
+async def watchlist_async(update, context):
+    await typing(update, context)
+    snapshot = storage.snapshot
+    msg = change_watchlist(update.message.chat_id, context.args, snapshot)
+    if msg is not None:
+        await telegram(update.message.reply_text, text=msg, parse_mode="html")
+        return
+    instruments = watchlist_entries(update.message.chat_id, snapshot)
+    if not instruments:
+        await telegram(update.message.reply_text, text="Your watchlist is empty. Add to it with "
+                                                       "<b><u>/watchlist add aapl eur/usd</u></b>", parse_mode="html")
+        return
+    await reply_digest_async(update.message, instruments, title="Watchlist")
+
+
+@metrics.timed("handler_seconds", "handler_errors_total", handler="suggestion")
+async def lookup_suggestion_async(update, context):
+    query = update.callback_query
+    _, kind, key = query.data.split(":", 2)
+    table = {"cross": storage.crossrates, "stock": storage.stocks, "crypto": storage.crypto}[kind]
+    instrum = table.get(key)
+    if instrum is None:
+        await telegram(query.answer, text="This instrument is no longer available.")
+        return
+    await telegram(query.answer)
+    await ASYNC_REPLIES[kind](query.message, context, instrum)
+
+
+@metrics.timed("handler_seconds", "handler_errors_total", handler="chart")
+async def tchart_menu_async(update, context):
+    await typing(update, context)
+    load_msg = None
+    query = update.callback_query
+    request = await telegram(chart_request, query, context)
+    if request is None:
+        return
+    instrum, counter, trange, new_chart = request
+
+    key = (instrum['path_id'], trange, counter)
+    chart, flight, leader = await backend_call(chart_cache.claim, key)
+    if chart is None:
+        load_msg = await telegram(show_loading, query, context, new_chart)
+        try:
+            if leader:
+                try:
+                    ohlc = await aapi.get_ohlc(instrum['path_id'], trange)
+                except Exception as e:
+                    chart_cache.settle(key, flight, error=e)
+                    raise
+                # building the figure and waiting on the renderer pool must not stall the loop
+                render = lambda *args: renderer.render(build_chart(ohlc, *args))
+                chart = await loop.run_in_executor(chart_pool, settle_chart, key, flight, render,
+                                                   instrum, trange, counter)
+            else:
+                chart = await asyncio.wrap_future(flight)
+        except RenderTimeout as e:
+            logger.error(e)
+            await telegram(chart_failed, query, context, load_msg)
+            return
+    await telegram(deliver_chart, query, context, key, chart, instrum, counter, new_chart, load_msg)
+
+
+async def cryptolist_async(update, context):
+    # a filtered list is remembered in the backend
+    text, keyboard = await backend_call(crypto_page, 0, " ".join(context.args or ()))
+    await telegram(context.bot.send_message, chat_id=update.message.chat_id, text=text, reply_markup=keyboard,
+                   parse_mode="html")
+
+
+async def crypto_list_page_async(update, context):
+    await telegram(turn_crypto_page, update.callback_query)
+
+
+def on_loop(handler):
+    # the dispatcher thread only schedules the coroutine and moves on to the next update
+    @wraps(handler)
+    def schedule(update, context):
+        future = asyncio.run_coroutine_threadsafe(handler(update, context), loop)
+        future.add_done_callback(lambda f: report_failure(handler.__name__, f))
+    return schedule
+
+
+def report_failure(name, future):
+    # exception() raises on a cancelled future, e.g. one dropped when the loop stops
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"{name}: {future.exception()}")
+
+
+def start_asyncio():
+    from aio import AsyncTransport, AsyncMDApiConnector, AsyncFundamentalApi, AsyncRefresher
+
+    global loop, aapi, afapi
+    loop = asyncio.new_event_loop()
+    Thread(target=loop.run_forever, name="asyncio", daemon=True).start()
+    atransport = AsyncTransport.from_config(config['HTTP'])
+    atransport.on_retry = scheduler.retried
+    # handlers on the loop and the refresher use the aiohttp pool, whatever still runs on threads the blocking one
+    metrics.collector("http", atransport.stats)
+    metrics.collector("http_blocking", transport.stats)
+    aapi = AsyncMDApiConnector(api, atransport)
+    afapi = AsyncFundamentalApi(fapi, atransport)
+    refresher = AsyncRefresher(storage, aapi, workers=config.getint('Feed', 'refresh_workers', fallback=8))
+    asyncio.run_coroutine_threadsafe(refresher.run(), loop)
+
+
+def launch():
+    """Starts the background refresh and Telegram polling, returns as soon as both run."""
+    Thread(target=preload, name="preload", daemon=True).start()
+    if config.getint('Metrics', 'port', fallback=0):
+        metrics.serve(config.getint('Metrics', 'port'), config.get('Metrics', 'host', fallback='127.0.0.1'))
+    if config.getfloat('Metrics', 'profile_slow', fallback=0) > 0:
+        metrics.enable_profiler(config.getfloat('Metrics', 'profile_slow'))
+    notifier.start()
+    alerts.autosave()
+    fapi.autosave()
+    api.candles.autosave()
+    scheduler.autosave()
+    storage.watch(alerts.symbols())
+    if election is not None:
+        # decided before the first refresh, so only one replica downloads the universe
+        election.renew()
+        election.start()
+    if config.get('Bot', 'mode', fallback='threaded') == 'asyncio':
+        start_asyncio()
+        handlers = {"process": on_loop(process_async), "tchart_menu": on_loop(tchart_menu_async),
+                    "cryptolist": on_loop(cryptolist_async), "lookup_suggestion": on_loop(lookup_suggestion_async),
+                    "crypto_list_page": on_loop(crypto_list_page_async),
+                    "watchlist": on_loop(watchlist_async)}
+    else:
+        storage.start()
+        handlers = {"process": process, "tchart_menu": tchart_menu,
+                    "cryptolist": cryptolist, "lookup_suggestion": lookup_suggestion,
+                    "crypto_list_page": crypto_list_page, "watchlist": watchlist}
 
-if __name__ == "__main__":
     dispatcher.add_handler(CommandHandler("start", start))
     dispatcher.add_handler(CommandHandler("help", start))
-    dispatcher.add_handler(CommandHandler("cryptolist", cryptolist))
-    dispatcher.add_handler(CallbackQueryHandler(tchart_menu))
-    dispatcher.add_handler(MessageHandler(Filters.text, process))
+    dispatcher.add_handler(CommandHandler("cryptolist", handlers["cryptolist"]))
+    dispatcher.add_handler(CommandHandler("alert", alert))
+    dispatcher.add_handler(CommandHandler("alerts", list_alerts))
+    dispatcher.add_handler(CommandHandler("unalert", unalert))
+    dispatcher.add_handler(CommandHandler("watchlist", handlers["watchlist"]))
+    dispatcher.add_handler(CommandHandler("stats", show_stats))
+    dispatcher.add_handler(CallbackQueryHandler(handlers["lookup_suggestion"], pattern=r"^lookup:"))
+    dispatcher.add_handler(CallbackQueryHandler(handlers["crypto_list_page"], pattern=r"^crypto:"))
+    dispatcher.add_handler(CallbackQueryHandler(handlers["tchart_menu"]))
+    dispatcher.add_handler(MessageHandler(Filters.text, handlers["process"]))
 
     # up.start_webhook(listen="0.0.0.0",
                     #  port=int(PORT),
-                    #  url_path=TOKEN)
-    # up.bot.setWebhook('https://mardatbot.herokuapp.com/' + TOKEN)
+                    #  url_path=config['Telegram']['token'])
+    # up.bot.setWebhook('https://mardatbot.herokuapp.com/' + config['Telegram']['token'])
     up.start_polling()
+
+
+if __name__ == "__main__":
+    bootstrap()
+    launch()
     up.idle()
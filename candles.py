@@ -0,0 +1,265 @@
+# -*- coding:utf-8 -*-
+
+import os
+import time
+import pickle
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Lock, Thread
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ("open", "high", "low", "close")
+# writing the store on every merge would cost more than the requests it saves, a thread writes it every minute
+SAVE_INTERVAL = 60
+# series in the shared backend outlive the local ones, a replica starting up can pick them up
+SHARED_TTL = 24 * 60 * 60
+
+
+class CandleSeries:
+    """Bars of one symbol and granularity, oldest first, one array per field."""
+
+    __slots__ = ("granularity", "timestamps", "columns", "fetched")
+
+    def __init__(self, granularity):
+        self.granularity = granularity
+        self.timestamps = array("q")
+        self.columns = {field: array("d") for field in FIELDS}
+        self.fetched = 0
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def merge(self, bars):
+        # upstream sends the newest bar first; the last stored bar may still have been forming
+        bars = sorted(bars, key=lambda bar: bar["timestamp"])
+        if bars:
+            first = bars[0]["timestamp"]
+            if self.timestamps and first > self.timestamps[-1]:
+                keep = 0 if first - self.timestamps[-1] > self.granularity * 1000 else len(self)
+            else:
+                keep = bisect_left(self.timestamps, first)
+            # anything newer than the overlap is replaced, a gap means the old bars no longer join up
+            del self.timestamps[keep:]
+            for field in FIELDS:
+                del self.columns[field][keep:]
+            self.timestamps.extend(int(bar["timestamp"]) for bar in bars)
+            for field in FIELDS:
+                self.columns[field].extend(float(bar[field]) for bar in bars)
+        self.fetched = time.time()
+
+    def copy(self):
+        series = CandleSeries(self.granularity)
+        series.timestamps = array("q", self.timestamps)
+        series.columns = {field: array("d", column) for field, column in self.columns.items()}
+        series.fetched = self.fetched
+        return series
+
+    def trim(self, max_bars):
+        if len(self) > max_bars:
+            del self.timestamps[:-max_bars]
+            for field in FIELDS:
+                del self.columns[field][:-max_bars]
+
+    def tail_size(self, now, max_age):
+        # how many bars bring the series up to date, the last stored one included
+        if now - self.fetched < max_age:
+            return 0
+        return int((now * 1000 - self.timestamps[-1]) // (self.granularity * 1000)) + 2
+
+    def buckets(self, granularity):
+        # buckets of a coarser granularity fully covered by the series; the first one may have
+        # started before the oldest stored bar and is left out
+        return len({ts // (granularity * 1000) for ts in self.timestamps}) - 1
+
+    def last(self, count):
+        return [dict(timestamp=self.timestamps[i], **{field: self.columns[field][i] for field in FIELDS})
+                for i in range(len(self) - 1, max(len(self) - count, 0) - 1, -1)]
+
+    def aggregate(self, granularity, count):
+        step = granularity * 1000
+        bars = []
+        for i, ts in enumerate(self.timestamps):
+            start = ts - ts % step
+            if bars and bars[-1]["timestamp"] == start:
+                bar = bars[-1]
+                bar["high"] = max(bar["high"], self.columns["high"][i])
+                bar["low"] = min(bar["low"], self.columns["low"][i])
+                bar["close"] = self.columns["close"][i]
+            else:
+                bars.append(dict(timestamp=start, **{field: self.columns[field][i] for field in FIELDS}))
+        return bars[1:][-count:][::-1]
+
+
+class CandleStore:
+    """Per-symbol candle history that only asks upstream for the bars it is missing.
+
+    A chart range is served from the stored bars of its own granularity or
+    aggregated from a finer stored series; otherwise the missing tail is
+    fetched and merged in. Bars are returned newest first, as upstream does.
+    """
+
+    def __init__(self, max_series=512, max_bars=2000, min_bars=400, max_age=60, path=None, shared=None):
+        # (symbol id, granularity) -> CandleSeries, least recently used first
+        self.series = OrderedDict()
+        self.max_series = max_series
+        self.max_bars = max_bars
+        # first fetches pull enough history to derive the next coarser chart range as well
+        self.min_bars = min_bars
+        self.max_age = max_age
+        self.path = path
+        # backend other replicas publish their series to
+        self.shared = shared
+        self.pulled = 0
+        self.served = 0
+        self.derived = 0
+        self.tail_fetches = 0
+        self.full_fetches = 0
+        self.bars_fetched = 0
+        self.dirty = False
+        self._lock = Lock()
+        self._save_lock = Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    self.series.update(pickle.load(f))
+                # the file may come from a run with a larger limit
+                while len(self.series) > max_series:
+                    self.series.popitem(last=False)
+            except Exception as e:
+                logger.error(f"Could not load candle store {path}: {e}")
+
+    def plan(self, symbol_id, granularity, count):
+        # returns (granularity to read from, number of bars to fetch first)
+        now = time.time()
+        best = None
+        with self._lock:
+            # coarsest finer series first, it has the fewest bars to aggregate
+            sources = [granularity] + sorted((g for s, g in self.series
+                                              if s == symbol_id and g < granularity and granularity % g == 0),
+                                             reverse=True)
+            for source in sources:
+                series = self.series.get((symbol_id, source))
+                if series is None or not len(series):
+                    continue
+                covered = len(series) if source == granularity else series.buckets(granularity)
+                if covered < count:
+                    continue
+                size = min(series.tail_size(now, self.max_age), self.max_bars)
+                if size == 0:
+                    self.series.move_to_end((symbol_id, source))
+                    self.served += 1
+                    self.derived += source != granularity
+                    return source, 0
+                # a finer series is only worth it while its tail stays a small request
+                if (best is None or size < best[1]) and (source == granularity or size <= count):
+                    best = (source, size)
+            if best is not None:
+                self.tail_fetches += 1
+                self.derived += best[0] != granularity
+                return best
+            self.full_fetches += 1
+            return granularity, min(max(count, self.min_bars), self.max_bars)
+
+    def merge(self, symbol_id, granularity, bars):
+        key = (symbol_id, granularity)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = CandleSeries(granularity)
+            series.merge(bars)
+            series.trim(self.max_bars)
+            self.series.move_to_end(key)
+            while len(self.series) > self.max_series:
+                self.series.popitem(last=False)
+            self.bars_fetched += len(bars)
+            self.dirty = True
+
+    def pull(self, symbol_id, granularity):
+        # adopts the shared series when another replica fetched it more recently than we did
+        if self.shared is None:
+            return
+        key = (symbol_id, granularity)
+        with self._lock:
+            series = self.series.get(key)
+            if series is not None and time.time() - series.fetched < self.max_age:
+                return
+            fetched = series.fetched if series is not None else 0
+        remote = self.shared.get(f"candles:{symbol_id}:{granularity}")
+        if remote is None or remote.fetched <= fetched:
+            return
+        with self._lock:
+            self.series[key] = remote
+            self.series.move_to_end(key)
+            while len(self.series) > self.max_series:
+                self.series.popitem(last=False)
+            self.pulled += 1
+            self.dirty = True
+
+    def push(self, symbol_id, granularity):
+        if self.shared is None:
+            return
+        with self._lock:
+            series = self.series.get((symbol_id, granularity))
+            # merges change series in place, the backend gets a copy
+            series = series.copy() if series is not None else None
+        if series is not None:
+            self.shared.set(f"candles:{symbol_id}:{granularity}", series, ttl=SHARED_TTL)
+
+    def bars(self, symbol_id, granularity, count, source=None):
+        source = source or granularity
+        with self._lock:
+            series = self.series.get((symbol_id, source))
+            if series is None:
+                return []
+            if source == granularity:
+                return series.last(count)
+            return series.aggregate(granularity, count)
+
+    def get(self, symbol_id, granularity, count, fetch):
+        # fetch(symbol_id, granularity, size) returns the latest ``size`` bars from upstream
+        self.pull(symbol_id, granularity)
+        source, size = self.plan(symbol_id, granularity, count)
+        if size:
+            self.merge(symbol_id, source, fetch(symbol_id, source, size))
+            self.push(symbol_id, source)
+        return self.bars(symbol_id, granularity, count, source)
+
+    def save(self, path=None):
+        path = path or self.path
+        with self._lock:
+            # series keep changing in place; copying their arrays is much cheaper than pickling them
+            series = {key: s.copy() for key, s in self.series.items()}
+            self.dirty = False
+        tmp = path + ".tmp"
+        with self._save_lock:
+            try:
+                with open(tmp, "wb") as f:
+                    pickle.dump(series, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, path)
+            except OSError as e:
+                logger.error(f"Could not save candle store {path}: {e}")
+
+    def autosave(self, interval=SAVE_INTERVAL):
+        # merged bars reach the disk within ``interval`` seconds
+        def run():
+            while True:
+                time.sleep(interval)
+                if self.dirty:
+                    self.save()
+        if self.path:
+            Thread(target=run, name="candles-save", daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            return {"series": len(self.series),
+                    "bars": sum(len(s) for s in self.series.values()),
+                    "served": self.served,
+                    "pulled": self.pulled,
+                    "derived": self.derived,
+                    "tail_fetches": self.tail_fetches,
+                    "full_fetches": self.full_fetches,
+                    "bars_fetched": self.bars_fetched}
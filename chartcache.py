@@ -0,0 +1,153 @@
+# -*- coding:utf-8 -*-
+
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+
+
+class ChartEntry:
+    __slots__ = ("png", "file_id", "expires")
+
+    def __init__(self, png, expires, file_id=None):
+        self.png = png
+        self.expires = expires
+        self.file_id = file_id
+
+
+class ChartCache:
+    """LRU cache of rendered chart PNGs bounded by total image size.
+
+    Keys are ``(symbol_id, time_range, counter_currency)``. Entries remember the
+    Telegram ``file_id`` of the first upload so later hits can skip the upload.
+    With a shared backend, charts rendered by other replicas fill local misses.
+    A miss is rendered once: ``claim`` makes the first caller the renderer and hands
+    everybody else a future that ``settle`` resolves with its entry.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, shared=None):
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.shared_hits = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= now:
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            if self.shared is None:
+                self.misses += 1
+                return None
+        return self.get_shared(key)
+
+    def claim(self, key):
+        # returns (cached entry, in-flight future, whether the caller has to render)
+        entry = self.get(key)
+        if entry is not None:
+            return entry, None, False
+        with self._lock:
+            flight = self._inflight.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return None, flight, False
+            # the previous renderer may have settled since the lookup above
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires > time.monotonic():
+                return entry, None, False
+            flight = self._inflight[key] = Future()
+            return None, flight, True
+
+    def settle(self, key, flight, png=None, ttl=0, error=None):
+        entry = None
+        if error is None:
+            # a chart too large to cache is still handed to the callers waiting for it
+            entry = self.put(key, png, ttl) or ChartEntry(png, 0)
+        with self._lock:
+            del self._inflight[key]
+        if error is not None:
+            flight.set_exception(error)
+            return None
+        flight.set_result(entry)
+        return entry
+
+    def get_shared(self, key):
+        remote = self.shared.get(self.shared_key(key))
+        ttl = remote[2] - time.time() if remote is not None else 0
+        entry = self._store(key, remote[0], ttl, remote[1]) if ttl > 0 else None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.shared_hits += 1
+        return entry
+
+    @staticmethod
+    def shared_key(key):
+        return "chart:" + ":".join(key)
+
+    def share(self, key, entry):
+        if self.shared is not None:
+            ttl = entry.expires - time.monotonic()
+            if ttl > 0:
+                self.shared.set(self.shared_key(key), (entry.png, entry.file_id, time.time() + ttl), ttl=ttl)
+
+    def put(self, key, png, ttl):
+        entry = self._store(key, png, ttl)
+        if entry is not None:
+            self.share(key, entry)
+        return entry
+
+    def _store(self, key, png, ttl, file_id=None):
+        if len(png) > self.max_bytes:
+            return None
+        entry = ChartEntry(png, time.monotonic() + ttl, file_id)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.size += len(png)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return entry
+
+    def set_file_id(self, key, file_id):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.file_id = file_id
+        if entry is not None:
+            self.share(key, entry)
+
+    def forget_file_id(self, key):
+        self.set_file_id(key, None)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= len(entry.png)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries),
+                    "bytes": self.size,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "shared_hits": self.shared_hits,
+                    "coalesced": self.coalesced,
+                    "evictions": self.evictions,
+                    "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0}
@@ -0,0 +1,77 @@
+# -*- coding:utf-8 -*-
+
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import metrics
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Composer:
+    """Runs the independent upstream calls of one lookup in parallel under a shared deadline.
+
+    Sources that fail or miss the deadline come back as ``None`` so the caller
+    can reply with partial data.
+    """
+
+    def __init__(self, workers=64, deadline=5):
+        self.deadline = deadline
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lookup")
+
+    def stats(self):
+        # calls waiting for a free worker
+        return {"queued": self.executor._work_queue.qsize()}
+
+    @staticmethod
+    def _timed(source, func):
+        started = time.perf_counter()
+        try:
+            return func()
+        finally:
+            # late calls are still recorded, they are what the histogram is for
+            metrics.histogram("upstream_latency_seconds", source=source).observe(time.perf_counter() - started)
+
+    def run(self, calls, deadline=None):
+        futures = {source: self.executor.submit(self._timed, source, func) for source, func in calls.items()}
+        done, pending = wait(futures.values(), timeout=deadline or self.deadline)
+        results = {}
+        for source, future in futures.items():
+            if future not in done:
+                logger.warning(f"{source} missed the lookup deadline")
+                results[source] = None
+                continue
+            try:
+                results[source] = future.result()
+            except Exception as e:
+                logger.error(f"{source} failed: {e}")
+                results[source] = None
+        return results
+
+    @staticmethod
+    async def _timed_async(source, coro):
+        started = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            metrics.histogram("upstream_latency_seconds", source=source).observe(time.perf_counter() - started)
+
+    async def run_async(self, calls, deadline=None):
+        # same contract as run(), with coroutines instead of blocking callables
+        tasks = {source: asyncio.ensure_future(self._timed_async(source, coro)) for source, coro in calls.items()}
+        done, pending = await asyncio.wait(tasks.values(), timeout=deadline or self.deadline)
+        results = {}
+        for source, task in tasks.items():
+            if task not in done:
+                logger.warning(f"{source} missed the lookup deadline")
+                results[source] = None
+                continue
+            try:
+                results[source] = task.result()
+            except Exception as e:
+                logger.error(f"{source} failed: {e}")
+                results[source] = None
+        return results
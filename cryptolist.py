@@ -0,0 +1,73 @@
+# -*- coding:utf-8 -*-
+
+from html import escape
+from hashlib import blake2b
+from threading import Lock
+
+from search import normalize
+
+# rows per page, well under Telegram's 4096 characters even with long descriptions
+PAGE_SIZE = 25
+MAX_ROW = 120
+MAX_FILTERS = 256
+
+
+def query_id(query):
+    # a short stable name for a filter, queries that match the same rows share it
+    return blake2b(normalize(query).encode(), digest_size=6).hexdigest()
+
+
+class CryptoPages:
+    """The /cryptolist pages of one crypto universe, rendered once when it is built.
+
+    Filtered listings are paginated on first use and kept per query, so a page
+    is a list lookup for every later request.
+    """
+
+    def __init__(self, crypto, page_size=PAGE_SIZE, max_filters=MAX_FILTERS):
+        self.page_size = page_size
+        self.max_filters = max_filters
+        self.rows = []
+        self.keys = []
+        for ticker, instrum in crypto.items():
+            row = f"{escape(instrum['description'][:MAX_ROW])} | (<b><u>{escape(ticker)}</u></b>)"
+            self.rows.append(row)
+            self.keys.append(normalize(f"{ticker} {instrum.get('name', '')} {instrum['description']}"))
+        self.pages = self.paginate(self.rows)
+        self.filtered = {}
+        self.hits = 0
+        self._lock = Lock()
+
+    def paginate(self, rows):
+        return ["\n".join(rows[i:i + self.page_size]) for i in range(0, len(rows), self.page_size)]
+
+    def matching(self, query):
+        query = normalize(query)
+        if not query:
+            return self.pages
+        with self._lock:
+            pages = self.filtered.get(query)
+            if pages is not None:
+                self.hits += 1
+                return pages
+        pages = self.paginate([row for row, key in zip(self.rows, self.keys) if query in key])
+        with self._lock:
+            self.filtered[query] = pages
+            while len(self.filtered) > self.max_filters:
+                self.filtered.pop(next(iter(self.filtered)))
+        return pages
+
+    def page(self, number, query=""):
+        # returns (text, page number, page count), the number is clamped to the pages there are
+        pages = self.matching(query)
+        if not pages:
+            return None, 0, 0
+        number = min(max(number, 0), len(pages) - 1)
+        return pages[number], number, len(pages)
+
+    def stats(self):
+        with self._lock:
+            return {"instruments": len(self.rows),
+                    "pages": len(self.pages),
+                    "filters": len(self.filtered),
+                    "filter_hits": self.hits}
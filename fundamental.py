@@ -1,31 +1,180 @@
 # -*- coding:utf-8 -*-
 
-from datetime import datetime
-import requests
+import os
+import time
+import pickle
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock, Thread
+
+from transport import default_transport
+from scheduler import default_scheduler, QuotaExceeded
+import metrics
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# statements only change quarterly, a day old copy is good enough
+CACHE_TTL = 24 * 60 * 60
+# "Limit reached" and other error payloads are retried sooner
+ERROR_TTL = 5 * 60
+FMP_URL = "https://financialmodelingprep.com/api/v3"
+PARAMS = {"period": "quarter",
+          "apikey": "xyz"}
+# same shape as the payload FMP itself sends once the quota is gone
+LIMIT_REACHED = {"Error Message": "Limit Reach. Please upgrade your plan or visit our documentation"}
+# the cache is written in the background at most this often, never on a request
+SAVE_INTERVAL = 60
 
 
 class FundamentalApi:
-    def __init__(self):
-        self.cache = {}
+    def __init__(self, transport=None, max_entries=2048, path=None, scheduler=None, url=FMP_URL, shared=None):
+        self.base_url = url
+        # (symbol, sheet) -> (data, fetched at, ttl), oldest first
+        self.cache = OrderedDict()
+        self.transport = transport or default_transport
+        self.scheduler = scheduler or default_scheduler
+        self.max_entries = max_entries
+        self.path = path
+        # backend holding the sheets every replica fetched, so each one is only paid for once
+        self.shared = shared
+        self.shared_hits = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.dirty = False
+        self._inflight = {}
+        self._lock = Lock()
+        self._save_lock = Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    self.cache.update(pickle.load(f))
+                # the file may come from a run with a larger limit
+                while len(self.cache) > max_entries:
+                    self.cache.popitem(last=False)
+            except Exception as e:
+                logger.error(f"Could not load fundamentals cache {path}: {e}")
+
+    def claim(self, key):
+        # returns (hit, cached data or in-flight future, whether the caller has to fetch)
+        with self._lock:
+            entry = self.cache.get(key)
+            # close to the daily quota any cached copy is better than a new request
+            if entry and (time.time() - entry[1] < entry[2] or self.scheduler.quota_low("fmp")):
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return True, entry[0], False
+            # only one worker fetches a missing sheet, the others wait for its result
+            flight = self._inflight.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return False, flight, False
+            flight = self._inflight[key] = Future()
+            self.misses += 1
+            return False, flight, True
+
+    def settle(self, key, flight, data=None, error=None):
+        with self._lock:
+            if error is None:
+                self.cache[key] = (data, time.time(), CACHE_TTL if type(data) == list else ERROR_TTL)
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.max_entries:
+                    self.cache.popitem(last=False)
+                self.dirty = True
+            del self._inflight[key]
+        if error is not None:
+            flight.set_exception(error)
+            return
+        flight.set_result(data)
 
+    @metrics.timed("fundamentals_request_seconds")
     def request(self, symbol, sheet):
-        now = datetime.now()
+        key = (symbol, sheet)
+        hit, value, leader = self.claim(key)
+        if hit:
+            return value
+        if not leader:
+            return value.result()
+        try:
+            data = self.shared_sheet(symbol, sheet)
+            if data is None:
+                data = self.fetch(symbol, sheet)
+                self.share(symbol, sheet, data)
+        except Exception as e:
+            self.settle(key, value, error=e)
+            raise
+        self.settle(key, value, data)
+        return data
 
-        result = self.cache.get(symbol)
-        if result:
-            result = result.get(sheet)
-            if result and (now - result[1]).days < 1:
-                return result[0]
+    def shared_sheet(self, symbol, sheet):
+        if self.shared is None:
+            return None
+        data = self.shared.get(f"fmp:{symbol}:{sheet}")
+        if data is not None:
+            with self._lock:
+                self.shared_hits += 1
+        return data
 
-        params = {"period": "quarter",
-                  "apikey": "xyz"}
+    def share(self, symbol, sheet, data):
+        # error payloads stay local, another replica may still have quota left
+        if self.shared is not None and type(data) == list:
+            self.shared.set(f"fmp:{symbol}:{sheet}", data, ttl=CACHE_TTL)
 
-        url = f"https://financialmodelingprep.com/api/v3/{sheet}/{symbol}"
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        data = response.json()
+    def url(self, symbol, sheet):
+        return f"{self.base_url}/{sheet}/{symbol}"
+
+    @staticmethod
+    def parse(data):
         if data and type(data) == list:
-            data = response.json()[0:4]
-        self.cache[symbol] = {sheet: (data, now)}
+            data = data[0:4]
+        return data
+
+    def fetch(self, symbol, sheet):
+        if self.scheduler.quota_low("fmp"):
+            return LIMIT_REACHED
+        try:
+            self.scheduler.acquire("fmp", sheet)
+        except QuotaExceeded:
+            return LIMIT_REACHED
+
+        with metrics.timer("upstream_request_seconds", "upstream_errors_total", upstream="fmp", endpoint=sheet):
+            response = self.transport.get(self.url(symbol, sheet), params=PARAMS)
+            response.raise_for_status()
+            data = response.json()
+        return self.parse(data)
+
+    def save(self, path=None):
+        path = path or self.path
+        with self._lock:
+            entries = dict(self.cache)
+            self.dirty = False
+        tmp = path + ".tmp"
+        with self._save_lock:
+            try:
+                with open(tmp, "wb") as f:
+                    pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, path)
+            except OSError as e:
+                logger.error(f"Could not save fundamentals cache {path}: {e}")
+
+    def autosave(self, interval=SAVE_INTERVAL):
+        # new sheets reach the disk within ``interval`` seconds
+        def run():
+            while True:
+                time.sleep(interval)
+                if self.dirty:
+                    self.save()
+        if self.path:
+            Thread(target=run, name="fundamentals-save", daemon=True).start()
 
-        return self.cache[symbol][sheet][0]
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {"entries": len(self.cache),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "coalesced": self.coalesced,
+                    "shared_hits": self.shared_hits,
+                    "hit_rate": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0}
@@ -1,12 +1,21 @@
 # -*- coding:utf-8 -*-
 
+import os
+import json
 import time
-from threading import Thread
+import pickle
+import socket
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import namedtuple
+from threading import Thread, Event, Lock
+from types import MappingProxyType
 from datetime import datetime
+from uuid import uuid4
 
-import jwt
-import requests
-import re
+from transport import default_transport
+from scheduler import default_scheduler, background
+from search import SearchIndex
+import metrics
 
 import logging
 
@@ -18,7 +27,53 @@ logger = logging.getLogger(__name__)
 
 # token expiration time in seconds
 EXPIRATION = 3600
+# seconds between full refreshes of the universe and the feed
+REFRESH_INTERVAL = 15 * 60
+# symbol ids the replicas advertise to the leader are kept this long after the last addition
+SHARED_IDS_TTL = 24 * 60 * 60
+UNIVERSE = ("stocks", "crossrates", "crypto")
 API_URL = "https://api-demo.exante.eu/md/2.0"
+# candle size (secs) and number of candles requested for each chart time range
+OHLC_DURATIONS = {"30 mins.": {"secs": 60, "cand": 30},
+                  "1 hour": {"secs": 60, "cand": 60},
+                  "6 hours": {"secs": 600, "cand": 36},
+                  "1 day": {"secs": 3600, "cand": 24},
+                  "1 week": {"secs": 21600, "cand": 28},
+                  "30 days": {"secs": 86400, "cand": 30},
+                  "3 months": {"secs": 86400, "cand": 90},
+                  "6 months": {"secs": 86400, "cand": 180},
+                  }
+
+
+def path_id(symbol_id):
+    # symbol ids such as EUR/USD.EXANTE are used as URL path segments and feed keys
+    return symbol_id.replace("/", "%2F")
+
+
+def freeze(value):
+    # snapshots are read by every thread at once, nothing in them may change in place
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    # plain containers again, for pickling
+    if isinstance(value, MappingProxyType):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+
+class Snapshot(namedtuple("Snapshot", ["generation", "stocks", "crossrates", "crypto", "feed", "index"])):
+    __slots__ = ()
+
+    @classmethod
+    def empty(cls):
+        return cls(0, *(MappingProxyType({}) for _ in range(4)), SearchIndex())
 
 
 class MDApiConnector:
@@ -26,10 +81,15 @@ class MDApiConnector:
     algo = "HS256"
     __headers = {'accept': 'application/x-json-stream'}
 
-    def __init__(self, client_id, app_id, key):
+    def __init__(self, client_id, app_id, key, transport=None, scheduler=None, candles=None, url=API_URL):
+        self.url = url
         self.client_id = client_id
         self.app_id = app_id
         self.key = key
+        self.transport = transport or default_transport
+        self.scheduler = scheduler or default_scheduler
+        # optional CandleStore, chart ranges are then served from stored bars
+        self.candles = candles
 
     def __get_token(self):
         now = datetime.now()
@@ -47,41 +107,85 @@ class MDApiConnector:
             "exp": int(now.timestamp()) + EXPIRATION
         }
 
+        import jwt
+
         new_token = str(jwt.encode(claims, self.key, self.algo), 'utf-8')
         self.token = (new_token, now)
 
         return new_token
 
+    def auth_headers(self):
+        return {"Authorization": f"Bearer {self.__get_token()}"}
+
     def __request(self, endpoint, params=None):
-        token = self.__get_token()
-        result = requests.get(API_URL + endpoint,
-                              headers={"Authorization": f"Bearer {token}"},
-                              params=params)
-        result.raise_for_status()
-        return result.json()
+        # "/ohlc/AAPL.NASDAQ/60" is throttled as the "ohlc" endpoint
+        name = endpoint.split("/")[1]
+        self.scheduler.acquire("exante", name)
+        with metrics.timer("upstream_request_seconds", "upstream_errors_total", upstream="exante", endpoint=name):
+            result = self.transport.get(self.url + endpoint,
+                                        headers=self.auth_headers(),
+                                        params=params)
+            result.raise_for_status()
+            return result.json()
 
-    def get_stocks(self):
-        stocks = self.__request("/types/STOCK")
-        return {x['ticker']: {"id": x["id"], "exchange": x["exchange"], "currency": x["currency"],
-                              "description": x["description"], "country": x["country"], "ticker": x['ticker']}
+    def stream_feed(self, symbol_ids, read_timeout=60, opened=None):
+        # opened is called with the response before reading, so another thread can interrupt it
+        self.scheduler.acquire("exante", "feed")
+        response = self.transport.get(self.url + f"/feed/{','.join(symbol_ids)}",
+                                      headers={**self.auth_headers(), **self.__headers},
+                                      stream=True, timeout=(self.transport.timeout[0], read_timeout))
+        try:
+            if opened is not None:
+                opened(response)
+            response.raise_for_status()
+            # the feed is sent chunked, the quotes of one chunk are yielded together
+            pending = b""
+            for chunk in response.iter_content(chunk_size=None):
+                lines = (pending + chunk).split(b"\n")
+                pending = lines.pop()
+                messages = [json.loads(line) for line in lines if line.strip()]
+                if messages:
+                    yield messages
+        finally:
+            response.close()
+
+    @staticmethod
+    def parse_stocks(stocks):
+        return {x['ticker']: {"id": x["id"], "path_id": path_id(x["id"]), "exchange": x["exchange"],
+                              "currency": x["currency"], "description": x["description"], "country": x["country"],
+                              "ticker": x['ticker']}
                 for ind, x in enumerate(stocks)}
 
-    def get_crossrates(self):
-        crossrates = self.__request("/types/CURRENCY")
-        return {x['ticker']: {"id": x["id"], "ticker": x['ticker'], "exchange": x["exchange"],
-                              "description": x["description"]}
+    @staticmethod
+    def parse_crossrates(crossrates):
+        return {x['ticker']: {"id": x["id"], "path_id": path_id(x["id"]), "ticker": x['ticker'],
+                              "exchange": x["exchange"], "description": x["description"]}
                 for x in crossrates}
 
+    @staticmethod
+    def parse_crypto(crypto):
+        # listed by description, which is the order /cryptolist shows them in
+        return {x['ticker']: {"id": x["id"], "path_id": path_id(x["id"]), "ticker": x['ticker'],
+                              "exchange": x["exchange"], "name": x["name"],
+                              "description": x["description"], "currency": x["currency"]}
+                for x in sorted(crypto, key=lambda x: x['description'])}
+
+    @staticmethod
+    def ohlc_window(duration):
+        return int(OHLC_DURATIONS[duration]['secs']), int(OHLC_DURATIONS[duration]['cand'])
+
+    @staticmethod
+    def ohlc_request(symbol_id, granularity, size):
+        return f"/ohlc/{symbol_id}/{granularity}", {"size": size}
+
+    def get_stocks(self):
+        return self.parse_stocks(self.__request("/types/STOCK"))
+
+    def get_crossrates(self):
+        return self.parse_crossrates(self.__request("/types/CURRENCY"))
+
     def get_crypto(self):
-        crypto = self.__request("/types/FUND")
-        crypto = {x['description']: {"id": x["id"], "ticker": x['ticker'], "exchange": x["exchange"], "name": x["name"],
-                                     "description": x["description"], "currency": x["currency"]}
-                  for x in crypto}
-        crypto = dict(sorted(crypto.items()))
-        return {crypto[x]['ticker']: {"id": crypto[x]["id"], "ticker": crypto[x]['ticker'],
-                                      "exchange": crypto[x]["exchange"], "name": crypto[x]["name"],
-                                      "description": crypto[x]["description"], "currency": crypto[x]["currency"]}
-                for x in crypto}
+        return self.parse_crypto(self.__request("/types/FUND"))
 
     def get_crossrate_price(self, id1, id2):
         crossrate = self.__request(f"/crossrates/{id1}/{id2}")
@@ -91,64 +195,460 @@ class MDApiConnector:
         ohlc = self.__request(f"/ohlc/{symbol_id}/86400", {"size": 1})
         return ohlc[0]
 
+    def get_bars(self, symbol_id, granularity, size):
+        return self.__request(*self.ohlc_request(symbol_id, granularity, size))
+
     def get_ohlc(self, symbol_id, duration):
-        duration_dict = {"30 mins.": {"secs": 60, "cand": 30},
-                         "1 hour": {"secs": 60, "cand": 60},
-                         "6 hours": {"secs": 600, "cand": 36},
-                         "1 day": {"secs": 3600, "cand": 24},
-                         "1 week": {"secs": 21600, "cand": 28},
-                         "30 days": {"secs": 86400, "cand": 30},
-                         "3 months": {"secs": 86400, "cand": 90},
-                         "6 months": {"secs": 86400, "cand": 180},
-                         }
-        ohlc = self.__request(f"/ohlc/{symbol_id}/{int(duration_dict[duration]['secs'])}",
-                              {"size": int(duration_dict[duration]['cand'])})
-        return ohlc
+        granularity, size = self.ohlc_window(duration)
+        if self.candles is None:
+            return self.get_bars(symbol_id, granularity, size)
+        return self.candles.get(symbol_id, granularity, size, self.get_bars)
 
     def get_feed(self, symbol_id):
         feed = self.__request(f"/feed/{symbol_id}/last")
         return feed
 
 
+def interrupt(response):
+    # close() does not wake a thread blocked reading the socket, shutting it down does
+    sock = getattr(getattr(response.raw, "_connection", None), "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class FeedStream(Thread):
+    def __init__(self, connector, storage, read_timeout=60, max_backoff=60):
+        super().__init__(daemon=True)
+        self.connector = connector
+        self.storage = storage
+        self.read_timeout = read_timeout
+        self.max_backoff = max_backoff
+        self.symbols = set()
+        self.connected = False
+        self.reconnects = 0
+        self._response = None
+        self._lock = Lock()
+        self._changed = Event()
+        self._stopped = Event()
+
+    def watch(self, symbol_ids):
+        with self._lock:
+            new = set(symbol_ids) - self.symbols
+            self.symbols |= new
+        if new:
+            # the running subscription is dropped and reopened with the new symbol set,
+            # even if the stream is idle and no message would come to notice it
+            self._resubscribe()
+
+    def stop(self):
+        self._stopped.set()
+        self._resubscribe()
+
+    def _resubscribe(self):
+        with self._lock:
+            self._changed.set()
+            if self._response is not None:
+                interrupt(self._response)
+
+    def _opened(self, response):
+        with self._lock:
+            self._response = response
+            if self._changed.is_set():
+                interrupt(response)
+
+    def run(self):
+        with background():
+            self._run()
+
+    def _run(self):
+        backoff = 1
+        while not self._stopped.is_set():
+            self._changed.clear()
+            with self._lock:
+                symbols = sorted(self.symbols)
+            if not symbols:
+                self._changed.wait()
+                continue
+            try:
+                for messages in self.connector.stream_feed(symbols, self.read_timeout, opened=self._opened):
+                    self.connected = True
+                    backoff = 1
+                    if self._changed.is_set():
+                        break
+                    # one new snapshot per chunk instead of one per tick
+                    quotes = [message for message in messages if "symbolId" in message]
+                    if quotes:
+                        self.storage.apply_quotes(quotes)
+            except Exception as e:
+                # an interrupted read is how a resubscription ends the old stream
+                if not self._changed.is_set():
+                    logger.error(f"Feed stream dropped: {e}")
+                    metrics.counter("feed_stream_errors_total").inc()
+                    self._changed.wait(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+            with self._lock:
+                self._response = None
+            self.connected = False
+            self.reconnects += 1
+
+
 class DataStorage(Thread):
-    def __init__(self, connector):
-        super().__init__()
+    def __init__(self, connector, stream=False, batch_size=5, workers=8, snapshot_path=None,
+                 shared=None, election=None, sync_interval=15, poll_interval=0):
+        super().__init__(daemon=True)
         self.connector = connector
-        self.stocks = {}
-        self.crossrates = {}
-        self.crypto = {}
-        self.feed = {}
+        self.stream = FeedStream(connector, self) if stream else None
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="refresh")
+        self.timings = {}
+        # readers always go through one immutable snapshot, writers publish a new one
+        self.snapshot = Snapshot.empty()
+        self._publish_lock = Lock()
         self.skip = True
+        self.snapshot_path = snapshot_path
+        # the leader's snapshot is shared through the backend, followers load it instead of refreshing
+        self.shared = shared
+        self.election = election
+        self.sync_interval = sync_interval
+        self.synced = None
+        # changes with every new universe, followers only rebuild their index when it does
+        self.universe_id = None
+        # the universe last written to the backend; quote updates only rewrite the feed
+        self._shared_universe = None
+        # ids already advertised to the leader, the other replicas' ids the leader adopted
+        self._advertised = {"watched": set(), "polled": set()}
+        self._advertise_due = 0
+        self.remote_polled = set()
+        self.wakeup = Event()
+        if election is not None:
+            election.listeners.append(lambda leader: self.wakeup.set())
+        # called with the merged quotes of every published feed update
+        self.listeners = []
+        # symbols kept in the feed even if nobody asked for them lately
+        self.watched = set()
+        # without a stream, the symbols this returns (e.g. those with alerts) are polled
+        # every poll_interval seconds between full refreshes
+        self.polled = None
+        self.poll_interval = poll_interval
+        self._next_refresh = 0
         self.cheat_feed = ["GOOG.NASDAQ", "AAPL.NASDAQ", "TSLA.NASDAQ", "AMZN.NASDAQ", "NFLX.NASDAQ",
                            "EUR%2FUSD.EXANTE", "EUR%2FRUB.EXANTE", "USD%2FRUB.EXANTE", "GBP%2FUSD.EXANTE",
                            "EUR%2FGBP.EXANTE"]
-        print("Loading...")
-        for i in range(0, 2):
-            feed = self.connector.get_feed(",".join(self.cheat_feed[i * 5:i * 5 + 5]))
-            for quote in feed:
-                quote["symbolId"] = re.sub("/", "%2F", quote["symbolId"])
-                self.feed[quote["symbolId"]] = quote
-        print("Ready.")
+        # serve the last good snapshot straight away, the first refresh happens in the background
+        if snapshot_path and os.path.exists(snapshot_path):
+            try:
+                self.load_snapshot(snapshot_path)
+                logger.info("Ready (from snapshot).")
+            except Exception as e:
+                logger.error(f"Could not load snapshot {snapshot_path}: {e}")
+
+    def save_snapshot(self, path=None):
+        path = path or self.snapshot_path
+        snapshot = self.snapshot
+        data = {name: thaw(getattr(snapshot, name)) for name in ("stocks", "crossrates", "crypto", "feed")}
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # never leave a half-written snapshot behind
+        os.replace(tmp, path)
+
+    def load_snapshot(self, path=None):
+        with open(path or self.snapshot_path, "rb") as f:
+            data = pickle.load(f)
+        return self.publish(**data)
+
+    def share(self):
+        snapshot = self.snapshot
+        universe_id = self.universe_id
+        # the universe is large and rarely changes, it is written before the feed that refers to it
+        if universe_id != self._shared_universe:
+            universe = {name: thaw(getattr(snapshot, name)) for name in UNIVERSE}
+            self.shared.set("snapshot:universe", (universe_id, universe))
+            self._shared_universe = universe_id
+        # followers poll the small version key and only fetch the snapshot when it changed
+        version = uuid4().hex
+        self.shared.set("snapshot", (version, {"feed": thaw(snapshot.feed), "universe_id": universe_id}))
+        self.shared.set("snapshot:version", version)
+        self.synced = version
+
+    def sync(self):
+        # returns True when a newer shared snapshot was loaded
+        version = self.shared.get("snapshot:version")
+        if version is None or version == self.synced:
+            return False
+        entry = self.shared.get("snapshot")
+        if entry is None:
+            return False
+        version, data = entry
+        universe_id = data["universe_id"]
+        changes = {}
+        if universe_id is not None and universe_id != self.universe_id:
+            universe = self.shared.get("snapshot:universe")
+            if universe is not None and universe[0] == universe_id:
+                changes = universe[1]
+            else:
+                # a newer universe is being written, the next feed update picks it up
+                universe_id = None
+        # quotes this replica streamed or fetched itself stay when they are newer than the leader's;
+        # alerts live on the replica they were set on, publishing checks them against the merged quotes
+        feed = self.snapshot.feed
+        quotes = [quote for symbol_id, quote in data["feed"].items()
+                  if symbol_id not in feed or feed[symbol_id].get("timestamp", 0) < quote.get("timestamp", 0)]
+        self.publish(quotes=quotes, **changes)
+        if universe_id is not None:
+            self.universe_id = universe_id
+        self.synced = version
+        return True
+
+    def advertise(self):
+        # every replica lists the symbols its users watch, the leader refreshes all of them
+        refresh = time.monotonic() >= self._advertise_due
+        current = {"watched": set(self.watched), "polled": set(self.polled()) if self.polled is not None else set()}
+        for key, symbol_ids in current.items():
+            new = symbol_ids if refresh else symbol_ids - self._advertised[key]
+            if new:
+                self.shared.add_members(key, new, ttl=SHARED_IDS_TTL)
+                self._advertised[key] |= new
+        if refresh:
+            self._advertise_due = time.monotonic() + SHARED_IDS_TTL / 4
+
+    def adopt(self):
+        # the leader takes over what the other replicas advertised
+        remote = self.shared.members("watched") - self.watched
+        if remote:
+            self.watch(remote)
+        self.remote_polled = self.shared.members("polled")
+
+    def exchange_ids(self):
+        if self.shared is None:
+            return
+        self.advertise()
+        if not self.following():
+            self.adopt()
+
+    def following(self):
+        return self.election is not None and not self.election.leader
+
+    def stats(self):
+        snapshot = self.snapshot
+        return {"generation": snapshot.generation,
+                "stocks": len(snapshot.stocks),
+                "crossrates": len(snapshot.crossrates),
+                "crypto": len(snapshot.crypto),
+                "feed": len(snapshot.feed),
+                "watched": len(self.watched),
+                "stream_connected": int(self.stream is not None and self.stream.connected),
+                "last_refresh_seconds": self.timings.get("total", 0)}
+
+    @property
+    def stocks(self):
+        return self.snapshot.stocks
+
+    @property
+    def crossrates(self):
+        return self.snapshot.crossrates
+
+    @property
+    def crypto(self):
+        return self.snapshot.crypto
+
+    @property
+    def feed(self):
+        return self.snapshot.feed
+
+    def publish(self, quotes=(), **changes):
+        changes = {k: freeze(v) for k, v in changes.items()}
+        if changes.keys() & set(UNIVERSE):
+            self.universe_id = uuid4().hex
+            # the search index belongs to the generation it was built from
+            current = self.snapshot
+            changes["index"] = SearchIndex(changes.get("stocks", current.stocks),
+                                           changes.get("crossrates", current.crossrates),
+                                           changes.get("crypto", current.crypto))
+        with self._publish_lock:
+            current = self.snapshot
+            if quotes:
+                changes["feed"] = MappingProxyType(self._merge_quotes(dict(current.feed), quotes))
+            # a single attribute store, readers see either the old or the new generation
+            snapshot = self.snapshot = current._replace(generation=current.generation + 1, **changes)
+        if quotes:
+            self.notify([snapshot.feed[path_id(quote["symbolId"])] for quote in quotes])
+        return snapshot
+
+    def notify(self, updated):
+        if not updated:
+            return
+        for listener in self.listeners:
+            try:
+                listener(updated)
+            except Exception as e:
+                logger.error(f"Quote listener failed: {e}")
+
+    @staticmethod
+    def _merge_quotes(feed, quotes):
+        for quote in quotes:
+            symbol_id = path_id(quote["symbolId"])
+            # stream updates may carry only the side that changed
+            merged = dict(feed.get(symbol_id, {}))
+            merged.update(quote)
+            merged["symbolId"] = symbol_id
+            feed[symbol_id] = freeze(merged)
+        return feed
+
+    def apply_quotes(self, quotes):
+        feed = self.publish(quotes=quotes).feed
+        return [feed[path_id(quote["symbolId"])] for quote in quotes]
+
+    def apply_quote(self, quote):
+        return self.apply_quotes([quote])[0]
+
+    def watch(self, symbol_ids):
+        # replaced rather than updated, the refresh thread may be iterating over it
+        self.watched = self.watched | set(symbol_ids)
+        if self.stream is not None:
+            self.stream.watch(symbol_ids)
+
+    def put_quotes(self, quotes):
+        feed = self.publish(quotes=quotes).feed
+        symbol_ids = [path_id(quote["symbolId"]) for quote in quotes]
+        if self.stream is not None:
+            self.stream.watch(symbol_ids)
+        return [feed[symbol_id] for symbol_id in symbol_ids]
+
+    def put_quote(self, quote):
+        return self.put_quotes([quote])[0]
+
+    @staticmethod
+    def _timed(func, *args):
+        started = time.perf_counter()
+        # refreshes must never hold up interactive lookups
+        with background():
+            result = func(*args)
+        return time.perf_counter() - started, result
+
+    def refresh(self, universe=True, feed_ids=None):
+        # every download runs at once on the executor, so a cycle lasts about as long as its slowest request
+        started = time.perf_counter()
+        jobs = {}
+        for stage, func, args in self.refresh_jobs(universe, feed_ids):
+            jobs[self.executor.submit(self._timed, func, *args)] = stage
+
+        outcomes = []
+        for future in as_completed(jobs):
+            try:
+                outcomes.append((jobs[future], *future.result(), None))
+            except Exception as e:
+                outcomes.append((jobs[future], None, None, e))
+        self.finish_refresh(outcomes, started)
+
+    def refresh_jobs(self, universe=True, feed_ids=None, connector=None):
+        connector = connector or self.connector
+        if universe:
+            for stage in ("stocks", "crossrates", "crypto"):
+                yield stage, getattr(connector, f"get_{stage}"), ()
+        feed_ids = feed_ids or []
+        for i in range(0, len(feed_ids), self.batch_size):
+            yield "feed", connector.get_feed, (",".join(feed_ids[i:i + self.batch_size]),)
+
+    def finish_refresh(self, outcomes, started):
+        timings, error, changes, quotes = {}, None, {}, []
+        for stage, elapsed, result, e in outcomes:
+            if e is not None:
+                logger.error(f"Refresh stage {stage} failed: {e}")
+                metrics.counter("refresh_errors_total", stage=stage).inc()
+                error = error or e
+                continue
+            metrics.histogram("refresh_stage_seconds", stage=stage).observe(elapsed)
+            timings[stage] = max(timings.get(stage, 0), elapsed)
+            if stage == "feed":
+                quotes.extend(result)
+            else:
+                changes[stage] = result
+        # the new generation is only published once every download has finished
+        if changes or quotes:
+            self.publish(quotes=quotes, **changes)
+        timings["total"] = time.perf_counter() - started
+        metrics.histogram("refresh_stage_seconds", stage="total").observe(timings["total"])
+        self.timings = timings
+        logger.info("Refresh timings: " + ", ".join(f"{k} {v:.3f}s" for k, v in timings.items()))
+        if error is not None:
+            raise error
+
+    def next_feed_ids(self):
+        if self.skip:
+            logger.info("Loading...")
+            return list(dict.fromkeys(list(self.feed) + self.cheat_feed + list(self.watched)))
+        if self.stream is None and datetime.today().weekday() not in (5, 6):
+            self.cheat_feed = list(dict.fromkeys(list(self.feed) + list(self.watched)))
+            return self.cheat_feed
+        return None
+
+    def due_poll(self):
+        # the feed ids to poll now, or None when a full refresh is due
+        if self.skip or time.monotonic() >= self._next_refresh or not self.polling():
+            return None
+        return list(set(self.polled()) | self.remote_polled)
+
+    def polling(self):
+        return self.stream is None and self.poll_interval > 0 and self.polled is not None
+
+    def interval(self):
+        remaining = max(self._next_refresh - time.monotonic(), 0)
+        return min(remaining, self.poll_interval) if self.polling() else remaining
+
+    def polled_refreshed(self):
+        # followers check their alerts against the shared feed as well
+        if self.shared is not None and not self.following():
+            self.share()
+
+    def refreshed(self):
+        self._next_refresh = time.monotonic() + REFRESH_INTERVAL
+        try:
+            # ready only once the snapshot is on disk, a restart right after the first refresh can use it
+            if self.snapshot_path:
+                self.save_snapshot()
+            if self.shared is not None and not self.following():
+                self.share()
+        finally:
+            if self.skip:
+                logger.info("Ready.")
+            self.skip = False
+
+    def step(self):
+        # one refresh as the leader or one sync as a follower, returns the seconds until the next one
+        self.exchange_ids()
+        if self.following():
+            if self.sync():
+                self.refreshed()
+            # until the leader has shared its first snapshot there is nothing to serve
+            return self.sync_interval if not self.skip else 1
+        polled = self.due_poll()
+        if polled is None:
+            self.refresh(feed_ids=self.next_feed_ids())
+            self.refreshed()
+        elif polled:
+            self.refresh(universe=False, feed_ids=polled)
+            self.polled_refreshed()
+        return self.interval()
+
+    def start_stream(self):
+        if self.stream is not None:
+            self.stream.watch(list(self.feed) + self.cheat_feed + list(self.watched))
+            self.stream.start()
 
     def run(self):
+        self.start_stream()
         while True:
-            timeout = 15 * 60
+            self.wakeup.clear()
             try:
-                self.stocks = self.connector.get_stocks()
-                self.crossrates = self.connector.get_crossrates()
-                self.crypto = self.connector.get_crypto()
-                if datetime.today().weekday() not in (5, 6) and not self.skip:
-                    print("Loading...")
-                    self.cheat_feed = [self.feed[x]["symbolId"] for x in self.feed]
-                    for i in range(0, len(self.feed), 5):
-                        feed = self.connector.get_feed(",".join(self.cheat_feed[i:i+5]))
-                        for quote in feed:
-                            quote["symbolId"] = re.sub("/", "%2F", quote["symbolId"])
-                            self.feed[quote["symbolId"]] = quote
-                    print("Ready.")
-                self.skip = False
-            except Exception as e:
-                logger.error(e)
+                timeout = self.step()
+            except Exception:
+                logger.exception("Refresh failed, retrying in 15s")
+                metrics.counter("refresh_failures_total").inc()
                 timeout = 15
 
-            time.sleep(timeout)
+            # a change of leader cuts the wait short
+            self.wakeup.wait(timeout)
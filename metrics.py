@@ -0,0 +1,293 @@
+# -*- coding:utf-8 -*-
+
+import sys
+import time
+import asyncio
+import traceback
+from bisect import bisect_left
+from collections import Counter as Tally
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock, get_ident
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds, the last bucket catches everything slower
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+PREFIX = "mardat_"
+
+
+class Histogram:
+    def __init__(self, name, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return None
+        rank, seen = q * count, 0
+        for bound, n in zip(self.buckets, counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def stats(self):
+        with self._lock:
+            count, total = self.count, self.sum
+        return {"count": count,
+                "mean": round(total / count, 4) if count else None,
+                "p50": self.quantile(0.5),
+                "p99": self.quantile(0.99)}
+
+
+class Counter:
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+_histograms = {}
+_counters = {}
+# name -> callable returning a flat dict of numbers, read at scrape time
+_collectors = {}
+_lock = Lock()
+
+
+def histogram(name, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = Histogram(name)
+        return _histograms[key]
+
+
+def histograms():
+    with _lock:
+        return dict(_histograms)
+
+
+def counter(name, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        if key not in _counters:
+            _counters[key] = Counter(name)
+        return _counters[key]
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def collector(name, func):
+    # stats() of caches, pools and queues are exported as gauges named <name>_<key>
+    with _lock:
+        _collectors[name] = func
+
+
+def collect():
+    with _lock:
+        collectors = dict(_collectors)
+    values = {}
+    for name, func in collectors.items():
+        try:
+            stats = func()
+        except Exception as e:
+            logger.error(f"Collector {name} failed: {e}")
+            continue
+        _flatten(values, name, stats)
+    return values
+
+
+def _flatten(values, name, stats):
+    for key, value in stats.items():
+        key = f"{name}_{key}".replace(":", "_").replace(".", "_").replace("-", "_")
+        if isinstance(value, dict):
+            _flatten(values, key, value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[key] = value
+
+
+@contextmanager
+def timer(name, error_name=None, profile=False, **labels):
+    """Observes the block's duration; exceptions also count towards ``error_name``."""
+    started = time.perf_counter()
+    sample = profiler.begin() if profile and profiler is not None else None
+    try:
+        yield
+    except Exception:
+        if error_name:
+            counter(error_name, **labels).inc()
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram(name, **labels).observe(elapsed)
+        if sample is not None:
+            profiler.end(sample, elapsed, f"{name}{_labels(labels)}")
+
+
+def timed(name, error_name=None, profile=False, **labels):
+    # decorator form of timer(), for plain functions and coroutine functions alike
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def timed_coroutine(*args, **kwargs):
+                with timer(name, error_name, **labels):
+                    return await func(*args, **kwargs)
+            return timed_coroutine
+
+        @wraps(func)
+        def timed_function(*args, **kwargs):
+            with timer(name, error_name, profile, **labels):
+                return func(*args, **kwargs)
+        return timed_function
+    return decorator
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+def _number(value):
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+def render():
+    """Prometheus text exposition format of every metric."""
+    lines = []
+    families = {}
+    for (name, labels), h in sorted(histograms().items()):
+        families.setdefault(name, []).append((dict(labels), h))
+    for name, series in families.items():
+        lines.append(f"# TYPE {PREFIX}{name} histogram")
+        for labels, h in series:
+            with h._lock:
+                counts, count, total = list(h.counts), h.count, h.sum
+            seen = 0
+            for bound, n in zip(h.buckets, counts):
+                seen += n
+                lines.append(f"{PREFIX}{name}_bucket{_labels(dict(labels, le=_number(bound)))} {seen}")
+            lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{PREFIX}{name}_count{_labels(labels)} {count}")
+    families = {}
+    for (name, labels), c in sorted(counters().items()):
+        families.setdefault(name, []).append((dict(labels), c))
+    for name, series in families.items():
+        lines.append(f"# TYPE {PREFIX}{name} counter")
+        lines.extend(f"{PREFIX}{name}{_labels(labels)} {c.value}" for labels, c in series)
+    for name, value in sorted(collect().items()):
+        lines.append(f"# TYPE {PREFIX}{name} gauge")
+        lines.append(f"{PREFIX}{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+class SamplingProfiler(Thread):
+    """Samples the stacks of threads inside a profiled block; slow ones are logged.
+
+    Only threads that called begin() are sampled, so the cost is paid while a
+    profiled request is running and nothing is logged for fast ones.
+    """
+
+    def __init__(self, threshold=2.0, interval=0.005, top=10):
+        super().__init__(name="profiler", daemon=True)
+        self.threshold = threshold
+        self.interval = interval
+        self.top = top
+        self.reports = 0
+        self._active = {}
+        self._lock = Lock()
+
+    def begin(self):
+        sample = (get_ident(), Tally())
+        with self._lock:
+            self._active.setdefault(sample[0], []).append(sample[1])
+        return sample
+
+    def end(self, sample, elapsed, name):
+        ident, stacks = sample
+        with self._lock:
+            self._active[ident].remove(stacks)
+            if not self._active[ident]:
+                del self._active[ident]
+        if elapsed < self.threshold or not stacks:
+            return
+        self.reports += 1
+        total = sum(stacks.values())
+        report = "\n".join(f"{n * 100 / total:5.1f}% {stack}" for stack, n in stacks.most_common(self.top))
+        logger.warning(f"Slow {name}: {elapsed:.3f}s, {total} samples\n{report}")
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for ident, tallies in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    # collapsed stack, outermost call first
+                    stack = ";".join(f"{f.name}:{f.lineno}" for f in traceback.extract_stack(frame)[-12:])
+                    for tally in tallies:
+                        tally[stack] += 1
+
+
+# set by enable_profiler(); timer(profile=True) is a plain timer until then
+profiler = None
+
+
+def enable_profiler(threshold=2.0, interval=0.005):
+    global profiler
+    if profiler is None:
+        profiler = SamplingProfiler(threshold, interval)
+        profiler.start()
+    return profiler
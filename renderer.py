@@ -0,0 +1,102 @@
+# -*- coding:utf-8 -*-
+
+import multiprocessing
+from threading import Lock
+
+import metrics
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RenderTimeout(Exception):
+    pass
+
+
+def _warm_up():
+    # the first kaleido export starts its chromium subprocess, pay for it before any job arrives
+    import plotly.io as pio
+    pio.to_image({"data": [], "layout": {}}, format="png", width=10, height=10)
+
+
+def _render(fig, image_format, width, height):
+    import plotly.io as pio
+    return pio.to_image(fig, format=image_format, width=width, height=height)
+
+
+class ChartRenderer:
+    """Pool of pre-warmed kaleido worker processes fed through the pool's job queue."""
+
+    def __init__(self, workers=2, timeout=30):
+        self.workers = workers
+        self.timeout = timeout
+        self.rendered = 0
+        self.timeouts = 0
+        self.pending = 0
+        self._lock = Lock()
+        self._pool = self._spawn()
+        # jobs still waited on per pool; a pool retired after a timeout is terminated once it drains
+        self._inflight = {}
+        self._retired = set()
+
+    @classmethod
+    def from_config(cls, section):
+        return cls(workers=section.getint("render_workers", 2),
+                   timeout=section.getfloat("render_timeout", 30))
+
+    def _spawn(self):
+        # workers are forked from a single-threaded fork server, never from the bot with its
+        # threads and their locks; that includes the pool replacing a dead worker
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["plotly.io"])
+        return context.Pool(self.workers, initializer=_warm_up)
+
+    @metrics.timed("chart_render_seconds", "chart_render_errors_total")
+    def render(self, fig, image_format="png", width=None, height=None, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        with self._lock:
+            pool = self._pool
+            self.pending += 1
+            self._inflight[pool] = self._inflight.get(pool, 0) + 1
+        try:
+            job = pool.apply_async(_render, (fig.to_dict(), image_format, width, height))
+            image = job.get(timeout)
+        except multiprocessing.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+                # a hung kaleido process would keep its slot forever, so new jobs go to a fresh pool;
+                # the old one is closed rather than terminated and finishes the jobs it already has
+                if self._pool is pool:
+                    logger.warning("Chart render timed out, restarting renderer pool")
+                    self._pool = self._spawn()
+                    self._retired.add(pool)
+                    pool.close()
+            raise RenderTimeout(f"chart render exceeded {timeout}s")
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self._inflight[pool] -= 1
+                drained = not self._inflight[pool] and pool in self._retired
+                if drained:
+                    del self._inflight[pool]
+                    self._retired.discard(pool)
+            if drained:
+                # nobody waits on it any more, only the hung worker is left
+                pool.terminate()
+        with self._lock:
+            self.rendered += 1
+        return image
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.workers, "pending": self.pending,
+                    "rendered": self.rendered, "timeouts": self.timeouts, "retired": len(self._retired)}
+
+    def close(self):
+        with self._lock:
+            retired, self._retired = self._retired, set()
+        for pool in retired:
+            pool.terminate()
+        self._pool.close()
+        self._pool.join()
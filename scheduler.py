@@ -0,0 +1,230 @@
+# -*- coding:utf-8 -*-
+
+import os
+import time
+import pickle
+import asyncio
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# a context variable is private to each thread and to each asyncio task
+_lane = ContextVar("lane", default=INTERACTIVE)
+
+
+@contextmanager
+def lane(priority):
+    # requests made inside the block are queued in the given priority lane
+    token = _lane.set(priority)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def background():
+    return lane(BACKGROUND)
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def delay(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class RequestScheduler:
+    """Token-bucket throttling per upstream and endpoint with priority lanes and daily quotas.
+
+    Interactive requests always go first: a background request only takes a
+    token while no interactive request is waiting for the same upstream.
+    Quota usage is kept in ``path`` so a restart does not hand out the day's
+    requests a second time.
+    """
+
+    def __init__(self, path=None):
+        self.buckets = {}
+        self.quotas = {}
+        # upstream -> (day, requests made that day)
+        self.used = {}
+        # (upstream, base url) pairs, to tell which upstream a transport retry went to
+        self.routes = []
+        self.throttled = 0
+        self.retries = 0
+        self.path = path
+        self.dirty = False
+        self._waiting = Counter()
+        self._cond = threading.Condition()
+        self._save_lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    self.used.update(pickle.load(f))
+            except Exception as e:
+                logger.error(f"Could not load quota usage {path}: {e}")
+
+    def configure(self, section):
+        for key, value in section.items():
+            if key.endswith("_rate"):
+                name = key[:-len("_rate")]
+                upstream, _, endpoint = name.partition(".")
+                self.limit(upstream, float(value), section.getfloat(f"{name}_burst", None), endpoint or None)
+            elif key.endswith("_daily"):
+                upstream = key[:-len("_daily")]
+                self.quota(upstream, int(value), section.getint(f"{upstream}_reserve", 0))
+        return self
+
+    def limit(self, upstream, rate, burst=None, endpoint=None):
+        self.buckets[(upstream, endpoint)] = TokenBucket(rate, burst)
+
+    def quota(self, upstream, daily, reserve=0):
+        self.quotas[upstream] = (daily, reserve)
+
+    def route(self, upstream, url):
+        self.routes.append((upstream, urlsplit(url)))
+
+    def _used_today(self, upstream):
+        today = datetime.utcnow().date()
+        day, count = self.used.get(upstream, (today, 0))
+        return count if day == today else 0
+
+    def remaining(self, upstream):
+        if upstream not in self.quotas:
+            return None
+        with self._cond:
+            return self.quotas[upstream][0] - self._used_today(upstream)
+
+    def quota_low(self, upstream):
+        # callers should serve cached data once only the reserve is left
+        if upstream not in self.quotas:
+            return False
+        return self.remaining(upstream) <= self.quotas[upstream][1]
+
+    def _buckets(self, upstream, endpoint):
+        keys = [(upstream, None)] + ([(upstream, endpoint)] if endpoint is not None else [])
+        return [self.buckets[k] for k in keys if k in self.buckets]
+
+    def _check_quota(self, upstream):
+        if upstream in self.quotas and self._used_today(upstream) >= self.quotas[upstream][0]:
+            raise QuotaExceeded(f"daily {upstream} quota used up")
+
+    def _take(self, upstream, buckets, priority):
+        # called with the condition held, returns how long to wait or 0 once a token was taken
+        if priority == BACKGROUND and self._waiting[(upstream, INTERACTIVE)]:
+            return 0.05
+        now = time.monotonic()
+        delay = max([b.delay(now) for b in buckets], default=0)
+        if delay > 0:
+            self.throttled += 1
+            return delay
+        for bucket in buckets:
+            bucket.consume()
+        self._count(upstream)
+        return 0
+
+    def _count(self, upstream):
+        self.used[upstream] = (datetime.utcnow().date(), self._used_today(upstream) + 1)
+        self.dirty = True
+
+    def retried(self, url):
+        # a retry made by the transport costs quota like any other request, it just skips the buckets;
+        # upstreams are told apart by host and path, the port is left out
+        parts = urlsplit(url)
+        for upstream, base in self.routes:
+            if parts.hostname == base.hostname and parts.path.startswith(base.path):
+                with self._cond:
+                    self.retries += 1
+                    self._count(upstream)
+                return
+
+    def acquire(self, upstream, endpoint=None):
+        priority = _lane.get()
+        buckets = self._buckets(upstream, endpoint)
+        with self._cond:
+            self._check_quota(upstream)
+            self._waiting[(upstream, priority)] += 1
+            try:
+                while True:
+                    delay = self._take(upstream, buckets, priority)
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+            finally:
+                self._waiting[(upstream, priority)] -= 1
+                self._cond.notify_all()
+
+    async def acquire_async(self, upstream, endpoint=None):
+        priority = _lane.get()
+        buckets = self._buckets(upstream, endpoint)
+        with self._cond:
+            self._check_quota(upstream)
+            self._waiting[(upstream, priority)] += 1
+        try:
+            while True:
+                with self._cond:
+                    delay = self._take(upstream, buckets, priority)
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+        finally:
+            with self._cond:
+                self._waiting[(upstream, priority)] -= 1
+                self._cond.notify_all()
+
+    def save(self, path=None):
+        path = path or self.path
+        with self._cond:
+            used = dict(self.used)
+            self.dirty = False
+        tmp = path + ".tmp"
+        with self._save_lock:
+            try:
+                with open(tmp, "wb") as f:
+                    pickle.dump(used, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, path)
+            except OSError as e:
+                logger.error(f"Could not save quota usage {path}: {e}")
+
+    def autosave(self, interval=5):
+        # usage reaches the disk within ``interval`` seconds, requests never wait for it
+        def run():
+            while True:
+                time.sleep(interval)
+                if self.dirty:
+                    self.save()
+        if self.path:
+            threading.Thread(target=run, name="quota-save", daemon=True).start()
+
+    def stats(self):
+        with self._cond:
+            return {"throttled": self.throttled,
+                    "retries": self.retries,
+                    "waiting": {f"{k[0]}:{'interactive' if k[1] == INTERACTIVE else 'background'}": n
+                                for k, n in self._waiting.items() if n},
+                    "used_today": {k: self._used_today(k) for k in self.used}}
+
+
+default_scheduler = RequestScheduler()
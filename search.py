@@ -0,0 +1,128 @@
+# -*- coding:utf-8 -*-
+
+import re
+from bisect import bisect_left
+from collections import Counter
+
+# trigrams and words shared by more entries than this carry no ranking signal and are skipped
+MAX_POSTINGS = 2000
+
+
+def normalize(text):
+    return re.sub(r"[^0-9A-Z]+", " ", text.upper()).strip()
+
+
+def trigrams(term):
+    term = f" {term} "
+    return {term[i:i + 3] for i in range(len(term) - 2)}
+
+
+def edit_distance(a, b):
+    # optimal string alignment distance, so a swapped pair of letters counts as one typo
+    prev2, prev = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        prev2, prev = prev, cur
+    return prev[-1]
+
+
+class SearchIndex:
+    """Prefix and typo-tolerant lookup over tickers, descriptions and crypto names.
+
+    Built once per universe refresh. Entries are ``(kind, key, instrument)``
+    tuples where ``kind`` is one of ``stock``, ``cross`` or ``crypto`` and
+    ``key`` is the instrument's key in the matching storage table.
+    """
+
+    def __init__(self, stocks=None, crossrates=None, crypto=None):
+        self.entries = []
+        vocab = {}
+        for kind, table in (("stock", stocks or {}), ("cross", crossrates or {}), ("crypto", crypto or {})):
+            for key, instrum in table.items():
+                idx = len(self.entries)
+                self.entries.append((kind, key, instrum))
+                ticker = normalize(key).replace(" ", "")
+                words = set(normalize(instrum.get("description", "")).split())
+                words.update(normalize(instrum.get("name", "")).split())
+                words.discard(ticker)
+                # the rank is stored with the term so exact tickers outrank name words
+                vocab.setdefault(ticker, []).append((0, idx))
+                for word in words:
+                    vocab.setdefault(word, []).append((1, idx))
+        self._terms = sorted(vocab)
+        self._postings = [vocab[term] for term in self._terms]
+        self._gram_counts = []
+        grams = {}
+        for term_id, term in enumerate(self._terms):
+            term_grams = trigrams(term)
+            self._gram_counts.append(len(term_grams))
+            for gram in term_grams:
+                grams.setdefault(gram, []).append(term_id)
+        self._grams = {k: v for k, v in grams.items() if len(v) <= MAX_POSTINGS}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _is_common(self, word):
+        i = bisect_left(self._terms, word)
+        return i < len(self._terms) and self._terms[i] == word and len(self._postings[i]) > MAX_POSTINGS
+
+    def prefix(self, text, limit=50):
+        found = {}
+        i = bisect_left(self._terms, text)
+        while i < len(self._terms) and len(found) < limit and self._terms[i].startswith(text):
+            term = self._terms[i]
+            for rank, idx in self._postings[i][:limit]:
+                score = (rank, 0 if term == text else 1, 0, len(term))
+                if idx not in found or score < found[idx]:
+                    found[idx] = score
+            i += 1
+        return found
+
+    def fuzzy(self, text, limit=50):
+        # trigrams narrow the vocabulary down to a few candidates, edit distance decides
+        counts = Counter()
+        for gram in trigrams(text):
+            counts.update(self._grams.get(gram, ()))
+        allowed = 1 if len(text) < 5 else 2
+        found = {}
+        for term_id, shared in counts.most_common(limit):
+            if shared < 2:
+                break
+            term = self._terms[term_id]
+            if abs(len(term) - len(text)) > allowed:
+                continue
+            distance = edit_distance(text, term)
+            if distance > allowed:
+                continue
+            for rank, idx in self._postings[term_id]:
+                score = (2, distance, rank, len(term))
+                if idx not in found or score < found[idx]:
+                    found[idx] = score
+        return found
+
+    def search(self, text, limit=6):
+        text = normalize(text)
+        if not text:
+            return []
+        words = list(dict.fromkeys([text.replace(" ", "")] + text.split()))
+        # words such as INC or CORP match most of the universe and say nothing about the instrument
+        words = [w for w in words if not self._is_common(w)] or words[:1]
+        scores, matches = {}, Counter()
+        for word in words:
+            for idx, score in self.prefix(word).items():
+                matches[idx] += 1
+                if idx not in scores or score < scores[idx]:
+                    scores[idx] = score
+        if len(scores) < limit:
+            for word in words[1:] or words:
+                for idx, score in self.fuzzy(word).items():
+                    scores.setdefault(idx, score)
+        # entries matching more of the query words come first
+        ranked = sorted(scores, key=lambda idx: (-matches[idx], scores[idx]))[:limit]
+        return [self.entries[idx] for idx in ranked]
@@ -0,0 +1,48 @@
+import os
+import sys
+from itertools import count
+from threading import Lock
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+
+class RecordingBot:
+    """Stands in for telegram.Bot and keeps every call it gets, in order."""
+
+    name = "@test_bot"
+
+    def __init__(self):
+        self.calls = []
+        self._ids = count(1000)
+        self._lock = Lock()
+
+    def _record(self, method, kwargs):
+        with self._lock:
+            self.calls.append((method, kwargs))
+            return SimpleNamespace(message_id=next(self._ids), chat_id=kwargs.get("chat_id"), photo=None)
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return lambda **kwargs: self._record(method, kwargs)
+
+    def sent(self, method):
+        with self._lock:
+            return [kwargs for name, kwargs in self.calls if name == method]
+
+
+@pytest.fixture
+def recording_bot():
+    return RecordingBot()
+
+
+def callback_query(chat_id, message_id, data):
+    answers = []
+    message = SimpleNamespace(chat_id=chat_id, message_id=message_id)
+    return SimpleNamespace(data=data, message=message, answers=answers,
+                           answer=lambda **kwargs: answers.append(kwargs))
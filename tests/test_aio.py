@@ -0,0 +1,27 @@
+import asyncio
+import logging
+from configparser import ConfigParser
+
+import bot
+from aio import AsyncTransport
+
+
+def test_connection_limit_is_the_pool_size():
+    config = ConfigParser()
+    config.read_dict({"HTTP": {"pool_size": "10", "per_host": "32"}})
+    transport = AsyncTransport.from_config(config["HTTP"])
+    assert (transport.pool_size, transport.per_host) == (10, 32)
+
+
+def test_cancelled_handlers_are_not_reported_as_failures(caplog):
+    loop = asyncio.new_event_loop()
+    try:
+        cancelled, failed = loop.create_future(), loop.create_future()
+        cancelled.cancel()
+        failed.set_exception(ValueError("boom"))
+        with caplog.at_level(logging.ERROR, logger="bot"):
+            bot.report_failure("process_async", cancelled)
+            bot.report_failure("process_async", failed)
+    finally:
+        loop.close()
+    assert [r.getMessage() for r in caplog.records] == ["process_async: boom"]
@@ -0,0 +1,103 @@
+import time
+from types import SimpleNamespace
+
+import bot
+from alerts import AlertBook
+from mdapi import DataStorage
+
+
+def quote(symbol_id, price):
+    return {"symbolId": symbol_id, "timestamp": int(time.time() * 1000),
+            "bid": [{"value": str(price), "size": "1"}], "ask": [{"value": str(price), "size": "1"}]}
+
+
+def fired(book, symbol_id, price):
+    return sorted(alert.id for alert, _ in book.check([quote(symbol_id, price)]))
+
+
+def test_alerts_fire_when_the_price_crosses():
+    book = AlertBook()
+    up = book.add(1, "AAPL.NASDAQ", "AAPL", ">", 190, price=185)
+    down = book.add(1, "AAPL.NASDAQ", "AAPL", "<", 180, price=185)
+    assert fired(book, "AAPL.NASDAQ", 189) == []
+    assert fired(book, "AAPL.NASDAQ", 191) == [up.id]
+    assert fired(book, "AAPL.NASDAQ", 175) == [down.id]
+    assert len(book) == 0
+
+
+def test_only_the_crossed_interval_is_matched():
+    book = AlertBook()
+    ids = [book.add(1, "EUR%2FUSD.EXANTE", "EUR/USD", ">", level, price=1.0).id for level in (1.1, 1.2, 1.3)]
+    assert fired(book, "EUR%2FUSD.EXANTE", 1.25) == ids[:2]
+    # back down and up again to the same price crosses nothing new
+    assert fired(book, "EUR%2FUSD.EXANTE", 1.15) == []
+    assert fired(book, "EUR%2FUSD.EXANTE", 1.25) == []
+    assert fired(book, "EUR%2FUSD.EXANTE", 1.35) == ids[2:]
+
+
+def test_a_level_already_passed_waits_for_the_next_crossing():
+    book = AlertBook()
+    alert = book.add(1, "AAPL.NASDAQ", "AAPL", ">", 190, price=200)
+    assert fired(book, "AAPL.NASDAQ", 201) == []
+    assert fired(book, "AAPL.NASDAQ", 185) == []
+    assert fired(book, "AAPL.NASDAQ", 195) == [alert.id]
+
+
+def test_the_first_quote_only_sets_the_start():
+    book = AlertBook()
+    alert = book.add(1, "AAPL.NASDAQ", "AAPL", "<", 180)
+    assert fired(book, "AAPL.NASDAQ", 170) == []
+    assert fired(book, "AAPL.NASDAQ", 185) == []
+    assert fired(book, "AAPL.NASDAQ", 179) == [alert.id]
+
+
+def test_last_prices_are_saved_with_the_alerts(tmp_path):
+    path = str(tmp_path / "alerts.pickle")
+    book = AlertBook(path=path)
+    alert = book.add(1, "AAPL.NASDAQ", "AAPL", ">", 190, price=185)
+    book.save()
+    # the price moved past the level while the bot was down
+    assert fired(AlertBook(path=path), "AAPL.NASDAQ", 195) == [alert.id]
+
+
+class Connector:
+    def __init__(self):
+        self.feeds = []
+
+    def get_stocks(self):
+        return {}
+
+    def get_crossrates(self):
+        return {}
+
+    def get_crypto(self):
+        return {}
+
+    def get_feed(self, symbol_ids):
+        self.feeds.append(symbol_ids)
+        return [quote(symbol_id, 100) for symbol_id in symbol_ids.split(",")]
+
+
+def test_alert_symbols_are_polled_between_refreshes():
+    connector = Connector()
+    storage = DataStorage(connector, poll_interval=60)
+    storage.cheat_feed = ["GOOG.NASDAQ"]
+    storage.polled = lambda: ["AAPL.NASDAQ"]
+    assert storage.step() == 60
+    assert connector.feeds == ["GOOG.NASDAQ"]
+    assert storage.step() == 60
+    assert connector.feeds[-1] == "AAPL.NASDAQ"
+    assert storage.feed.keys() == {"GOOG.NASDAQ", "AAPL.NASDAQ"}
+
+
+def test_unknown_symbols_are_escaped_in_the_reply(monkeypatch):
+    monkeypatch.setattr(bot, "storage", DataStorage(connector=None))
+    replies = []
+    message = SimpleNamespace(chat_id=1, reply_text=lambda **kwargs: replies.append(kwargs))
+    bot.alert(SimpleNamespace(message=message), SimpleNamespace(args=["<b>x&y", ">", "1"]))
+    assert replies[0]["text"].startswith("Could not find <b>&lt;b&gt;x&amp;y</b>.")
+
+
+def test_alert_replies_escape_the_ticker():
+    alert = AlertBook().add(1, "M&M.NSE", "M&M", ">", 10, price=5)
+    assert bot.format_alert(alert) == f"#{alert.id} <b>M&amp;M</b> &gt; 10"
@@ -0,0 +1,84 @@
+import time
+
+from candles import CandleSeries, CandleStore
+
+MINUTE = 60
+
+
+def bar(minute, close, high=None, low=None):
+    # minutes since an hour boundary, upstream style
+    return {"timestamp": 3600 * 1000 * 1000 + minute * MINUTE * 1000, "open": close,
+            "high": close if high is None else high, "low": close if low is None else low, "close": close}
+
+
+def series(minutes):
+    candles = CandleSeries(MINUTE)
+    candles.merge([bar(minute, minute) for minute in minutes])
+    return candles
+
+
+def test_merge_replaces_the_overlap():
+    candles = series(range(5))
+    # newest first, the last stored bar was still forming
+    candles.merge([bar(6, 60), bar(5, 50), bar(4, 40)])
+    assert [b["close"] for b in candles.last(10)] == [60, 50, 40, 3, 2, 1, 0]
+
+
+def test_merge_after_a_gap_drops_the_old_bars():
+    candles = series(range(5))
+    candles.merge([bar(10, 10), bar(9, 9)])
+    assert [b["close"] for b in candles.last(10)] == [10, 9]
+
+
+def test_tail_size_covers_the_missed_bars():
+    candles = series(range(5))
+    last = candles.timestamps[-1] / 1000
+    assert candles.tail_size(candles.fetched + 1, max_age=60) == 0
+    # three bars were missed, the stored last one is fetched again as it may have changed
+    candles.fetched = 0
+    assert candles.tail_size(last + 3 * MINUTE, max_age=60) == 5
+
+
+def test_aggregate_builds_coarser_bars():
+    candles = CandleSeries(MINUTE)
+    candles.merge([bar(minute, minute, high=minute + 100, low=-minute) for minute in range(3, 15)])
+    bars = candles.aggregate(5 * MINUTE, 10)
+    # minutes 3-4 only cover part of their bucket and are left out, newest bucket first
+    assert [b["timestamp"] for b in bars] == [bar(10, 0)["timestamp"], bar(5, 0)["timestamp"]]
+    assert bars[1] == dict(bar(5, 9, high=109, low=-9), open=5)
+    assert candles.buckets(5 * MINUTE) == 2
+
+
+def test_plan_derives_from_a_finer_series():
+    store = CandleStore(min_bars=100)
+    assert store.plan("AAPL.NASDAQ", 5 * MINUTE, 2) == (5 * MINUTE, 100)
+    store.merge("AAPL.NASDAQ", MINUTE, [bar(minute, minute) for minute in range(3, 15)])
+    assert store.plan("AAPL.NASDAQ", 5 * MINUTE, 2) == (MINUTE, 0)
+    assert store.bars("AAPL.NASDAQ", 5 * MINUTE, 2, MINUTE)[0]["close"] == 14
+    # three buckets are more than the finer series covers
+    assert store.plan("AAPL.NASDAQ", 5 * MINUTE, 3) == (5 * MINUTE, 100)
+    assert store.stats()["derived"] == 1
+
+
+def test_plan_fetches_only_the_stale_tail():
+    store = CandleStore(max_age=60)
+    now = time.time()
+    store.merge("AAPL.NASDAQ", MINUTE, [{"timestamp": int((now - minute * MINUTE) * 1000), "open": 1,
+                                          "high": 1, "low": 1, "close": 1} for minute in range(10)])
+    store.series[("AAPL.NASDAQ", MINUTE)].fetched = now - 120
+    source, size = store.plan("AAPL.NASDAQ", MINUTE, 10)
+    assert source == MINUTE and size == 2
+    assert store.stats()["tail_fetches"] == 1
+
+
+def test_saved_store_is_trimmed_on_load(tmp_path):
+    path = str(tmp_path / "candles.pkl")
+    store = CandleStore(path=path)
+    for symbol in ("AAPL", "MSFT", "TSLA"):
+        store.merge(symbol, MINUTE, [bar(0, 1)])
+    assert store.dirty
+    store.save()
+    assert not store.dirty
+    smaller = CandleStore(path=path, max_series=2)
+    assert list(smaller.series) == [("MSFT", MINUTE), ("TSLA", MINUTE)]
+    assert smaller.bars("TSLA", MINUTE, 1)[0]["close"] == 1
@@ -0,0 +1,127 @@
+import time
+from inspect import unwrap
+from threading import Barrier, Thread
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+from backend import MemoryBackend
+from chartcache import ChartCache
+from conftest import callback_query
+
+USERS = 32
+
+
+@pytest.fixture
+def chart_bot(monkeypatch):
+    monkeypatch.setattr(bot, "backend", MemoryBackend())
+    monkeypatch.setattr(bot, "chart_cache", ChartCache())
+    renders = []
+
+    def render_chart(instrum, trange, counter):
+        # slow enough for every callback to be in flight at once
+        renders.append((instrum["path_id"], trange, counter))
+        time.sleep(0.05)
+        return f"png {instrum['ticker']} {trange} {counter}".encode()
+
+    monkeypatch.setattr(bot, "render_chart", render_chart)
+    monkeypatch.setattr(bot, "renders", renders, raising=False)
+    return bot
+
+
+def instrument(i):
+    return {"ticker": f"T{i}", "path_id": f"T{i}.NASDAQ", "exchange": "NASDAQ", "currency": "USD"}
+
+
+def run_concurrently(callbacks, context):
+    handler = unwrap(bot.tchart_menu)
+    barrier = Barrier(len(callbacks))
+    errors = []
+
+    def run(query):
+        barrier.wait()
+        try:
+            handler(SimpleNamespace(callback_query=query, effective_message=query.message), context)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [Thread(target=run, args=(query,)) for query in callbacks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+
+def test_concurrent_new_charts_get_their_own_image(chart_bot, recording_bot):
+    context = SimpleNamespace(bot=recording_bot)
+    callbacks = []
+    for i in range(USERS):
+        chart_bot.remember_chart(i, 500 + i, instrument(i), "USD")
+        callbacks.append(callback_query(i, 500 + i, "stock"))
+
+    buffers = {}
+    send_photo = recording_bot.send_photo
+
+    def record_photo(**kwargs):
+        buffers[kwargs["chat_id"]] = (kwargs["photo"], kwargs["photo"].getvalue())
+        return send_photo(**kwargs)
+
+    recording_bot.send_photo = record_photo
+    run_concurrently(callbacks, context)
+
+    assert len(buffers) == USERS
+    for chat_id, (photo, png) in buffers.items():
+        assert png == f"png T{chat_id} 1 day USD".encode()
+    assert len({id(photo) for photo, _ in buffers.values()}) == USERS
+
+
+def test_concurrent_range_changes_share_the_chart_but_not_the_buffer(chart_bot, recording_bot):
+    context = SimpleNamespace(bot=recording_bot)
+    callbacks = []
+    for i in range(USERS):
+        chart_bot.remember_chart(i, 500 + i, instrument(0), "USD")
+        callbacks.append(callback_query(i, 500 + i, "1 week" if i % 2 else "1 hour"))
+
+    run_concurrently(callbacks, context)
+
+    edits = recording_bot.sent("edit_message_media")
+    assert sorted(edit["chat_id"] for edit in edits) == list(range(USERS))
+    for edit in edits:
+        trange = "1 week" if edit["chat_id"] % 2 else "1 hour"
+        assert edit["media"].media.input_file_content == f"png T0 {trange} USD".encode()
+    assert len({id(edit["media"].media) for edit in edits}) == USERS
+
+
+def test_presses_of_a_missing_chart_render_it_once(chart_bot, recording_bot):
+    context = SimpleNamespace(bot=recording_bot)
+    callbacks = []
+    for i in range(USERS):
+        chart_bot.remember_chart(i, 500 + i, instrument(0), "USD")
+        callbacks.append(callback_query(i, 500 + i, "1 hour"))
+
+    run_concurrently(callbacks, context)
+
+    assert chart_bot.renders == [("T0.NASDAQ", "1 hour", "USD")]
+    assert len(recording_bot.sent("edit_message_media")) == USERS
+    assert chart_bot.chart_cache.stats()["coalesced"] + chart_bot.chart_cache.stats()["hits"] == USERS - 1
+
+
+def test_unchanged_chart_keeps_its_file_id(chart_bot, recording_bot):
+    from telegram.error import BadRequest
+
+    key = ("T0.NASDAQ", "1 hour", "USD")
+    chart_bot.chart_cache.put(key, b"png", 60)
+    chart_bot.chart_cache.set_file_id(key, "file-1")
+
+    def edit_message_media(**kwargs):
+        raise BadRequest("Message is not modified: specified new message content is the same")
+
+    recording_bot.edit_message_media = edit_message_media
+    query = callback_query(1, 501, "1 hour")
+    chart_bot.deliver_chart(query, SimpleNamespace(bot=recording_bot), key, chart_bot.chart_cache.get(key),
+                            instrument(0), "USD", False, None)
+
+    assert chart_bot.chart_cache.get(key).file_id == "file-1"
+    assert not recording_bot.sent("send_photo")
@@ -0,0 +1,60 @@
+from inspect import unwrap
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+from backend import MemoryBackend
+from mdapi import DataStorage
+
+LONG = "decentralised autonomous settlement network token"
+
+
+@pytest.fixture
+def crypto_bot(monkeypatch):
+    storage = DataStorage(connector=None)
+    crypto = {f"C{i:03d}": {"id": f"C{i:03d}.EXANTE", "path_id": f"C{i:03d}.EXANTE", "ticker": f"C{i:03d}",
+                            "exchange": "EXANTE", "name": f"C{i:03d}", "currency": "USD",
+                            "description": f"{LONG if i % 2 else 'plain'} coin {i:03d}"}
+              for i in range(120)}
+    storage.publish(crypto=crypto)
+    monkeypatch.setattr(bot, "storage", storage)
+    monkeypatch.setattr(bot, "backend", MemoryBackend())
+    return bot
+
+
+def page_query(data):
+    edits, answers = [], []
+    return SimpleNamespace(data=data, answers=answers, edits=edits,
+                           answer=lambda **kwargs: answers.append(kwargs),
+                           edit_message_text=lambda **kwargs: edits.append(kwargs))
+
+
+def buttons(keyboard):
+    return [button.callback_data for button in keyboard.inline_keyboard[0]]
+
+
+def test_long_filters_fit_the_callback_data(crypto_bot):
+    text, keyboard = bot.crypto_page(0, LONG)
+    assert all(len(data.encode()) <= 64 for data in buttons(keyboard))
+    query = page_query(buttons(keyboard)[-1])
+    unwrap(bot.crypto_list_page)(SimpleNamespace(callback_query=query), None)
+    # the second page of the same filter, not of a truncated one
+    expected, _, _ = bot.crypto_pages().page(1, LONG)
+    assert query.edits[0]["text"] == expected
+    assert "plain" not in expected
+
+
+def test_unfiltered_pages_need_no_backend(crypto_bot):
+    _, keyboard = bot.crypto_page(0)
+    assert buttons(keyboard) == ["crypto:0:", "crypto:1:"]
+    assert bot.backend.stats()["entries"] == 0
+
+
+def test_forgotten_filters_ask_for_a_new_list(crypto_bot):
+    _, keyboard = bot.crypto_page(0, LONG)
+    bot.backend = MemoryBackend()
+    query = page_query(buttons(keyboard)[-1])
+    unwrap(bot.crypto_list_page)(SimpleNamespace(callback_query=query), None)
+    assert query.edits == []
+    assert "expired" in query.answers[0]["text"]
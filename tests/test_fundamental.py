@@ -0,0 +1,49 @@
+import time
+
+from fundamental import FundamentalApi
+
+
+class Sheets:
+    """Stands in for the FMP fetch, one statement per call."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, symbol, sheet):
+        self.calls.append((symbol, sheet))
+        return [{"symbol": symbol, "sheet": sheet}]
+
+
+def test_misses_do_not_write_the_cache(tmp_path, monkeypatch):
+    path = str(tmp_path / "fundamentals.pkl")
+    fapi = FundamentalApi(path=path)
+    monkeypatch.setattr(fapi, "fetch", Sheets())
+    fapi.request("AAPL", "ratios")
+    assert fapi.dirty
+    assert not (tmp_path / "fundamentals.pkl").exists()
+    fapi.save()
+    assert not fapi.dirty
+    assert FundamentalApi(path=path).request("AAPL", "ratios") == [{"symbol": "AAPL", "sheet": "ratios"}]
+
+
+def test_autosave_writes_dirty_caches(tmp_path, monkeypatch):
+    path = tmp_path / "fundamentals.pkl"
+    fapi = FundamentalApi(path=str(path))
+    monkeypatch.setattr(fapi, "fetch", Sheets())
+    fapi.autosave(interval=0.01)
+    fapi.request("AAPL", "ratios")
+    deadline = time.monotonic() + 2
+    while fapi.dirty and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not fapi.dirty and path.exists()
+
+
+def test_loaded_cache_is_trimmed(tmp_path, monkeypatch):
+    path = str(tmp_path / "fundamentals.pkl")
+    fapi = FundamentalApi(path=path)
+    monkeypatch.setattr(fapi, "fetch", Sheets())
+    for symbol in ("AAPL", "MSFT", "TSLA"):
+        fapi.request(symbol, "ratios")
+    fapi.save()
+    smaller = FundamentalApi(path=path, max_entries=2)
+    assert list(smaller.cache) == [("MSFT", "ratios"), ("TSLA", "ratios")]
@@ -0,0 +1,50 @@
+import time
+from threading import Thread
+
+import pytest
+
+from renderer import ChartRenderer, RenderTimeout
+
+
+class Figure:
+    def to_dict(self):
+        return {"data": [{"type": "scatter", "x": [1, 2, 3], "y": [3, 1, 2]}], "layout": {}}
+
+
+@pytest.fixture(scope="module")
+def renderer():
+    renderer = ChartRenderer(workers=1, timeout=60)
+    yield renderer
+    renderer.close()
+
+
+def test_workers_do_not_fork_from_the_bot(renderer):
+    assert renderer._pool._ctx.get_start_method() == "forkserver"
+
+
+def test_renders_png(renderer):
+    assert renderer.render(Figure(), width=100, height=100).startswith(b"\x89PNG")
+
+
+def test_timeout_replaces_the_pool(renderer):
+    pool = renderer._pool
+    with pytest.raises(RenderTimeout):
+        renderer.render(Figure(), width=100, height=100, timeout=0.001)
+    assert renderer._pool is not pool
+    assert renderer._pool._ctx.get_start_method() == "forkserver"
+    assert renderer.render(Figure(), width=100, height=100).startswith(b"\x89PNG")
+
+
+def test_timeout_spares_the_other_jobs(renderer):
+    images = []
+    other = Thread(target=lambda: images.append(renderer.render(Figure(), width=200, height=200)))
+    other.start()
+    while not renderer.pending:
+        time.sleep(0.001)
+    pool = renderer._pool
+    with pytest.raises(RenderTimeout):
+        renderer.render(Figure(), width=100, height=100, timeout=0.001)
+    other.join()
+    # the job already on the old pool finished there, then the drained pool was shut down
+    assert images[0].startswith(b"\x89PNG")
+    assert renderer._pool is not pool and renderer.stats()["retired"] == 0
@@ -0,0 +1,131 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from backend import RedisBackend, LeaderElection
+from fundamental import FundamentalApi
+from mdapi import DataStorage
+from standins import KeyValueServer
+
+
+def quote(symbol_id, price, timestamp):
+    return {"symbolId": symbol_id, "timestamp": timestamp,
+            "bid": [{"value": str(price), "size": "1"}], "ask": [{"value": str(price), "size": "1"}]}
+
+
+class Connector:
+    """Serves a fixed universe and records which feeds were asked for."""
+
+    def __init__(self):
+        self.feeds = []
+
+    def get_stocks(self):
+        return {"AAPL": {"id": "AAPL.NASDAQ", "path_id": "AAPL.NASDAQ", "ticker": "AAPL", "description": "Apple"}}
+
+    def get_crossrates(self):
+        return {}
+
+    def get_crypto(self):
+        return {}
+
+    def get_feed(self, symbol_ids):
+        self.feeds.extend(symbol_ids.split(","))
+        return [quote(symbol_id, 100, int(time.time() * 1000)) for symbol_id in symbol_ids.split(",")]
+
+
+@pytest.fixture
+def server():
+    server = KeyValueServer().start()
+    yield server
+    if not server.closed:
+        server.stop()
+
+
+def backend(server):
+    host, port = server.address
+    return RedisBackend(host=host, port=port, timeout=0.5)
+
+
+def replica(server, leader):
+    election = SimpleNamespace(leader=leader, listeners=[])
+    storage = DataStorage(Connector(), shared=backend(server), election=election)
+    storage.cheat_feed = []
+    return storage
+
+
+def test_leadership_moves_when_the_lease_expires(server):
+    first = LeaderElection(backend(server), ttl=0.3, owner="first")
+    second = LeaderElection(backend(server), ttl=0.3, owner="second")
+    assert first.renew() and not second.renew()
+    # the first replica stops renewing without releasing its lease, as a crashed one would
+    time.sleep(0.2)
+    assert not second.renew()
+    time.sleep(0.2)
+    assert second.renew()
+    assert not first.renew()
+    assert (first.leader, second.leader) == (False, True)
+    assert second.transitions == 1 and first.transitions == 2
+
+
+def test_followers_pick_up_new_snapshots(server):
+    leader, follower = replica(server, True), replica(server, False)
+    leader.step()
+    assert follower.step() and "AAPL" in follower.stocks
+    index = follower.snapshot.index
+    written, fetched = [], []
+    set_key, get_key = leader.shared.set, follower.shared.get
+    leader.shared.set = lambda key, *args, **kwargs: written.append(key) or set_key(key, *args, **kwargs)
+    follower.shared.get = lambda key: fetched.append(key) or get_key(key)
+    leader.apply_quote(quote("AAPL.NASDAQ", 105, 2000))
+    leader.share()
+    follower.step()
+    assert follower.feed["AAPL.NASDAQ"]["bid"][0]["value"] == "105"
+    # the universe did not change, so it was neither written again nor fetched, nor was the search index rebuilt
+    assert "snapshot:universe" not in written + fetched
+    assert follower.snapshot.index is index
+    leader.publish(stocks=dict(leader.connector.get_stocks(), TSLA={"id": "TSLA.NASDAQ", "ticker": "TSLA"}))
+    leader.share()
+    follower.step()
+    assert "TSLA" in follower.stocks and follower.universe_id == leader.universe_id
+
+
+def test_newer_local_quotes_survive_a_sync(server):
+    leader, follower = replica(server, True), replica(server, False)
+    leader.publish(stocks=leader.connector.get_stocks())
+    leader.apply_quote(quote("AAPL.NASDAQ", 100, 1000))
+    leader.apply_quote(quote("TSLA.NASDAQ", 200, 1000))
+    follower.apply_quote(quote("AAPL.NASDAQ", 101, 5000))
+    leader.share()
+    follower.step()
+    assert follower.feed["AAPL.NASDAQ"]["timestamp"] == 5000
+    assert follower.feed["TSLA.NASDAQ"]["timestamp"] == 1000
+
+
+def test_the_leader_refreshes_what_followers_watch(server):
+    leader, follower = replica(server, True), replica(server, False)
+    follower.watch(["NFLX.NASDAQ"])
+    follower.polled = lambda: ["AMD.NASDAQ"]
+    follower.step()
+    leader.polled = lambda: []
+    leader.poll_interval = 60
+    leader.step()
+    assert "NFLX.NASDAQ" in leader.watched and "NFLX.NASDAQ" in leader.connector.feeds
+    leader.step()
+    assert leader.connector.feeds[-1] == "AMD.NASDAQ"
+
+
+def test_caches_fall_through_while_the_backend_is_down(server, monkeypatch):
+    shared = backend(server)
+    shared.set("fmp:AAPL:ratios", [{"symbol": "AAPL", "source": "shared"}])
+    fapi = FundamentalApi(shared=shared)
+    monkeypatch.setattr(fapi, "fetch", lambda symbol, sheet: [{"symbol": symbol, "source": "upstream"}])
+    assert fapi.request("AAPL", "ratios")[0]["source"] == "shared"
+    server.stop()
+    assert shared.get("fmp:AAPL:ratios") is None
+    shared.set("fmp:MSFT:ratios", [])
+    assert fapi.request("MSFT", "ratios")[0]["source"] == "upstream"
+    assert shared.members("watched") == set()
+    # without a backend to hold the lease every replica refreshes on its own
+    assert LeaderElection(shared, ttl=1).renew()
+    assert shared.stats()["errors"] > 0
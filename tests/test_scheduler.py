@@ -0,0 +1,124 @@
+import time
+from threading import Thread
+
+import pytest
+
+import bot
+from fundamental import FundamentalApi, LIMIT_REACHED
+from scheduler import RequestScheduler, QuotaExceeded, background
+from transport import HttpTransport
+from standins import StandInServer, Upstream, FMP_PREFIX
+
+
+@pytest.fixture
+def server():
+    server = StandInServer().start()
+    yield server
+    server.stop()
+
+
+def fundamentals(server, scheduler, retries=0):
+    transport = HttpTransport(retries=retries, backoff=0)
+    scheduler.route("fmp", server.url + FMP_PREFIX)
+    transport.on_retry = scheduler.retried
+    return FundamentalApi(transport=transport, scheduler=scheduler, url=server.url + FMP_PREFIX)
+
+
+def test_token_bucket_paces_requests(server):
+    scheduler = RequestScheduler()
+    scheduler.limit("fmp", rate=20, burst=5)
+    fapi = fundamentals(server, scheduler)
+    threads = [Thread(target=fapi.request, args=(f"S{i}", "ratios")) for i in range(15)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # the burst goes out at once, the other ten at 20 per second
+    assert time.monotonic() - started >= 0.45
+    assert server.stats()["requests"]["fmp:ratios"] == 15
+    assert scheduler.stats()["throttled"] > 0
+
+
+def test_interactive_requests_go_first():
+    scheduler = RequestScheduler()
+    scheduler.limit("exante", rate=10, burst=1)
+    scheduler.acquire("exante")
+    order = []
+
+    def take(name, lane_background):
+        if lane_background:
+            with background():
+                scheduler.acquire("exante")
+        else:
+            scheduler.acquire("exante")
+        order.append(name)
+
+    waiting = Thread(target=take, args=("background", True))
+    waiting.start()
+    time.sleep(0.02)
+    threads = [Thread(target=take, args=(f"interactive {i}", False)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads + [waiting]:
+        thread.join()
+    assert order[-1] == "background"
+
+
+def test_cached_sheets_are_served_when_the_quota_runs_low(server):
+    scheduler = RequestScheduler()
+    scheduler.quota("fmp", daily=3, reserve=1)
+    fapi = fundamentals(server, scheduler)
+    first = fapi.request("AAPL", "ratios")
+    fapi.request("MSFT", "ratios")
+    # only the reserve is left: expired sheets are served as they are and new ones are refused
+    fapi.cache[("AAPL", "ratios")] = (first, 0, 0)
+    assert fapi.request("AAPL", "ratios") == first
+    assert fapi.request("TSLA", "ratios") == LIMIT_REACHED
+    assert server.stats()["requests"]["fmp:ratios"] == 2
+    scheduler.acquire("fmp")
+    with pytest.raises(QuotaExceeded):
+        scheduler.acquire("fmp")
+
+
+def test_partly_cached_statements_show_the_limit_notice():
+    stock = {"ticker": "AAPL", "description": "Apple", "exchange": "NASDAQ", "currency": "USD"}
+    data = {"ohlc": {"close": "150"}, "feed": None, "key-metrics": LIMIT_REACHED,
+            "ratios": [{"returnOnEquity": 0.5}], "income-statement": [{"epsdiluted": 1.5}] * 4}
+    msg, limit_reached = bot.format_stock(stock, data)
+    assert limit_reached
+    # the sheets that were cached are still shown
+    assert "<u>0.5</u>" in msg and "<u>6.00 USD</u>" in msg and "<u>25.00</u>" in msg
+
+
+def test_retries_count_against_the_quota(server):
+    server.upstreams["fmp"] = Upstream(error_rate=1.0)
+    scheduler = RequestScheduler()
+    scheduler.quota("fmp", daily=10)
+    fapi = fundamentals(server, scheduler, retries=2)
+    with pytest.raises(Exception):
+        fapi.request("AAPL", "ratios")
+    assert server.stats()["errors"]["fmp:ratios"] == 3
+    assert scheduler.remaining("fmp") == 7
+    assert scheduler.stats()["retries"] == 2
+
+
+def test_retries_of_other_upstreams_are_not_charged(server):
+    scheduler = RequestScheduler()
+    scheduler.quota("fmp", daily=10)
+    scheduler.route("fmp", server.url + FMP_PREFIX)
+    scheduler.retried(server.url + "/md/2.0/feed/AAPL.NASDAQ")
+    assert scheduler.remaining("fmp") == 10
+
+
+def test_quota_usage_survives_a_restart(tmp_path):
+    path = str(tmp_path / "quota.pickle")
+    scheduler = RequestScheduler(path=path)
+    scheduler.quota("fmp", daily=5)
+    for _ in range(3):
+        scheduler.acquire("fmp")
+    assert scheduler.dirty
+    scheduler.save()
+    restarted = RequestScheduler(path=path)
+    restarted.quota("fmp", daily=5)
+    assert restarted.remaining("fmp") == 2
@@ -0,0 +1,85 @@
+import random
+import time
+from statistics import median
+
+import pytest
+
+from search import SearchIndex
+
+SYMBOLS = 50000
+WORDS = ["Global", "United", "American", "Pacific", "First", "National", "Energy", "Capital", "Digital", "Medical",
+         "Systems", "Holdings", "Resources", "Networks", "Pharma", "Motors", "Foods", "Mining", "Realty", "Media",
+         "Solar", "Bio", "Micro", "Quantum", "Ocean", "Silver", "Golden", "Northern", "Western", "Atlantic"]
+SUFFIXES = ["Inc", "Corp", "Group", "Ltd", "PLC", "SA", "AG", "Co"]
+# (p50, p99) limits per query, in seconds; loose enough for a busy CI machine
+LIMITS = {"prefix": (0.001, 0.01), "typo": (0.01, 0.05), "name": (0.01, 0.05)}
+
+
+def generated_universe(size, seed=11):
+    rnd = random.Random(seed)
+    stocks = {}
+    while len(stocks) < size:
+        ticker = "".join(rnd.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(rnd.randint(2, 5)))
+        if ticker in stocks:
+            continue
+        # a made-up word per company, as in real names, keeps the vocabulary large
+        own = "".join(rnd.choice("bcdfgklmnprstvz") + rnd.choice("aeiou") for _ in range(rnd.randint(2, 4))).title()
+        description = f"{own} {rnd.choice(WORDS)} {rnd.choice(WORDS)} {rnd.choice(SUFFIXES)}"
+        exchange = rnd.choice(["NASDAQ", "NYSE", "LSE", "XETRA"])
+        stocks[ticker] = {"id": f"{ticker}.{exchange}", "path_id": f"{ticker}.{exchange}", "ticker": ticker,
+                          "exchange": exchange, "currency": "USD", "description": description, "country": "US"}
+    return stocks
+
+
+def typo(word, rnd):
+    i = rnd.randrange(len(word) - 1)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+@pytest.fixture(scope="module")
+def universe():
+    stocks = generated_universe(SYMBOLS)
+    return stocks, SearchIndex(stocks)
+
+
+@pytest.fixture(scope="module")
+def queries(universe):
+    stocks, _ = universe
+    rnd = random.Random(5)
+    sample = rnd.sample(sorted(stocks.values(), key=lambda s: s["ticker"]), 200)
+    own = [s["description"].split()[0] for s in sample if len(s["description"].split()[0]) >= 6]
+    return {"prefix": [(s["ticker"][:2], None) for s in sample],
+            "typo": [(typo(word, rnd), word) for word in own],
+            "name": [(" ".join(s["description"].split()[:2]), s["ticker"]) for s in sample]}
+
+
+def latencies(index, queries):
+    timings = []
+    for text, _ in queries:
+        started = time.perf_counter()
+        index.search(text)
+        timings.append(time.perf_counter() - started)
+    return sorted(timings)
+
+
+def test_results_are_relevant(universe, queries):
+    _, index = universe
+    assert len(index) == SYMBOLS
+    for text, _ in queries["prefix"]:
+        assert all(key.startswith(text) or text in instrum["description"].upper()
+                   for _, key, instrum in index.search(text))
+    # a swapped pair near the start of a short word shares too few trigrams to be found
+    found = [any(word in instrum["description"] for _, _, instrum in index.search(text))
+             for text, word in queries["typo"]]
+    assert sum(found) >= 0.9 * len(found)
+    for text, ticker in queries["name"]:
+        assert ticker in [key for _, key, _ in index.search(text, limit=50)], text
+
+
+@pytest.mark.parametrize("kind", sorted(LIMITS))
+def test_query_latency(universe, queries, kind):
+    _, index = universe
+    timings = latencies(index, queries[kind])
+    p50, p99 = median(timings), timings[int(len(timings) * 0.99)]
+    assert p50 < LIMITS[kind][0], f"{kind} p50 {p50 * 1000:.2f} ms"
+    assert p99 < LIMITS[kind][1], f"{kind} p99 {p99 * 1000:.2f} ms"
@@ -0,0 +1,57 @@
+import pickle
+
+import pytest
+
+from mdapi import DataStorage
+
+STOCK = {"id": "AAPL.NASDAQ", "path_id": "AAPL.NASDAQ", "ticker": "AAPL", "exchange": "NASDAQ",
+         "currency": "USD", "description": "Apple Inc", "country": "US"}
+QUOTE = {"symbolId": "AAPL.NASDAQ", "timestamp": 1000,
+         "bid": [{"value": "99.5", "size": "100"}], "ask": [{"value": "100.5", "size": "100"}]}
+
+
+@pytest.fixture
+def storage():
+    return DataStorage(connector=None)
+
+
+def test_published_snapshot_cannot_be_changed(storage):
+    storage.publish(stocks={"AAPL": dict(STOCK)})
+    quote = storage.apply_quote(QUOTE)
+    with pytest.raises(TypeError):
+        storage.stocks["AAPL"]["description"] = "changed"
+    with pytest.raises(TypeError):
+        quote["timestamp"] = 0
+    with pytest.raises(TypeError):
+        quote["bid"][0]["value"] = "0"
+    assert storage.feed["AAPL.NASDAQ"]["bid"][0]["value"] == "99.5"
+
+
+def test_partial_quotes_keep_the_other_side(storage):
+    storage.apply_quote(QUOTE)
+    storage.apply_quote({"symbolId": "AAPL.NASDAQ", "timestamp": 2000, "ask": [{"value": "101", "size": "5"}]})
+    quote = storage.feed["AAPL.NASDAQ"]
+    assert quote["bid"][0]["value"] == "99.5" and quote["ask"][0]["value"] == "101"
+
+
+def test_snapshot_file_round_trips(storage, tmp_path):
+    storage.publish(stocks={"AAPL": dict(STOCK)})
+    storage.apply_quote(QUOTE)
+    path = str(tmp_path / "snapshot.pkl")
+    storage.save_snapshot(path)
+    with open(path, "rb") as f:
+        assert pickle.load(f)["feed"]["AAPL.NASDAQ"]["bid"] == QUOTE["bid"]
+    loaded = DataStorage(connector=None, snapshot_path=path)
+    assert loaded.stocks["AAPL"] == STOCK
+    assert loaded.snapshot.index.search("AAPL")
+
+
+def test_snapshot_is_written_before_the_storage_is_ready(tmp_path):
+    path = tmp_path / "snapshot.pkl"
+    storage = DataStorage(connector=None, snapshot_path=str(path))
+    storage.publish(stocks={"AAPL": dict(STOCK)})
+    ready = []
+    save_snapshot = storage.save_snapshot
+    storage.save_snapshot = lambda: ready.append(not storage.skip) or save_snapshot()
+    storage.refreshed()
+    assert ready == [False] and not storage.skip and path.exists()
@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+from mdapi import MDApiConnector, DataStorage
+from scheduler import RequestScheduler
+from transport import HttpTransport
+from standins import StandInServer, EXANTE_PREFIX
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.fixture
+def server():
+    server = StandInServer(feed_interval=0.05).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def storage(server):
+    connector = MDApiConnector("client", "app", "secret", transport=HttpTransport(retries=0),
+                               scheduler=RequestScheduler(), url=server.url + EXANTE_PREFIX)
+    storage = DataStorage(connector, stream=True)
+    storage.stream.max_backoff = 0.1
+    yield storage
+    storage.stream.stop()
+
+
+def test_streamed_quotes_reach_the_feed(server, storage):
+    storage.stream.watch(["AAPL.NASDAQ", "EUR%2FUSD.EXANTE"])
+    storage.stream.start()
+    assert wait_for(lambda: {"AAPL.NASDAQ", "EUR%2FUSD.EXANTE"} <= storage.feed.keys())
+    assert server.streams == [["AAPL.NASDAQ", "EUR/USD.EXANTE"]]
+
+
+def test_dropped_stream_reconnects(server, storage):
+    storage.stream.watch(["AAPL.NASDAQ"])
+    storage.stream.start()
+    assert wait_for(lambda: storage.stream.connected)
+    server.drop_streams()
+    assert wait_for(lambda: len(server.streams) == 2)
+    assert wait_for(lambda: storage.stream.reconnects == 1 and storage.stream.connected)
+
+
+def test_idle_stream_resubscribes_at_once(server, storage):
+    # nothing is ever sent, so only an interrupted read can pick up the new symbol
+    server.feed_interval = 0
+    storage.stream.read_timeout = 60
+    storage.stream.watch(["AAPL.NASDAQ"])
+    storage.stream.start()
+    assert wait_for(lambda: len(server.streams) == 1)
+    started = time.monotonic()
+    storage.stream.watch(["TSLA.NASDAQ"])
+    assert wait_for(lambda: len(server.streams) == 2, timeout=2.0)
+    assert time.monotonic() - started < 1.0
+    assert server.streams[-1] == ["AAPL.NASDAQ", "TSLA.NASDAQ"]
+    assert server.stats()["errors"] == {}
+
+
+def test_known_symbols_keep_the_stream(server, storage):
+    storage.stream.watch(["AAPL.NASDAQ"])
+    storage.stream.start()
+    assert wait_for(lambda: "AAPL.NASDAQ" in storage.feed)
+    storage.stream.watch(["AAPL.NASDAQ"])
+    time.sleep(0.2)
+    assert len(server.streams) == 1
+
+
+def test_quotes_of_a_chunk_are_published_together(server, storage):
+    server.feed_interval = 0.2
+    storage.stream.watch(["AAPL.NASDAQ", "TSLA.NASDAQ", "GOOG.NASDAQ"])
+    published = []
+    storage.listeners.append(published.append)
+    storage.stream.start()
+    assert wait_for(lambda: len(published) >= 2)
+    assert all(len(quotes) == 3 for quotes in published)
+    assert storage.snapshot.generation == len(published)
@@ -0,0 +1,32 @@
+import pickle
+from threading import Thread
+
+from watchlist import Watchlists
+
+
+def test_removing_from_an_unknown_chat_keeps_no_list():
+    watchlists = Watchlists()
+    assert watchlists.remove(1, [("stock", "AAPL")]) == []
+    assert watchlists.lists == {}
+
+
+def test_emptied_lists_are_dropped():
+    watchlists = Watchlists()
+    watchlists.add(1, [("stock", "AAPL")])
+    assert watchlists.remove(1, [("stock", "AAPL")]) == [("stock", "AAPL")]
+    assert 1 not in watchlists.lists
+
+
+def test_concurrent_changes_all_reach_the_file(tmp_path):
+    path = str(tmp_path / "watchlists.pickle")
+    watchlists = Watchlists(path=path, max_symbols=100)
+    threads = [Thread(target=watchlists.add, args=(chat_id, [("stock", f"S{i}") for i in range(20)]))
+               for chat_id in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with open(path, "rb") as f:
+        saved = pickle.load(f)
+    assert saved == watchlists.lists
+    assert Watchlists(path=path).get(15) == [("stock", f"S{i}") for i in range(20)]
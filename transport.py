@@ -0,0 +1,105 @@
+# -*- coding:utf-8 -*-
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class ReportingRetry(Retry):
+    """Retry that reports the full URL of every retry it allows."""
+
+    def __init__(self, *args, report=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.report = report
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.report = self.report
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        # raises once the retries are used up, so only requests that are really made again are reported
+        retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        if self.report is not None and _pool is not None:
+            self.report(f"{_pool.scheme}://{_pool.host}:{_pool.port}{url}")
+        return retry
+
+
+class HttpTransport:
+    """Keep-alive connection pool shared by all API clients.
+
+    Each thread gets its own lightweight ``requests.Session`` (sessions are not
+    thread-safe), but every session is mounted on the same adapter, so TCP/TLS
+    connections are pooled and reused across threads.
+    """
+
+    def __init__(self, pool_size=10, per_host=32, timeout=(3.05, 10), retries=3, backoff=0.5):
+        self.timeout = timeout
+        # called with the URL of every retried request, e.g. RequestScheduler.retried
+        self.on_retry = None
+        retry = ReportingRetry(total=retries,
+                               backoff_factor=backoff,
+                               status_forcelist=RETRY_STATUSES,
+                               method_whitelist=frozenset(["GET"]),
+                               respect_retry_after_header=True,
+                               raise_on_status=False,
+                               report=self._retried)
+        # pool_connections is the number of per-host pools kept around,
+        # pool_maxsize caps the number of open connections to a single host
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=per_host,
+                                   max_retries=retry, pool_block=True)
+        self._local = threading.local()
+
+    @classmethod
+    def from_config(cls, section):
+        return cls(pool_size=section.getint("pool_size", 10),
+                   per_host=section.getint("per_host", 32),
+                   timeout=(section.getfloat("connect_timeout", 3.05), section.getfloat("read_timeout", 10)),
+                   retries=section.getint("retries", 3),
+                   backoff=section.getfloat("backoff", 0.5))
+
+    @property
+    def session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", self.adapter)
+            session.mount("http://", self.adapter)
+            self._local.session = session
+        return session
+
+    def _retried(self, url):
+        if self.on_retry is not None:
+            self.on_retry(url)
+
+    def get(self, url, headers=None, params=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, headers=headers, params=params, **kwargs)
+
+    def stats(self):
+        pools = self.adapter.poolmanager.pools
+        created, requested = 0, 0
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            created += pool.num_connections
+            requested += pool.num_requests
+        return {"new_connections": created,
+                "reused_connections": max(requested - created, 0),
+                "requests": requested,
+                "pools": len(pools)}
+
+    def close(self):
+        self.adapter.close()
+
+
+default_transport = HttpTransport()
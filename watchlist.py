@@ -0,0 +1,78 @@
+# -*- coding:utf-8 -*-
+
+import os
+import pickle
+from threading import Lock
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Watchlists:
+    """Per-chat lists of ``(kind, key)`` instruments, written to disk on every change."""
+
+    def __init__(self, path=None, max_symbols=20):
+        self.lists = {}
+        self.path = path
+        self.max_symbols = max_symbols
+        self._lock = Lock()
+        self._save_lock = Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    self.lists.update(pickle.load(f))
+            except Exception as e:
+                logger.error(f"Could not load watchlists {path}: {e}")
+
+    def get(self, chat_id):
+        with self._lock:
+            return list(self.lists.get(chat_id, ()))
+
+    def add(self, chat_id, entries):
+        # returns the entries that were not on the list yet
+        with self._lock:
+            current = self.lists.setdefault(chat_id, [])
+            added = [e for e in dict.fromkeys(entries) if e not in current][:self.max_symbols - len(current)]
+            current.extend(added)
+        if added:
+            self.save()
+        return added
+
+    def remove(self, chat_id, entries):
+        with self._lock:
+            if chat_id not in self.lists:
+                return []
+            current = self.lists[chat_id]
+            removed = [e for e in current if e in entries]
+            kept = [e for e in current if e not in entries]
+            if kept:
+                self.lists[chat_id] = kept
+            else:
+                del self.lists[chat_id]
+        if removed:
+            self.save()
+        return removed
+
+    def clear(self, chat_id):
+        with self._lock:
+            removed = self.lists.pop(chat_id, [])
+        if removed:
+            self.save()
+        return removed
+
+    def save(self, path=None):
+        path = path or self.path
+        if not path:
+            return
+        # held from the copy to the rename, so an older copy can never replace a newer file
+        with self._save_lock:
+            with self._lock:
+                data = {chat_id: list(entries) for chat_id, entries in self.lists.items() if entries}
+            tmp = path + ".tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, path)
+            except OSError as e:
+                logger.error(f"Could not save watchlists {path}: {e}")